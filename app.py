@@ -7,7 +7,7 @@ import logging
 import urllib.parse
 from xml.etree import ElementTree
 
-from flask import abort, Flask, redirect, render_template, request
+from flask import abort, Flask, redirect, render_template, request, Response
 from flask_caching import Cache
 import flask_gae_static
 from google.cloud import ndb
@@ -265,7 +265,8 @@ def url():
       activities = [as2.to_as1(obj) for obj in body_items]
     elif input == 'atom':
       try:
-        activities = atom.atom_to_activities(resp.text)
+        activities = list(atom.iter_atom_to_activities(
+          resp.iter_content(source.XML_PARSE_CHUNK_SIZE)))
       except ElementTree.ParseError as e:
         raise BadRequest(f'Could not parse {final_url} as XML: {e}')
       except ValueError as e:
@@ -279,12 +280,12 @@ def url():
     elif input == 'jsonfeed':
       activities, actor = jsonfeed.jsonfeed_to_activities(body_json)
     elif input == 'rss':
+      # feedparser, not the strict incremental rss.iter_to_activities, since
+      # lots of real world RSS isn't well formed XML, eg has &nbsp; entities
       try:
         activities = rss.to_activities(resp.text)
-      except ElementTree.ParseError as e:
-        raise BadRequest(f'Could not parse {final_url} as XML: {e}')
       except ValueError as e:
-        raise BadRequest(f'Could not parse {final_url} as Atom: {e}')
+        raise BadRequest(f'Could not parse {final_url} as RSS: {e}')
   except ValueError as e:
     logger.warning('parsing input failed', exc_info=True)
     return abort(400, f'Could not parse {final_url} as {input}: {str(e)}')
@@ -395,6 +396,11 @@ def make_response(response, actor=None, url=None, title=None, hfeed=None):
       reader = request.values.get('reader', 'true').lower()
       if reader not in ('true', 'false'):
         return abort(400, 'reader param must be either true or false')
+      # streamed responses aren't stored in the response cache, so only stream
+      # when asked to
+      stream = request.values.get('stream', 'false').lower()
+      if stream not in ('true', 'false'):
+        return abort(400, 'stream param must be either true or false')
       if not actor and hfeed:
         actor = microformats2.json_to_object({
           'properties': hfeed.get('properties', {}),
@@ -407,7 +413,7 @@ def make_response(response, actor=None, url=None, title=None, hfeed=None):
         link_hub = urllib.parse.quote(hub, safe=':/?&=')
         headers['Link'].append(f'<{link_hub}>; rel="hub"')
 
-      return atom.activities_to_atom(
+      feed = atom.iter_activities_to_atom(
         activities, actor,
         host_url=url or request.host_url + '/',
         request_url=request.url,
@@ -415,7 +421,10 @@ def make_response(response, actor=None, url=None, title=None, hfeed=None):
         title=title,
         rels={'hub': hub} if hub else None,
         reader=(reader == 'true'),
-      ), headers
+      )
+      if stream == 'true':
+        return Response(feed, headers=headers)
+      return ''.join(feed), headers
 
     elif format == 'rss':
       if not title:
@@ -3,9 +3,12 @@ import collections
 import logging
 from operator import itemgetter
 import re
+import time
 
 from oauth_dropins.webutil import util
 
+from . import httputil
+
 logger = logging.getLogger(__name__)
 
 # maps each AS1 RSVP verb to the collection inside an event object that the
@@ -28,6 +31,12 @@ VERBS_WITH_OBJECT = {
 # used in original_post_discovery
 _PERMASHORTCITATION_RE = re.compile(r'\(([^:\s)]+\.[^\s)]{2,})[ /]([^\s)]+)\)$')
 
+# used in resolve_redirects. Cached values are dicts with keys url (final URL),
+# html (boolean), and expires (POSIX timestamp), so they can be stored in any
+# caches.Cache, including ones shared across processes.
+REDIRECT_CACHE_TIME = 24 * 60 * 60  # 1 day, in seconds
+REDIRECT_FAILURE_CACHE_TIME = 60 * 60  # 1 hour, in seconds
+
 
 def object_type(obj):
   """Returns the object type, or the verb if it's an activity object.
@@ -193,37 +202,64 @@ def actor_name(actor):
   return 'Unknown'
 
 
-def original_post_discovery(
-    activity, domains=None, include_redirect_sources=True,
-    include_reserved_hosts=True, max_redirect_fetches=None, **kwargs):
-  """Discovers original post links.
+def resolve_redirects(urls, cache=None, max_workers=1, **kwargs):
+  """Follows redirects for multiple URLs, concurrently, with optional caching.
 
-  This is a variation on http://indiewebcamp.com/original-post-discovery . It
-  differs in that it finds multiple candidate links instead of one, and it
-  doesn't bother looking for MF2 (etc) markup because the silos don't let you
-  input it. More background:
-  https://github.com/snarfed/bridgy/issues/51#issuecomment-136018857
+  If cache is provided, results are stored in it for
+  :const:`REDIRECT_CACHE_TIME`. Failed fetches are cached too, but only for
+  :const:`REDIRECT_FAILURE_CACHE_TIME`.
+
+  Args:
+    urls: sequence of string URLs
+    cache: :class:`caches.Cache` or dict, optional. Pass eg a
+      :class:`caches.MemcacheCache` to share resolved URLs across processes.
+    max_workers: int, max number of URLs to fetch at once. Defaults to 1, ie
+      serial.
+    kwargs: passed to requests.head()
+
+  Returns:
+    dict mapping each URL that redirects to an HTML page to its final URL
+  """
+  now = time.time()
+  results = {}
+  to_fetch = []
+  for url in dict.fromkeys(urls):
+    cached = cache.get(f'R {url}') if cache is not None else None
+    if cached and cached.get('expires', 0) > now:
+      results[url] = cached
+    else:
+      to_fetch.append(url)
+
+  def fetch(url):
+    resolved = util.follow_redirects(url, **kwargs)
+    failed = not resolved.ok
+    return {
+      'url': resolved.url,
+      'html': resolved.headers.get('content-type', '').startswith('text/html'),
+      'expires': time.time() + (REDIRECT_FAILURE_CACHE_TIME if failed
+                                else REDIRECT_CACHE_TIME),
+    }
+
+  fetched = httputil.map_concurrently(fetch, to_fetch, max_workers=max_workers)
+  for url, result in zip(to_fetch, fetched):
+    if cache is not None:
+      cache[f'R {url}'] = result
+    results[url] = result
+
+  return {url: result['url'] for url, result in results.items()
+          if result['url'] != url and result['html']}
 
-  Original post candidates come from the upstreamDuplicates, attachments, and
-  tags fields, as well as links and permashortlinks/permashortcitations in the
-  text content.
+
+def _original_post_candidates(activity):
+  """Returns an activity's original post candidate URLs.
+
+  Details in :func:`original_post_discovery`.
 
   Args:
     activity: activity dict
-    domains: optional sequence of domains. If provided, only links to these
-      domains will be considered original and stored in upstreamDuplicates.
-      (Permashortcitations are exempt.)
-    include_redirect_sources: boolean, whether to include URLs that redirect
-      as well as their final destination URLs
-    include_reserved_hosts: boolean, whether to include domains on reserved
-      TLDs (eg foo.example) and local hosts (eg http://foo.local/,
-      http://my-server/)
-    max_redirect_fetches: if specified, only make up to this many HTTP
-      fetches to resolve redirects.
-    kwargs: passed to requests.head() when following redirects
 
   Returns:
-    ([string original post URLs], [string mention URLs]) tuple
+    list of string URLs, cleaned and deduped
   """
   obj = activity.get('object') or activity
   content = obj.get('content', '').strip()
@@ -241,23 +277,39 @@ def original_post_discovery(
   candidates += [match.expand(r'http://\1/\2') for match in
                  _PERMASHORTCITATION_RE.finditer(content)]
 
-  candidates = util.dedupe_urls(
+  return util.dedupe_urls(
     util.clean_url(url) for url in candidates
     if url and (url.startswith('http://') or url.startswith('https://')) and
     # heuristic: ellipsized URLs are probably incomplete, so omit them.
     not url.endswith('...') and not url.endswith('…'))
 
-  # check for redirect and add their final urls
+
+def _to_fetch(candidates, max_redirect_fetches):
+  """Returns the candidate URLs to resolve redirects for, up to the limit."""
   if max_redirect_fetches and len(candidates) > max_redirect_fetches:
-    logger.warning('Found {len(candidates)} original post candidates, only resolving redirects for the first {max_redirect_fetches}')
-  redirects = {}  # maps final URL to original URL for redirects
-  for url in candidates[:max_redirect_fetches]:
-    resolved = util.follow_redirects(url, **kwargs)
-    if (resolved.url != url and
-        resolved.headers.get('content-type', '').startswith('text/html')):
-      redirects[resolved.url] = url
+    logger.warning(f'Found {len(candidates)} original post candidates, only resolving redirects for the first {max_redirect_fetches}')
+  return candidates[:max_redirect_fetches]
 
-  candidates.extend(redirects.keys())
+
+def _classify_candidates(candidates, redirects, domains=None,
+                         include_redirect_sources=True,
+                         include_reserved_hosts=True):
+  """Splits original post candidates into originals and mentions.
+
+  Details in :func:`original_post_discovery`.
+
+  Args:
+    candidates: list of string URLs
+    redirects: dict mapping candidate URLs that redirect to their final URLs
+    domains, include_redirect_sources, include_reserved_hosts: see
+      :func:`original_post_discovery`
+
+  Returns:
+    ([string original post URLs], [string mention URLs]) tuple
+  """
+  # maps final URL to original URL for redirects
+  redirects = {redirects[url]: url for url in candidates if url in redirects}
+  candidates = candidates + list(redirects.keys())
 
   # use domains to determine which URLs are original post links vs mentions
   originals = set()
@@ -286,3 +338,80 @@ def original_post_discovery(
 
   logger.info(f'Original post discovery found original posts {originals}, mentions {mentions}')
   return originals, mentions
+
+
+def original_post_discovery(
+    activity, domains=None, include_redirect_sources=True,
+    include_reserved_hosts=True, max_redirect_fetches=None,
+    redirect_cache=None, max_workers=1, **kwargs):
+  """Discovers original post links.
+
+  This is a variation on http://indiewebcamp.com/original-post-discovery . It
+  differs in that it finds multiple candidate links instead of one, and it
+  doesn't bother looking for MF2 (etc) markup because the silos don't let you
+  input it. More background:
+  https://github.com/snarfed/bridgy/issues/51#issuecomment-136018857
+
+  Original post candidates come from the upstreamDuplicates, attachments, and
+  tags fields, as well as links and permashortlinks/permashortcitations in the
+  text content.
+
+  Args:
+    activity: activity dict
+    domains: optional sequence of domains. If provided, only links to these
+      domains will be considered original and stored in upstreamDuplicates.
+      (Permashortcitations are exempt.)
+    include_redirect_sources: boolean, whether to include URLs that redirect
+      as well as their final destination URLs
+    include_reserved_hosts: boolean, whether to include domains on reserved
+      TLDs (eg foo.example) and local hosts (eg http://foo.local/,
+      http://my-server/)
+    max_redirect_fetches: if specified, only make up to this many HTTP
+      fetches to resolve redirects.
+    redirect_cache: passed to :func:`resolve_redirects` as cache
+    max_workers: passed to :func:`resolve_redirects`
+    kwargs: passed to requests.head() when following redirects
+
+  Returns:
+    ([string original post URLs], [string mention URLs]) tuple
+  """
+  candidates = _original_post_candidates(activity)
+  redirects = resolve_redirects(_to_fetch(candidates, max_redirect_fetches),
+                                cache=redirect_cache,
+                                max_workers=max_workers, **kwargs)
+  return _classify_candidates(
+    candidates, redirects, domains=domains,
+    include_redirect_sources=include_redirect_sources,
+    include_reserved_hosts=include_reserved_hosts)
+
+
+def original_post_discovery_batch(
+    activities, domains=None, include_redirect_sources=True,
+    include_reserved_hosts=True, max_redirect_fetches=None,
+    redirect_cache=None, max_workers=1, **kwargs):
+  """Runs :func:`original_post_discovery` on multiple activities.
+
+  Collects all of the activities' candidate URLs first, then resolves each
+  distinct URL's redirects only once, concurrently, even if it appears in many
+  activities.
+
+  Args:
+    activities: sequence of activity dicts
+    max_redirect_fetches: if specified, only resolve redirects for up to this
+      many candidate URLs per activity
+    domains, include_redirect_sources, include_reserved_hosts, redirect_cache,
+    max_workers, kwargs: see :func:`original_post_discovery`
+
+  Returns:
+    list of ([string original post URLs], [string mention URLs]) tuples, one
+    per activity, in the same order
+  """
+  candidates = [_original_post_candidates(a) for a in activities]
+  to_fetch = sum((_to_fetch(c, max_redirect_fetches) for c in candidates), [])
+  redirects = resolve_redirects(to_fetch, cache=redirect_cache,
+                                max_workers=max_workers, **kwargs)
+  return [_classify_candidates(
+            c, redirects, domains=domains,
+            include_redirect_sources=include_redirect_sources,
+            include_reserved_hosts=include_reserved_hosts)
+          for c in candidates]
@@ -26,9 +26,9 @@ NAMESPACES = {
   'georss': 'http://www.georss.org/georss',
   'thr': 'http://purl.org/syndication/thread/1.0',
 }
+# min number of characters per chunk that iter_activities_to_atom yields
+STREAM_CHUNK_SIZE = 8192
 
-jinja_env = jinja2.Environment(
-  loader=jinja2.PackageLoader(__package__, 'templates'), autoescape=True)
 
 
 def _encode_ampersands(text):
@@ -88,6 +88,9 @@ class Defaulter(collections.defaultdict):
   can continue to be referenced when an attribute or item lookup fails. Helps
   avoid conditionals in the template itself.
   https://docs.djangoproject.com/en/1.8/ref/templates/language/#variables
+
+  Copies its input, recursively. The templates here now use
+  :class:`DefaultingEnvironment` instead, which doesn't.
   """
   def __init__(self, init={}):
     super(Defaulter, self).__init__(
@@ -112,10 +115,49 @@ class Defaulter(collections.defaultdict):
     return super(Defaulter, self).__hash__() if self else None.__hash__()
 
 
+class _Empty(dict):
+  """Empty, falsy value that renders as ''. See :class:`DefaultingEnvironment`."""
+  def __str__(self):
+    return ''
+
+  def __hash__(self):
+    return None.__hash__()
+
+
+EMPTY = _Empty()
+
+
+class DefaultingEnvironment(jinja2.Environment):
+  """Jinja environment that gives templates :class:`Defaulter` semantics.
+
+  Attribute and item lookups on dicts that fail return :data:`EMPTY`, which
+  can continue to be referenced, instead of :class:`jinja2.Undefined`. Unlike
+  :class:`Defaulter`, this doesn't copy the template's input. Lookups on
+  anything other than dicts behave as usual.
+  """
+  def getattr(self, obj, attribute):
+    val = super().getattr(obj, attribute)
+    if isinstance(val, jinja2.Undefined) and isinstance(obj, dict):
+      return EMPTY
+    return val
+
+  def getitem(self, obj, argument):
+    val = super().getitem(obj, argument)
+    if isinstance(val, jinja2.Undefined) and isinstance(obj, dict):
+      return EMPTY
+    return val
+
+
+jinja_env = DefaultingEnvironment(
+  loader=jinja2.PackageLoader(__package__, 'templates'), autoescape=True)
+
+
 def activities_to_atom(activities, actor, title=None, request_url=None,
                        host_url=None, xml_base=None, rels=None, reader=True):
   """Converts ActivityStreams 1 activities to an Atom feed.
 
+  See :func:`iter_activities_to_atom` for a streaming version.
+
   Args:
     activities: list of ActivityStreams activity dicts
     actor: ActivityStreams actor dict, the author of the feed
@@ -131,6 +173,30 @@ def activities_to_atom(activities, actor, title=None, request_url=None,
   Returns:
     unicode string with Atom XML
   """
+  return ''.join(iter_activities_to_atom(
+    activities, actor, title=title, request_url=request_url, host_url=host_url,
+    xml_base=xml_base, rels=rels, reader=reader))
+
+
+def iter_activities_to_atom(activities, actor, title=None, request_url=None,
+                            host_url=None, xml_base=None, rels=None,
+                            reader=True):
+  """Converts ActivityStreams 1 activities to an Atom feed, incrementally.
+
+  Generator version of :func:`activities_to_atom`. Prepares and renders each
+  activity only when it's reached, so memory use stays bounded regardless of
+  the number of activities, as long as activities is itself an iterator.
+  Useful for streaming HTTP responses.
+
+  Args:
+    activities: iterable of ActivityStreams activity dicts
+    actor: ActivityStreams actor dict, the author of the feed
+    other kwargs: see :func:`activities_to_atom`
+
+  Yields:
+    unicode strings, chunks of Atom XML, usually at least
+    :const:`STREAM_CHUNK_SIZE` characters each
+  """
   # Strip query params from URLs so that we don't include access tokens, etc
   host_url = (_remove_query_params(host_url) if host_url
               else 'https://github.com/snarfed/granary')
@@ -138,19 +204,28 @@ def activities_to_atom(activities, actor, title=None, request_url=None,
     request_url = host_url
 
   _prepare_actor(actor)
-  for a in activities:
-    _prepare_activity(a, reader=reader)
 
-  updated = (util.get_first(activities[0], 'object', default={}).get('published', '')
-             if activities else '')
+  activities = iter(activities)
+  first = next(activities, None)
+  if first is not None:
+    _prepare_activity(first, reader=reader)
+  updated = (util.get_first(first, 'object', default={}).get('published', '')
+             if first else '')
+
+  def items():
+    if first is not None:
+      yield first
+    for a in activities:
+      _prepare_activity(a, reader=reader)
+      yield a
 
   if actor is None:
     actor = {}
 
-  return jinja_env.get_template(FEED_TEMPLATE).render(
-    actor=Defaulter(actor),
+  chunks = jinja_env.get_template(FEED_TEMPLATE).generate(
+    actor=actor,
     host_url=host_url,
-    items=[Defaulter(a) for a in activities],
+    items=items(),
     mimetypes=mimetypes,
     rels=rels or {},
     request_url=request_url,
@@ -160,6 +235,19 @@ def activities_to_atom(activities, actor, title=None, request_url=None,
     xml_base=xml_base,
   )
 
+  buffer = []
+  size = 0
+  for chunk in chunks:
+    buffer.append(chunk)
+    size += len(chunk)
+    if size >= STREAM_CHUNK_SIZE:
+      yield ''.join(buffer)
+      buffer = []
+      size = 0
+
+  if buffer:
+    yield ''.join(buffer)
+
 
 def activity_to_atom(activity, xml_base=None, reader=True):
   """Converts a single ActivityStreams 1 activity to an Atom entry.
@@ -176,7 +264,7 @@ def activity_to_atom(activity, xml_base=None, reader=True):
   """
   _prepare_activity(activity, reader=reader)
   return jinja_env.get_template(ENTRY_TEMPLATE).render(
-    activity=Defaulter(activity),
+    activity=activity,
     mimetypes=mimetypes,
     VERBS_WITH_OBJECT=as1.VERBS_WITH_OBJECT,
     xml_base=xml_base,
@@ -193,11 +281,42 @@ def atom_to_activities(atom):
     list of ActivityStreams activity dicts
   """
   assert isinstance(atom, str)
-  parser = ElementTree.XMLParser(encoding='UTF-8')
-  feed = ElementTree.XML(atom.encode('utf-8'), parser=parser)
-  if _tag(feed) != 'feed':
-    raise ValueError(f'Expected root feed tag; got {feed.tag}')
-  return [_atom_to_activity(elem) for elem in feed if _tag(elem) == 'entry']
+  return list(iter_atom_to_activities(atom))
+
+
+def iter_atom_to_activities(atom):
+  """Converts an Atom feed to ActivityStreams 1 activities, incrementally.
+
+  Generator version of :func:`atom_to_activities`. Parses the feed one entry at
+  a time and discards each entry once it's converted, so memory use stays
+  bounded regardless of the feed's size.
+
+  Args:
+    atom: Atom document with top-level <feed> element. Unicode or byte string,
+      file-like object, or iterable of chunks, eg
+      :meth:`requests.Response.iter_content`.
+
+  Yields:
+    ActivityStreams activity dicts
+
+  Raises:
+    :class:`ElementTree.ParseError` if the XML is malformed,
+    :class:`ValueError` if the top-level element isn't <feed>
+  """
+  feed = None
+  depth = 0
+  for event, elem in source.xml_iterparse(atom):
+    if event == 'start':
+      if feed is None:
+        feed = elem
+        if _tag(feed) != 'feed':
+          raise ValueError(f'Expected root feed tag; got {feed.tag}')
+      depth += 1
+    else:
+      depth -= 1
+      if depth == 1 and _tag(elem) == 'entry':
+        yield _atom_to_activity(elem)
+        feed.remove(elem)
 
 
 def atom_to_activity(atom):
@@ -0,0 +1,524 @@
+"""Benchmarks for granary's format conversions.
+
+Times the same conversions that tests/test_testdata.py exercises, on the canned
+objects in tests/testdata/ individually and on synthetic feeds built from them,
+and reports throughput and peak memory. Results can be saved as a baseline and
+compared against later to catch performance regressions.
+
+Also times the Facebook reactions scraper on the canned mbasic HTML page in
+tests/testdata/, both on a full parse and on the targeted parse that it does
+itself, and checks that both produce the same output.
+
+Usage::
+
+  python -m granary.bench
+  python -m granary.bench --sizes 10,100 --filter atom --save baseline.json
+  python -m granary.bench --compare baseline.json --threshold 0.2
+
+Exits with status 1 if --compare finds any regressions, if a benchmark raises
+an exception, or if a scraper's targeted parse changes its output.
+"""
+import argparse
+import copy
+from datetime import datetime
+import glob
+import itertools
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+import jinja2
+from oauth_dropins.webutil import util
+from oauth_dropins.webutil.util import json_dumps, json_loads
+
+from . import as1, as2, atom, facebook, jsonfeed, microformats2, rss, source
+
+TESTDATA_DIR = os.path.join(os.path.dirname(__file__), 'tests', 'testdata')
+
+DEFAULT_SIZES = (10, 100, 10000)
+# run each benchmark for at least this many seconds, and at least once
+DEFAULT_MIN_TIME = .5
+# fractional change in ops/sec or peak memory that counts as a regression
+DEFAULT_THRESHOLD = .1
+
+ACTOR = {
+  'objectType': 'person',
+  'displayName': 'Ms. Benchmark',
+  'url': 'https://bench/',
+  'image': {'url': 'https://bench/pic.jpg'},
+}
+
+
+class Benchmark(object):
+  """A single benchmark.
+
+  Attributes:
+    name: string
+    fn: callable that does one operation. Takes the values returned by setup
+      as positional args.
+    setup: callable that returns a tuple of args for fn. Called before every
+      operation, outside the timed section, so that fn can modify its inputs.
+    items: int, number of objects each operation converts
+  """
+  def __init__(self, name, fn, setup, items=1):
+    self.name = name
+    self.fn = fn
+    self.setup = setup
+    self.items = items
+
+  def run(self, min_time=DEFAULT_MIN_TIME):
+    """Runs this benchmark.
+
+    Args:
+      min_time: float, minimum number of seconds to spend running operations
+
+    Returns:
+      dict with keys:
+      * ops_per_sec: float
+      * items_per_sec: float
+      * peak_kb: float, peak memory allocated during one operation, in KB
+    """
+    ops = 0
+    elapsed = 0
+    while ops == 0 or elapsed < min_time:
+      args = self.setup()
+      start = time.perf_counter()
+      self.fn(*args)
+      elapsed += time.perf_counter() - start
+      ops += 1
+
+    args = self.setup()
+    tracemalloc.start()
+    try:
+      self.fn(*args)
+      _, peak = tracemalloc.get_traced_memory()
+    finally:
+      tracemalloc.stop()
+
+    return {
+      'ops_per_sec': ops / elapsed,
+      'items_per_sec': ops * self.items / elapsed,
+      'peak_kb': peak / 1024,
+    }
+
+
+def read_testdata(ext):
+  """Reads all testdata files with a given extension.
+
+  Args:
+    ext: string, eg 'as.json'. Only matches files whose extension is exactly
+      this, eg not as-from-mf2.json for 'as.json'.
+
+  Returns:
+    list of file contents, decoded from JSON if ext ends in .json. Skips JSON
+    files that don't parse.
+  """
+  contents = []
+  for filename in sorted(glob.glob(os.path.join(TESTDATA_DIR, f'*.{ext}'))):
+    base = os.path.basename(filename)[:-len(ext) - 1]
+    if '.' in base:
+      continue
+    with open(filename, encoding='utf-8') as f:
+      content = f.read()
+    if ext.endswith('.json'):
+      try:
+        content = json_loads(content)
+      except ValueError:
+        # a few testdata files aren't valid JSON and aren't used by tests
+        continue
+    contents.append(content)
+  return contents
+
+
+def _as1_objects():
+  """Returns the canned test ActivityStreams 1 objects, excluding feeds."""
+  return [obj for obj in read_testdata('as.json')
+          if isinstance(obj, dict)
+          and obj.get('objectType') not in ('feed', 'collection')]
+
+
+def _copy(val):
+  return (copy.deepcopy(val),)
+
+
+def _each(fn):
+  def call(vals):
+    return [fn(val) for val in vals]
+  return call
+
+
+def _as_activity(obj):
+  if obj.get('objectType') == 'activity':
+    return obj
+  return {'objectType': 'activity', 'verb': 'post', 'object': obj}
+
+
+def _works(fn, val):
+  """Returns True if fn(val) doesn't raise an exception, False otherwise."""
+  try:
+    fn(copy.deepcopy(val))
+    return True
+  except Exception:
+    return False
+
+
+def object_benchmarks():
+  """Returns benchmarks that convert each canned test object once per operation.
+
+  Returns:
+    list of :class:`Benchmark`
+  """
+  objs = _as1_objects()
+  activities = [_as_activity(obj) for obj in objs]
+  mf2_json = [obj for obj in read_testdata('mf2.json') if isinstance(obj, dict)]
+  mf2_html = read_testdata('mf2.html')
+  as2_objs = read_testdata('as2.json')
+  feeds = read_testdata('feed.json')
+  rss_docs = read_testdata('rss.xml')
+
+  atom_activities = [a for a in activities
+                     if _works(lambda a: atom.activity_to_atom(a), a)]
+  atom_entries = [atom.activity_to_atom(copy.deepcopy(a)) for a in atom_activities]
+
+  conversions = (
+    ('microformats2.object_to_json', microformats2.object_to_json, objs),
+    ('microformats2.object_to_html', microformats2.object_to_html, objs),
+    ('microformats2.json_to_object', microformats2.json_to_object, mf2_json),
+    ('microformats2.json_to_html', microformats2.json_to_html, mf2_json),
+    ('microformats2.html_to_activities', microformats2.html_to_activities,
+     mf2_html),
+    ('as2.from_as1', as2.from_as1, objs),
+    ('as2.to_as1', as2.to_as1, as2_objs),
+    ('atom.activity_to_atom', atom.activity_to_atom, atom_activities),
+    ('atom.atom_to_activity', atom.atom_to_activity, atom_entries),
+    ('jsonfeed.activities_to_jsonfeed',
+     lambda a: jsonfeed.activities_to_jsonfeed([a], ACTOR), activities),
+    ('jsonfeed.jsonfeed_to_activities', jsonfeed.jsonfeed_to_activities, feeds),
+    ('rss.from_activities',
+     lambda a: rss.from_activities([a], ACTOR, title='Bench',
+                                   feed_url='https://bench/feed'),
+     activities),
+    ('rss.to_activities', rss.to_activities, rss_docs),
+  )
+
+  benchmarks = []
+  for name, fn, inputs in conversions:
+    inputs = [val for val in inputs if _works(fn, val)]
+    if inputs:
+      benchmarks.append(Benchmark(f'objects/{name}', _each(fn),
+                                  lambda inputs=inputs: _copy(inputs),
+                                  items=len(inputs)))
+  return benchmarks
+
+
+def synthetic_activities(size):
+  """Returns a synthetic feed of activities built from the canned test objects.
+
+  Cycles through the test objects that all feed formats can convert, and gives
+  each activity a unique id and URL.
+
+  Args:
+    size: int, number of activities
+
+  Returns:
+    list of ActivityStreams activity dicts
+  """
+  candidates = [_as_activity(obj) for obj in _as1_objects()]
+  candidates = [a for a in candidates if isinstance(a.get('object'), dict) and all(
+    _works(fn, [a]) for fn in (
+      lambda a: atom.activities_to_atom(a, ACTOR),
+      lambda a: rss.from_activities(a, ACTOR, feed_url='https://bench/feed'),
+      lambda a: jsonfeed.activities_to_jsonfeed(a, ACTOR),
+      microformats2.activities_to_html,
+    ))]
+
+  activities = []
+  for i, activity in zip(range(size), itertools.cycle(candidates)):
+    activity = copy.deepcopy(activity)
+    activity['object']['id'] = activity['object']['url'] = f'https://bench/{i}'
+    activities.append(activity)
+  return activities
+
+
+# plain Jinja environment for _defaulter_activities_to_atom
+DEFAULTER_JINJA_ENV = jinja2.Environment(loader=atom.jinja_env.loader,
+                                         autoescape=True)
+
+
+def _defaulter_activities_to_atom(activities, actor):
+  """Renders an Atom feed the way atom.activities_to_atom did before it used
+  :class:`atom.DefaultingEnvironment`, with each activity copied into a
+  :class:`atom.Defaulter`. For comparison.
+  """
+  atom._prepare_actor(actor)
+
+  def items():
+    for a in activities:
+      atom._prepare_activity(a)
+      yield atom.Defaulter(a)
+
+  return ''.join(DEFAULTER_JINJA_ENV.get_template(atom.FEED_TEMPLATE).generate(
+    actor=atom.Defaulter(actor),
+    host_url='https://bench/',
+    items=items(),
+    mimetypes=atom.mimetypes,
+    rels={},
+    request_url='https://bench/',
+    title='Bench',
+    updated='',
+    VERBS_WITH_OBJECT=as1.VERBS_WITH_OBJECT,
+    xml_base=None,
+  ))
+
+
+def feed_benchmarks(size):
+  """Returns benchmarks that convert a whole synthetic feed per operation.
+
+  Args:
+    size: int, number of items in the feed
+
+  Returns:
+    list of :class:`Benchmark`
+  """
+  activities = synthetic_activities(size)
+  objs = [a['object'] for a in activities]
+
+  def render(fn):
+    return fn(copy.deepcopy(activities))
+
+  atom_feed = render(lambda a: atom.activities_to_atom(a, ACTOR))
+  rss_feed = render(lambda a: rss.from_activities(
+    a, ACTOR, title='Bench', feed_url='https://bench/feed'))
+  json_feed = render(lambda a: jsonfeed.activities_to_jsonfeed(a, ACTOR))
+  html = render(microformats2.activities_to_html)
+  mf2_objs = [microformats2.object_to_json(obj) for obj in copy.deepcopy(objs)]
+  as2_objs = [as2.from_as1(obj) for obj in copy.deepcopy(objs)]
+
+  def consume(iterator):
+    for _ in iterator:
+      pass
+
+  conversions = (
+    ('atom.activities_to_atom', lambda a: atom.activities_to_atom(a, ACTOR),
+     activities),
+    ('atom.activities_to_atom.defaulter',
+     lambda a: _defaulter_activities_to_atom(a, ACTOR), activities),
+    ('atom.iter_activities_to_atom',
+     lambda a: consume(atom.iter_activities_to_atom(iter(a), ACTOR)), activities),
+    ('atom.atom_to_activities', atom.atom_to_activities, atom_feed),
+    ('atom.iter_atom_to_activities',
+     lambda feed: consume(atom.iter_atom_to_activities(feed)), atom_feed),
+    ('rss.from_activities',
+     lambda a: rss.from_activities(a, ACTOR, title='Bench',
+                                   feed_url='https://bench/feed'),
+     activities),
+    ('rss.to_activities', rss.to_activities, rss_feed),
+    ('rss.iter_to_activities',
+     lambda feed: consume(rss.iter_to_activities(feed)), rss_feed),
+    ('jsonfeed.activities_to_jsonfeed',
+     lambda a: jsonfeed.activities_to_jsonfeed(a, ACTOR), activities),
+    ('jsonfeed.jsonfeed_to_activities', jsonfeed.jsonfeed_to_activities,
+     json_feed),
+    ('microformats2.activities_to_html', microformats2.activities_to_html,
+     activities),
+    ('microformats2.html_to_activities', microformats2.html_to_activities, html),
+    ('microformats2.object_to_json', _each(microformats2.object_to_json), objs),
+    ('microformats2.json_to_object', _each(microformats2.json_to_object),
+     mf2_objs),
+    ('as2.from_as1', _each(as2.from_as1), objs),
+    ('as2.to_as1', _each(as2.to_as1), as2_objs),
+  )
+
+  return [Benchmark(f'feed-{size}/{name}', fn,
+                    lambda input=input: _copy(input), items=size)
+          for name, fn, input in conversions]
+
+
+def _scrapers():
+  """Returns (name, function, [HTML pages]) tuples for the scrape benchmarks.
+
+  Only includes scrapers that do a targeted parse. Each function takes an HTML
+  string or a full :class:`bs4.BeautifulSoup` parse of it and returns the
+  scraper's JSON output.
+  """
+  fb = facebook.Facebook(scrape=True, cookie_c_user='bench', cookie_xs='bench')
+
+  def reactions(html):
+    return fb.merge_scraped_reactions(html, {
+      'fb_id': '1',
+      'url': 'https://bench/1',
+      'object': {},
+    })
+
+  with open(os.path.join(TESTDATA_DIR, 'facebook.mbasic.reactions.html'),
+            encoding='utf-8') as f:
+    page = f.read()
+
+  return (
+    ('facebook.merge_scraped_reactions', reactions, [page]),
+  )
+
+
+def _full_parse(html):
+  return util.parse_html(html, features=source.SCRAPE_PARSER)
+
+
+def scrape_benchmarks():
+  """Returns benchmarks that scrape the canned Facebook HTML pages.
+
+  Each scraper gets two benchmarks: .../full, which parses each whole page
+  first, like the scraper did before it targeted its parse, and .../targeted,
+  which passes the raw HTML so the scraper only parses the parts it uses.
+
+  Returns:
+    list of :class:`Benchmark`
+  """
+  benchmarks = []
+  for name, fn, pages in _scrapers():
+    benchmarks.extend([
+      Benchmark(f'scrape/{name}/full',
+                _each(lambda html, fn=fn: fn(_full_parse(html))),
+                lambda pages=pages: (pages,), items=len(pages)),
+      Benchmark(f'scrape/{name}/targeted', _each(fn),
+                lambda pages=pages: (pages,), items=len(pages)),
+    ])
+  return benchmarks
+
+
+def check_scrapers():
+  """Checks that the scrapers' targeted parses don't change their output.
+
+  Returns:
+    list of string descriptions of mismatches, empty if there are none
+  """
+  # scraped relative timestamps like "2 hrs" are resolved against now
+  now = datetime.now()
+  orig_now_fn = facebook.now_fn
+  facebook.now_fn = lambda: now
+
+  mismatches = []
+  try:
+    for name, fn, pages in _scrapers():
+      for i, html in enumerate(pages):
+        if fn(_full_parse(html)) != fn(html):
+          mismatches.append(f'{name}: page {i} output differs from full parse')
+  finally:
+    facebook.now_fn = orig_now_fn
+
+  return mismatches
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+  """Compares benchmark results against a baseline.
+
+  Args:
+    results: dict mapping string benchmark name to result dict, as returned by
+      :meth:`Benchmark.run`
+    baseline: dict, same format
+    threshold: float, fractional slowdown or memory increase that counts as
+      a regression
+
+  Returns:
+    list of string descriptions of regressions, empty if there are none
+  """
+  regressions = []
+  for name, result in results.items():
+    base = baseline.get(name)
+    if not base:
+      continue
+
+    speed = result['ops_per_sec'] / base['ops_per_sec']
+    if speed < 1 - threshold:
+      regressions.append(f'{name}: {(1 - speed) * 100:.1f}% slower')
+
+    if base['peak_kb'] and result['peak_kb'] / base['peak_kb'] > 1 + threshold:
+      growth = result['peak_kb'] / base['peak_kb'] - 1
+      regressions.append(f'{name}: {growth * 100:.1f}% more peak memory')
+
+  return regressions
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+    prog='python -m granary.bench',
+    description="Benchmarks granary's format conversions.")
+  parser.add_argument(
+    '--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+    help='comma-separated synthetic feed sizes, in items (default %(default)s)')
+  parser.add_argument(
+    '--filter', help='only run benchmarks whose names match this regexp')
+  parser.add_argument(
+    '--min-time', type=float, default=DEFAULT_MIN_TIME,
+    help='minimum seconds to run each benchmark (default %(default)s)')
+  parser.add_argument('--save', help='write results to this JSON file')
+  parser.add_argument('--compare', help='compare against results in this JSON file')
+  parser.add_argument(
+    '--threshold', type=float, default=DEFAULT_THRESHOLD,
+    help='fractional slowdown or memory growth that counts as a regression '
+         '(default %(default)s)')
+  args = parser.parse_args(argv)
+
+  benchmarks = object_benchmarks() + scrape_benchmarks()
+  for size in args.sizes.split(','):
+    if size.strip():
+      benchmarks.extend(feed_benchmarks(int(size)))
+  if args.filter:
+    benchmarks = [b for b in benchmarks if re.search(args.filter, b.name)]
+
+  baseline = {}
+  if args.compare:
+    with open(args.compare, encoding='utf-8') as f:
+      baseline = json_loads(f.read())['results']
+
+  print(f'{"benchmark":<55} {"ops/s":>10} {"items/s":>12} {"peak KB":>10} {"vs base":>8}')
+  results = {}
+  errors = []
+  for b in benchmarks:
+    # a converter that raises on its input shouldn't stop the other benchmarks
+    try:
+      result = results[b.name] = b.run(min_time=args.min_time)
+    except Exception as e:
+      errors.append(f'{b.name}: {e.__class__.__name__}: {e}')
+      print(f'{b.name:<55} {"error":>10}')
+      continue
+    base = baseline.get(b.name)
+    change = (f'{(result["ops_per_sec"] / base["ops_per_sec"] - 1) * 100:+.0f}%'
+              if base else '')
+    print(f'{b.name:<55} {result["ops_per_sec"]:>10.1f} '
+          f'{result["items_per_sec"]:>12.1f} {result["peak_kb"]:>10.1f} {change:>8}')
+
+  status = 0
+  if errors:
+    print('\nErrors:')
+    for error in errors:
+      print(f'  {error}')
+    status = 1
+
+  if any(b.name.startswith('scrape/') for b in benchmarks):
+    mismatches = check_scrapers()
+    if mismatches:
+      print('\nScraper output mismatches:')
+      for mismatch in mismatches:
+        print(f'  {mismatch}')
+      status = 1
+
+  if args.save:
+    with open(args.save, 'w', encoding='utf-8') as f:
+      f.write(json_dumps({'results': results}, indent=2, sort_keys=True))
+
+  if args.compare:
+    regressions = compare(results, baseline, threshold=args.threshold)
+    if regressions:
+      print('\nRegressions:')
+      for regression in regressions:
+        print(f'  {regression}')
+      return 1
+    print('\nNo regressions.')
+
+  return status
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,251 @@
+"""Pluggable caches for :class:`source.Source` and the silos."""
+import collections.abc
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import cachetools
+from oauth_dropins.webutil.util import json_dumps, json_loads
+
+
+class Cache(collections.abc.MutableMapping):
+  """Base class for caches to pass as the cache kwarg of
+  :meth:`source.Source.get_activities_response`, or to set as
+  :attr:`source.Source.cache`.
+
+  Caches are dict-like, so silos use them the same way as a plain dict. Keys
+  are strings, values are JSON-serializable. Subclasses implement
+  :meth:`_get`, :meth:`__setitem__`, :meth:`__delitem__`, :meth:`__iter__`,
+  and :meth:`__len__`.
+
+  Attributes:
+    hits: int, number of lookups that found a value
+    misses: int, number of lookups that didn't
+  """
+  def __init__(self):
+    self.hits = self.misses = 0
+    self._stats_lock = threading.Lock()
+
+  def _get(self, key):
+    """Returns the value for key. Raises :class:`KeyError` if it's not cached."""
+    raise NotImplementedError()
+
+  def __getitem__(self, key):
+    try:
+      val = self._get(key)
+    except KeyError:
+      with self._stats_lock:
+        self.misses += 1
+      raise
+
+    with self._stats_lock:
+      self.hits += 1
+    return val
+
+  def stats(self):
+    """Returns a dict with this cache's hits and misses counts."""
+    return {'hits': self.hits, 'misses': self.misses}
+
+
+class MemoryCache(Cache):
+  """In-memory cache with LRU eviction and an optional TTL. Thread safe.
+
+  Attributes:
+    maxsize: int, max number of values to store
+    ttl: int, optional, seconds before values expire
+  """
+  def __init__(self, maxsize=10000, ttl=None):
+    super().__init__()
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self._cache = (cachetools.TTLCache(maxsize, ttl) if ttl
+                   else cachetools.LRUCache(maxsize))
+    self._lock = threading.RLock()
+
+  def _get(self, key):
+    with self._lock:
+      return self._cache[key]
+
+  def __setitem__(self, key, value):
+    with self._lock:
+      self._cache[key] = value
+
+  def __delitem__(self, key):
+    with self._lock:
+      del self._cache[key]
+
+  def __iter__(self):
+    with self._lock:
+      return iter(list(self._cache))
+
+  def __len__(self):
+    with self._lock:
+      return len(self._cache)
+
+
+class SqliteCache(Cache):
+  """Cache stored in a SQLite database, with LRU eviction and an optional TTL.
+
+  Persists across processes when given a file path. Thread safe. Values are
+  stored as JSON.
+
+  Expired rows are purged at most once per TTL. Least recently used rows are
+  only evicted once this instance's count of rows goes over maxsize, so when
+  multiple processes share a database file, it may temporarily hold more than
+  maxsize rows.
+
+  Attributes:
+    maxsize: int, optional, max number of values to store
+    ttl: int, optional, seconds before values expire
+  """
+  TABLE = 'granary_cache'
+
+  def __init__(self, path=':memory:', maxsize=None, ttl=None):
+    """Constructor.
+
+    Args:
+      path: string, SQLite database filename. Defaults to an in-memory database.
+      maxsize: int, optional, max number of values to store
+      ttl: int, optional, seconds before values expire
+    """
+    super().__init__()
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self._lock = threading.RLock()
+    self._conn = sqlite3.connect(path, check_same_thread=False,
+                                 isolation_level=None)
+    self._conn.execute(f"""
+      CREATE TABLE IF NOT EXISTS {self.TABLE} (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        expires REAL,
+        accessed REAL NOT NULL)""")
+    self._conn.execute(f"""
+      CREATE INDEX IF NOT EXISTS {self.TABLE}_accessed
+      ON {self.TABLE} (accessed)""")
+    self._size = None
+    self._next_purge = time.time() + ttl if ttl else None
+
+  def _execute(self, sql, *args):
+    with self._lock:
+      return self._conn.execute(sql.format(table=self.TABLE), args).fetchall()
+
+  def _get(self, key):
+    now = time.time()
+    rows = self._execute(
+      'SELECT value FROM {table} WHERE key = ? AND (expires IS NULL OR expires > ?)',
+      key, now)
+    if not rows:
+      raise KeyError(key)
+
+    self._execute('UPDATE {table} SET accessed = ? WHERE key = ?', now, key)
+    return json_loads(rows[0][0])
+
+  def __setitem__(self, key, value):
+    now = time.time()
+    with self._lock:
+      new = not self._execute('SELECT 1 FROM {table} WHERE key = ?', key)
+      self._execute(
+        'INSERT OR REPLACE INTO {table} (key, value, expires, accessed) VALUES (?, ?, ?, ?)',
+        key, json_dumps(value), now + self.ttl if self.ttl else None, now)
+
+      if self._next_purge and now >= self._next_purge:
+        self._purge(now)
+      elif self._size is not None and new:
+        self._size += 1
+
+      if self.maxsize:
+        if self._size is None:
+          self._size = self._count()
+        if self._size > self.maxsize:
+          self._evict(now)
+
+  def _count(self):
+    return self._execute('SELECT COUNT(*) FROM {table}')[0][0]
+
+  def _purge(self, now):
+    """Deletes expired rows and recounts the rest."""
+    self._execute('DELETE FROM {table} WHERE expires <= ?', now)
+    self._size = self._count()
+    if self.ttl:
+      self._next_purge = now + self.ttl
+
+  def _evict(self, now):
+    """Deletes expired rows, then least recently used rows over maxsize."""
+    self._purge(now)
+    if self._size > self.maxsize:
+      self._execute("""
+        DELETE FROM {table} WHERE key IN (
+          SELECT key FROM {table} ORDER BY accessed LIMIT ?)""",
+        self._size - self.maxsize)
+      self._size = self.maxsize
+
+  def __delitem__(self, key):
+    with self._lock:
+      if not self._execute('SELECT 1 FROM {table} WHERE key = ?', key):
+        raise KeyError(key)
+      self._execute('DELETE FROM {table} WHERE key = ?', key)
+      if self._size is not None:
+        self._size -= 1
+
+  def _live_keys(self):
+    return [row[0] for row in self._execute(
+      'SELECT key FROM {table} WHERE expires IS NULL OR expires > ?', time.time())]
+
+  def __iter__(self):
+    return iter(self._live_keys())
+
+  def __len__(self):
+    return len(self._live_keys())
+
+  def close(self):
+    self._conn.close()
+
+
+class MemcacheCache(Cache):
+  """Cache stored in memcached, or anything with a memcached-compatible client.
+
+  The client must have ``get(key)`` that returns None on a miss,
+  ``set(key, value, expire)``, and ``delete(key)`` methods, eg
+  :class:`pymemcache.client.base.Client` or :class:`memcache.Client`. Values
+  are stored as JSON strings. Eviction is up to the server, so this doesn't
+  support iteration or len().
+
+  Attributes:
+    client: memcached client
+    ttl: int, optional, seconds before values expire
+    prefix: string, prepended to all keys
+  """
+  def __init__(self, client, ttl=None, prefix='granary:'):
+    super().__init__()
+    self.client = client
+    self.ttl = ttl
+    self.prefix = prefix
+
+  def _key(self, key):
+    # memcached keys can't contain whitespace or control characters
+    return self.prefix + urllib.parse.quote(key, safe='')
+
+  def _get(self, key):
+    val = self.client.get(self._key(key))
+    if val is None:
+      raise KeyError(key)
+    if isinstance(val, bytes):
+      val = val.decode()
+    return json_loads(val)
+
+  def __setitem__(self, key, value):
+    self.client.set(self._key(key), json_dumps(value), self.ttl or 0)
+
+  def __delitem__(self, key):
+    self.client.delete(self._key(key))
+
+  def __bool__(self):
+    return True
+
+  def __iter__(self):
+    raise NotImplementedError("memcached doesn't support iterating over keys")
+
+  def __len__(self):
+    raise NotImplementedError("memcached doesn't support counting keys")
@@ -6,11 +6,13 @@ https://developers.facebook.com/docs/graph-api/using-graph-api/
 import collections
 import copy
 from datetime import datetime
+import hashlib
 import html
 import logging
 import re
 import urllib.error, urllib.parse, urllib.request
 
+from bs4 import SoupStrainer
 from bs4.element import NavigableString, Tag
 import dateutil.parser
 import mf2util
@@ -19,6 +21,8 @@ from oauth_dropins.webutil import util
 from oauth_dropins.webutil.util import json_dumps, json_loads
 
 from . import as1
+from . import httputil
+from . import ratelimits
 from . import source
 
 logger = logging.getLogger(__name__)
@@ -87,10 +91,14 @@ API_NOTIFICATION = '%s/notifications'
 API_UPLOAD_VIDEO = 'https://graph-video.facebook.com/v4.0/me/videos'
 
 MAX_IDS = 50  # for the ids query param
+MAX_BATCH = 50  # max requests per batch API call
 
 M_HTML_BASE_URL = 'https://mbasic.facebook.com/'
 M_HTML_TIMELINE_URL = '%s?v=timeline'
 M_HTML_REACTIONS_URL = 'ufi/reaction/profile/browser/?ft_ent_identifier=%s'
+# only parse the reaction list items on mbasic reactions pages. (targeted
+# parses of timeline and post pages benchmarked no faster than full parses.)
+M_HTML_REACTIONS_STRAINER = SoupStrainer('li')
 
 # Use a modern browser user agent so that we get modern HTML tags like article
 # and footer, which we then use to scrape.
@@ -198,7 +206,8 @@ class Facebook(source.Source):
   """
 
   def __init__(self, access_token=None, user_id=None, scrape=False,
-               cookie_c_user=None, cookie_xs=None):
+               cookie_c_user=None, cookie_xs=None, session=None, max_workers=1,
+               scrape_cache=None):
     """Constructor.
 
     If an OAuth access token is provided, it will be passed on to Facebook. This
@@ -214,7 +223,18 @@ class Facebook(source.Source):
         use the API (False)
       cookie_c_user: string, optional c_user cookie to use when scraping
       cookie_xs: string, optional xs cookie to use when scraping
+      session: :class:`requests.Session`, optional, passed through to
+        :meth:`Source.__init__`
+      max_workers: int, optional, max number of post permalink and reactions
+        pages to fetch concurrently when scraping. Defaults to 1, ie serially.
+        If more than 1, scraping and session isn't provided, scraping requests
+        share a new :class:`httputil.PooledSession`.
+      scrape_cache: :class:`caches.Cache` or dict, optional, caches parsed
+        permalink and reactions pages when scraping, keyed by post id and a
+        fingerprint of the post's content and comment and reaction counts on
+        the timeline. Unchanged posts aren't refetched on the next poll.
     """
+    super().__init__(session=session, pool_size=max_workers if scrape else None)
     if scrape:
       assert cookie_c_user and cookie_xs
     self.access_token = access_token
@@ -222,6 +242,8 @@ class Facebook(source.Source):
     self.scrape = scrape
     self.cookie_c_user = cookie_c_user
     self.cookie_xs = cookie_xs
+    self.max_workers = max_workers
+    self.scrape_cache = scrape_cache
 
   def object_url(self, id):
     # Facebook always uses www. They redirect bare facebook.com URLs to it.
@@ -301,27 +323,52 @@ class Facebook(source.Source):
       if count:
         url = util.add_query_params(url, {'limit': count})
       headers = {'If-None-Match': etag} if etag else {}
-      try:
-        resp = self.urlopen(url, headers=headers, _as=None)
-        etag = resp.info().get('ETag')
-        posts = self._as(list, source.load_json(resp.read(), url))
-      except urllib.error.HTTPError as e:
-        if e.code == 304:  # Not Modified, from a matching ETag
-          posts = []
-        else:
-          raise
 
       if group_id == source.SELF:
-        # TODO: save and use ETag for all of these extra calls
-        # TODO: use batch API to get photos, events, etc in one request
-        # https://developers.facebook.com/docs/graph-api/making-multiple-requests
+        # fetch the feed and all of the extra calls in one batch request. if
+        # self.validators is set, urlopen_batch_full makes the extra calls
+        # conditional and replays their bodies when they're unchanged.
         # https://github.com/snarfed/bridgy/issues/44
+        extra_urls = [API_PHOTOS_UPLOADED % user_id, API_ALBUMS % user_id]
         if fetch_news:
-          posts.extend(self.urlopen(API_NEWS_PUBLISHES % user_id, _as=list))
-        posts = self._merge_photos(posts, user_id)
+          extra_urls.append(API_NEWS_PUBLISHES % user_id)
         if fetch_events:
-          activities.extend(self._get_events(owner_id=event_owner_id))
+          extra_urls.append(API_USER_EVENTS)
+
+        feed_req = {'relative_url': url}
+        if headers:
+          feed_req['headers'] = headers
+        resps = self.urlopen_batch_full(
+          [feed_req] + [{'relative_url': extra} for extra in extra_urls])
+        feed = resps[0]
+        extras = [self._batch_body(extra, resp, _as=list)
+                  for extra, resp in zip(extra_urls, resps[1:])]
+
+        etag = feed.get('headers', {}).get('ETag')
+        if int(feed.get('code', 0)) == 304:  # Not Modified, from a matching ETag
+          posts = []
+        else:
+          posts = self._batch_body(url, feed, _as=list)
+
+        photos, albums = extras[:2]
+        if fetch_news:
+          posts.extend(extras[2])
+        posts = self._merge_photos(posts, user_id, photos=photos, albums=albums)
+        if fetch_events:
+          activities.extend(self._get_events(owner_id=event_owner_id,
+                                             events=extras[-1]))
+
       else:
+        try:
+          resp = self.urlopen(url, headers=headers, _as=None)
+          etag = resp.info().get('ETag')
+          posts = self._as(list, source.load_json(resp.read(), url))
+        except urllib.error.HTTPError as e:
+          if e.code == 304:  # Not Modified, from a matching ETag
+            posts = []
+          else:
+            raise
+
         # for group feeds, filter out some shared_story posts because they tend
         # to be very tangential - friends' likes, related posts, etc.
         #
@@ -349,35 +396,41 @@ class Facebook(source.Source):
     # don't fetch extras for Facebook notes. if you pass /comments a note id, it
     # 400s with "notes API is deprecated for versions ..."
     # https://github.com/snarfed/bridgy/issues/480
-    if fetch_shares and fetch_shares_ids:
-      # some sharedposts requests 400, not sure why.
-      # https://github.com/snarfed/bridgy/issues/348
-      with util.ignore_http_4xx_error():
-        for id, shares in self._split_id_requests(API_SHARES, fetch_shares_ids).items():
-          activity = id_to_activity.get(id)
-          if activity:
-            activity['object'].setdefault('tags', []).extend(
-              [self.share_to_object(share) for share in shares])
-
-    if fetch_replies and fetch_comments_ids:
-      # some comments requests 400, not sure why.
-      with util.ignore_http_4xx_error():
-        for id, comments in self._split_id_requests(API_COMMENTS_ALL,
-                                                    fetch_comments_ids).items():
-          activity = id_to_activity.get(id)
-          if activity:
-            replies = activity['object'].setdefault('replies', {}
-                                       ).setdefault('items', [])
-            existing_ids = {reply['fb_id'] for reply in replies}
-            for comment in comments:
-              if comment['id'] not in existing_ids:
-                replies.append(self.comment_to_object(comment))
+    #
+    # shares and comments are fetched together, in one batch request if
+    # possible.
+    if not fetch_shares:
+      fetch_shares_ids = []
+    if not fetch_replies:
+      fetch_comments_ids = []
+    if ((fetch_shares_ids or fetch_comments_ids) and
+        ratelimits.rate_limits.remaining(self._rate_limit_key()) == 0):
+      logger.warning('Facebook rate limit exhausted; skipping shares and comments. Results will be incomplete!')
+      fetch_shares_ids = fetch_comments_ids = []
+    all_shares, all_comments = self._split_id_requests(
+      [(API_SHARES, fetch_shares_ids), (API_COMMENTS_ALL, fetch_comments_ids)])
+
+    for id, shares in all_shares.items():
+      activity = id_to_activity.get(id)
+      if activity:
+        activity['object'].setdefault('tags', []).extend(
+          [self.share_to_object(share) for share in shares])
+
+    for id, comments in all_comments.items():
+      activity = id_to_activity.get(id)
+      if activity:
+        replies = activity['object'].setdefault('replies', {}
+                                   ).setdefault('items', [])
+        existing_ids = {reply['fb_id'] for reply in replies}
+        for comment in comments:
+          if comment['id'] not in existing_ids:
+            replies.append(self.comment_to_object(comment))
 
     response = self.make_activities_base_response(util.trim_nulls(activities))
     response['etag'] = etag
     return response
 
-  def _merge_photos(self, posts, user_id):
+  def _merge_photos(self, posts, user_id, photos=None, albums=None):
     """Fetches and merges photo objects into posts, replacing matching posts.
 
     Have to fetch uploaded photos manually since facebook sometimes collapses
@@ -395,12 +448,22 @@ class Facebook(source.Source):
     Args:
       posts: list of Facebook post object dicts
       user_id: string Facebook user id
+      photos: list of Facebook photo object dicts from
+        :const:`API_PHOTOS_UPLOADED`, optional
+      albums: list of Facebook album object dicts from :const:`API_ALBUMS`,
+        optional. If photos and albums aren't both provided, they're fetched
+        in a single batch request.
 
     Returns:
       new list of post and photo object dicts
     """
     assert user_id
 
+    if photos is None or albums is None:
+      photos, albums = [self._as(list, body) for body in self.urlopen_batch(
+        (API_PHOTOS_UPLOADED % user_id, API_ALBUMS % user_id))]
+    albums = {a.get('id'): a for a in albums}
+
     posts_by_obj_id = {}
     for post in posts:
       obj_id = post.get('object_id')
@@ -410,9 +473,6 @@ class Facebook(source.Source):
           logger.warning(f"merging posts for object_id {obj_id}: overwriting {existing.get('id')} with {post.get('id')}!")
         posts_by_obj_id[obj_id] = post
 
-    albums = None  # lazy loaded, maps facebook id to ActivityStreams object
-
-    photos = self.urlopen(API_PHOTOS_UPLOADED % user_id, _as=list)
     for photo in photos:
       album_id = photo.get('album', {}).get('id')
       post = posts_by_obj_id.pop(photo.get('id'), {})
@@ -423,8 +483,6 @@ class Facebook(source.Source):
       if privacy and privacy.get('value') != 'CUSTOM':
         photo['privacy'] = privacy
       elif album_id:
-        if albums is None:
-          albums = {a['id']: a for a in self.urlopen(API_ALBUMS % user_id, _as=list)}
         photo['privacy'] = albums.get(album_id, {}).get('privacy')
       else:
         photo['privacy'] = 'custom'  # ie unknown
@@ -432,28 +490,42 @@ class Facebook(source.Source):
     return ([p for p in posts if not p.get('object_id')] +
             list(posts_by_obj_id.values()) + photos)
 
-  def _split_id_requests(self, api_call, ids):
-    """Splits an API call into multiple to stay under the MAX_IDS limit per call.
+  def _split_id_requests(self, calls):
+    """Splits API calls into multiple to stay under the MAX_IDS limit per call.
+
+    The resulting calls are all sent together, via the batch API if there's
+    more than one. 4xx responses are ignored, since some sharedposts and
+    comments calls 400 for unknown reasons.
+    https://github.com/snarfed/bridgy/issues/348
 
     https://developers.facebook.com/docs/graph-api/using-graph-api#multiidlookup
 
     Args:
-      api_call: string with %s placeholder for ids query param
-      ids: sequence of string ids
+      calls: sequence of (string API call with %s placeholder for ids query
+        param, sequence of string ids) tuples
 
     Returns:
-      merged list of objects from the responses' 'data' fields
+      list of dicts, one per call, mapping id to merged list of objects from
+      the responses' 'data' fields
     """
-    results = {}
-    for i in range(0, len(ids), MAX_IDS):
-      resp = self.urlopen(api_call % ','.join(ids[i:i + MAX_IDS]))
-      for id, objs in resp.items():
+    urls = []  # (index into calls, string url) tuples
+    for i, (api_call, ids) in enumerate(calls):
+      for j in range(0, len(ids), MAX_IDS):
+        urls.append((i, api_call % ','.join(ids[j:j + MAX_IDS])))
+
+    results = [{} for _ in calls]
+    resps = self._urlopen_multi([{'relative_url': url} for _, url in urls])
+    for (i, url), resp in zip(urls, resps):
+      if int(resp.get('code', 0)) // 100 == 4:
+        logger.info(f"Ignoring {resp.get('code')} for {url}: {resp.get('body')}")
+        continue
+      for id, objs in self._batch_body(url, resp).items():
         # objs is usually a dict but sometimes a boolean. (oh FB, never change!)
-        results.setdefault(id, []).extend(self._as(dict, objs).get('data', []))
+        results[i].setdefault(id, []).extend(self._as(dict, objs).get('data', []))
 
     return results
 
-  def _get_events(self, owner_id=None):
+  def _get_events(self, owner_id=None, events=None):
     """Fetches the current user's events.
 
     https://developers.facebook.com/docs/graph-api/reference/user/events/
@@ -463,11 +535,14 @@ class Facebook(source.Source):
 
     Args:
       owner_id: string. if provided, only returns events owned by this user
+      events: list of Facebook event dicts from :const:`API_USER_EVENTS`,
+        optional. If not provided, they're fetched.
 
     Returns:
       list of ActivityStreams event objects
     """
-    events = self.urlopen(API_USER_EVENTS, _as=list)
+    if events is None:
+      events = self.urlopen(API_USER_EVENTS, _as=list)
     return [self.event_to_activity(event) for event in events
             if not owner_id or owner_id == event.get('owner', {}).get('id')]
 
@@ -1618,9 +1693,9 @@ class Facebook(source.Source):
     Returns: dict, AS1 object, or None if email html couldn't be parsed
 
     Arguments:
-      html: string
+      html: string or :class:`bs4.BeautifulSoup`
     """
-    soup = util.parse_html(html)
+    soup = source.parse_scraped_html(html)
     type = None
 
     type = 'comment'
@@ -1796,7 +1871,8 @@ class Facebook(source.Source):
     def get(url, *params, allow_redirects=False):
       url = urllib.parse.urljoin(M_HTML_BASE_URL, url % params)
       cookie = f'c_user={self.cookie_c_user}; xs={self.cookie_xs}'
-      resp = util.requests_get(url, allow_redirects=allow_redirects, headers={
+      resp = httputil.requests_fn('get', session=self.session)(
+        url, allow_redirects=allow_redirects, headers={
         'Cookie': cookie,
         'User-Agent': SCRAPE_USER_AGENT,
       })
@@ -1809,38 +1885,93 @@ class Facebook(source.Source):
 
       resp = get(activity_id, allow_redirects=True)
       activities = [self.scraped_to_activity(resp.text, **kwargs)[0]]
+      fingerprints = [self._scraped_fingerprint(a) for a in activities]
     else:
       resp = get(M_HTML_TIMELINE_URL, user_id)
       activities, _ = self.scraped_to_activities(resp.text, **kwargs)
+      fingerprints = [self._scraped_fingerprint(a) for a in activities]
       if fetch_replies:
         # fetch and convert individual post permalinks
-        # TODO: cache?
-        fbids = [a['fb_id'] for a in activities]
-        activities = []
-        for id in fbids:
-          resp = get(id)
-          activities.append(self.scraped_to_activity(resp.text)[0])
+        activities = self._scrape_each(
+          'AFSP', activities, fingerprints,
+          lambda activity: self.scraped_to_activity(get(activity['fb_id']).text)[0])
 
     if fetch_likes:
       # fetch and convert likes
-      # TODO: cache?
-      for activity in activities:
+      def fetch_reactions(activity):
         resp = get(M_HTML_REACTIONS_URL, activity['fb_id'])
-        self.merge_scraped_reactions(resp.text, activity)
+        return self.merge_scraped_reactions(resp.text, copy.deepcopy(activity))
+
+      all_tags = self._scrape_each('AFSR', activities, fingerprints,
+                                   fetch_reactions)
+      for activity, tags in zip(activities, all_tags):
+        as1.merge_by_id(activity['object'], 'tags', tags)
 
     return self.make_activities_base_response(activities)
 
+  def _scrape_each(self, prefix, activities, fingerprints, fn):
+    """Calls a scraping function on each activity, concurrently, with caching.
+
+    Runs up to max_workers at once. Results are cached in scrape_cache, if it's
+    set, keyed by prefix, post id, and fingerprint.
+
+    Args:
+      prefix: string, cache key prefix
+      activities: sequence of AS activities
+      fingerprints: sequence of string fingerprints, one per activity
+      fn: callable that takes an activity and returns a JSON-serializable result
+
+    Returns:
+      list of fn's results, one per activity, in the same order
+    """
+    keys = [f"{prefix} {activity.get('fb_id')} {fingerprint}"
+            for activity, fingerprint in zip(activities, fingerprints)]
+
+    results = [None] * len(activities)
+    if self.scrape_cache is not None:
+      for i, key in enumerate(keys):
+        cached = self.scrape_cache.get(key)
+        if cached is not None:
+          results[i] = copy.deepcopy(cached)
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    fetched = httputil.map_concurrently(
+      fn, [activities[i] for i in missing], max_workers=self.max_workers)
+
+    for i, result in zip(missing, fetched):
+      results[i] = result
+      if self.scrape_cache is not None:
+        self.scrape_cache[keys[i]] = copy.deepcopy(result)
+
+    return results
+
+  @staticmethod
+  def _scraped_fingerprint(activity):
+    """Returns a short hash of a scraped activity's content and counts.
+
+    Omits the published time, since it's often relative, eg "22 hrs".
+
+    Args:
+      activity: AS activity
+
+    Returns: string
+    """
+    obj = activity.get('object') or {}
+    fields = {field: obj.get(field) for field in
+              ('content', 'attachments', 'replies', 'fb_reaction_count', 'tags')}
+    return hashlib.sha256(json_dumps(fields, sort_keys=True).encode()).hexdigest()[:16]
+
   def scraped_to_activities(self, scraped, log_html=False, **kwargs):
     """Converts HTML from an mbasic.facebook.com timeline to AS1 activities.
 
     Args:
-      scraped: str, HTML
+      scraped: str HTML or :class:`bs4.BeautifulSoup`
       log_html: boolean
       kwargs: unused
 
     Returns: tuple: ([AS activities], AS logged in actor (ie viewer))
     """
-    soup = util.parse_html(scraped)
+    soup = source.parse_scraped_html(scraped)
     if log_html:
       logging.info(soup.prettify())
 
@@ -1969,13 +2100,14 @@ class Facebook(source.Source):
     """Converts HTML from an mbasic.facebook.com post page to an AS1 activity.
 
     Args:
-      scraped: str, HTML from an mbasic.facebook.com post permalink
+      scraped: str HTML or :class:`bs4.BeautifulSoup` from an
+        mbasic.facebook.com post permalink
       log_html: boolean
       kwargs: unused
 
     Returns: tuple: (dict AS activity or None, AS logged in actor (ie viewer))
     """
-    soup = util.parse_html(scraped)
+    soup = source.parse_scraped_html(scraped)
     if log_html:
       logging.info(soup.prettify())
 
@@ -2133,13 +2265,14 @@ class Facebook(source.Source):
     Existing likes and emoji reactions in 'tags' are ignored.
 
     Args:
-      scraped: str, HTML from an mbasic.facebook.com/ufi/reaction/profile/browser/ page
+      scraped: str HTML or :class:`bs4.BeautifulSoup` from an
+        mbasic.facebook.com/ufi/reaction/profile/browser/ page
       activity: dict, AS activity to merge these reactions into
 
     Returns:
       list of dict AS like/react tag objects converted from scraped
     """
-    soup = util.parse_html(scraped)
+    soup = source.parse_scraped_html(scraped, parse_only=M_HTML_REACTIONS_STRAINER)
 
     tags = []
     for reaction in soup.find_all('li'):
@@ -2176,11 +2309,13 @@ class Facebook(source.Source):
     """Converts HTML from an mbasic.facebook.com profile about page to an AS1 actor.
 
     Args:
-      scraped: str, HTML from an mbasic.facebook.com post permalink
+      scraped: str HTML or :class:`bs4.BeautifulSoup` from an
+        mbasic.facebook.com profile about page
 
     Returns: dict, AS1 actor
     """
-    soup = util.parse_html(scraped)
+    # not strained, since this uses the title and images outside #root
+    soup = source.parse_scraped_html(scraped)
     root = soup.find(id='root')
     if not root:
       return None
@@ -2558,20 +2693,49 @@ class Facebook(source.Source):
     """
     if not url.startswith('http'):
       url = API_BASE + url
+
+    # conditional GET, if we have validators. key on the URL without the token.
+    validator_url = url
+    stored = None
+    if _as is not None and 'data' not in kwargs:
+      kwargs['headers'], stored = self._conditional_headers(
+        url, self.access_token, kwargs.get('headers'))
+
     if self.access_token:
       url = util.add_query_params(url, [('access_token', self.access_token)])
-    resp = util.urlopen(urllib.request.Request(url, **kwargs))
+    try:
+      resp = httputil.urlopen(urllib.request.Request(url, **kwargs),
+                            session=self.session)
+    except urllib.error.HTTPError as e:
+      ratelimits.rate_limits.update(self._rate_limit_key(), e.headers, status=e.code)
+      if e.code == 304 and stored is not None:
+        return self._as(_as, source.load_json(stored, url))
+      raise
+    ratelimits.rate_limits.update(self._rate_limit_key(),
+                              getattr(resp, 'headers', None))
 
     if _as is None:
       return resp
 
     body = resp.read()
+    if 'data' not in kwargs:
+      self._store_validators(validator_url, self.access_token,
+                             getattr(resp, 'headers', None), body)
     try:
       return self._as(_as, source.load_json(body, url))
     except ValueError:  # couldn't parse JSON
       logger.debug(f'Response: {resp.getcode()} {body}')
       raise
 
+  def _rate_limit_key(self):
+    """Returns the :class:`ratelimits.RateLimits` key for this access token.
+
+    Facebook reports usage as percentages of the app's or page's limit in the
+    X-App-Usage and X-Business-Use-Case-Usage headers.
+    https://developers.facebook.com/docs/graph-api/overview/rate-limiting/
+    """
+    return ratelimits.rate_limit_key(self.NAME, self.access_token)
+
   @staticmethod
   def _as(type, resp):
     """Converts an API response to a specific type.
@@ -2616,15 +2780,8 @@ class Facebook(source.Source):
     """
     resps = self.urlopen_batch_full([{'relative_url': url} for url in urls])
 
-    bodies = []
-    for url, resp in zip(urls, resps):
-      code = int(resp.get('code', 0))
-      body = resp.get('body')
-      if code // 100 in (4, 5):
-        raise urllib.error.HTTPError(url, code, body, resp.get('headers'), None)
-      bodies.append(body)
-
-    return bodies
+    return [self._batch_body(url, resp, _as=None)
+            for url, resp in zip(urls, resps)]
 
   def urlopen_batch_full(self, requests):
     """Sends a batch of multiple API calls using Facebook's batch API.
@@ -2633,6 +2790,9 @@ class Facebook(source.Source):
     with headers, HTTP status code, etc. Only raises :class:`urllib2.HTTPError`
     if the outer batch request itself returns an HTTP error.
 
+    Requests are automatically split into multiple batch calls of up to
+    :const:`MAX_BATCH` requests each.
+
     https://developers.facebook.com/docs/graph-api/making-multiple-requests
 
     Args:
@@ -2657,6 +2817,17 @@ class Facebook(source.Source):
            ...
           ]
     """
+    # conditional GETs for the individual calls, if we have validators. maps
+    # index to stored body.
+    stored = {}
+    for i, req in enumerate(requests):
+      if req.get('method', 'GET') == 'GET' and req.get('relative_url'):
+        headers, body = self._conditional_headers(
+          API_BASE + req['relative_url'], self.access_token, req.get('headers'))
+        if body is not None:
+          req['headers'] = headers
+          stored[i] = body
+
     for req in requests:
       if 'method' not in req:
         req['method'] = 'GET'
@@ -2664,13 +2835,24 @@ class Facebook(source.Source):
         req['headers'] = [{'name': n, 'value': v}
                           for n, v in sorted(req['headers'].items())]
 
-    data = 'batch=' + json_dumps(util.trim_nulls(requests), sort_keys=True)
-    resps = self.urlopen('', data=data, _as=list)
+    resps = []
+    for i in range(0, len(requests), MAX_BATCH):
+      batch = util.trim_nulls(requests[i:i + MAX_BATCH])
+      data = 'batch=' + json_dumps(batch, sort_keys=True)
+      resps.extend(self.urlopen('', data=data, _as=list))
 
-    for resp in resps:
+    for i, resp in enumerate(resps):
       if 'headers' in resp:
         resp['headers'] = {h['name']: h['value'] for h in resp['headers']}
 
+      req = requests[i] if i < len(requests) else {}
+      code = util.is_int(resp.get('code')) and int(resp['code'])
+      if code == 304 and i in stored:
+        resp.update({'code': 200, 'body': stored[i]})
+      elif code == 200 and req.get('method') == 'GET' and req.get('relative_url'):
+        self._store_validators(API_BASE + req['relative_url'], self.access_token,
+                               resp.get('headers'), resp.get('body'))
+
       body = resp.get('body')
       if body:
         try:
@@ -2679,3 +2861,56 @@ class Facebook(source.Source):
           pass
 
     return resps
+
+  def _urlopen_multi(self, requests):
+    """Sends API requests in as few round trips as possible.
+
+    A single request is sent on its own with :meth:`urlopen`. Multiple requests
+    are sent together with :meth:`urlopen_batch_full`.
+
+    Args:
+      requests: sequence of dict requests, same as :meth:`urlopen_batch_full`
+
+    Returns:
+      sequence of dict responses, same as :meth:`urlopen_batch_full`
+    """
+    if len(requests) != 1:
+      return self.urlopen_batch_full(requests) if requests else []
+
+    req = requests[0]
+    try:
+      resp = self.urlopen(req['relative_url'], headers=req.get('headers') or {},
+                          _as=None)
+      code, headers, body = resp.getcode(), resp.info(), resp.read()
+    except urllib.error.HTTPError as e:
+      headers = e.headers
+      code, body = util.interpret_http_exception(e)
+
+    if isinstance(body, bytes):
+      body = body.decode()
+    try:
+      body = json_loads(body)
+    except (ValueError, TypeError):
+      pass
+
+    return [{'code': int(code), 'headers': dict(headers or {}), 'body': body}]
+
+  @classmethod
+  def _batch_body(cls, url, resp, _as=dict):
+    """Returns the body of a single response from the batch API.
+
+    Args:
+      url: string, the request's relative URL
+      resp: dict response from :meth:`urlopen_batch_full`
+      _as: list, dict, or None. If not None, passes the body through
+        :meth:`_as` with this type.
+
+    Raises:
+      :class:`urllib.error.HTTPError` if the response's status code is 4xx or
+      5xx
+    """
+    code = int(resp.get('code', 0))
+    body = resp.get('body')
+    if code // 100 in (4, 5):
+      raise urllib.error.HTTPError(url, code, body, resp.get('headers'), None)
+    return body if _as is None else cls._as(_as, body)
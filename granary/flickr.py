@@ -3,12 +3,11 @@
 
 Uses Flickr's REST API https://www.flickr.com/services/api/
 
-TODO: Fetching feeds with comments and/or favorites is very request
-intensive right now. It would be ideal to find a way to batch
-requests, make requests asynchronously, or make better calls to the
-API itself. Maybe use flickr.activity.userPhotos
-(https://www.flickr.com/services/api/flickr.activity.userPhotos.html)
-when group_id=SELF.
+Fetching feeds with comments and/or favorites takes two API calls per photo.
+For group_id=SELF, get_activities can instead use flickr.activity.userPhotos
+(https://www.flickr.com/services/api/flickr.activity.userPhotos.html) to fetch
+recent comments and favorites for all photos at once. Otherwise, the per-photo
+calls can be made in parallel.
 """
 import copy
 import logging
@@ -20,10 +19,16 @@ from oauth_dropins.webutil import util
 from oauth_dropins import flickr_auth
 
 from . import as1
+from . import httputil
 from . import source
 
 logger = logging.getLogger(__name__)
 
+# flickr.activity.userPhotos params. per_page is the API's max.
+ACTIVITY_TIMEFRAME = '30d'
+ACTIVITY_PER_PAGE = 50
+ACTIVITY_MAX_PAGES = 10
+
 
 class Flickr(source.Source):
   """Flickr source class. See file docstring and Source class for details."""
@@ -38,7 +43,7 @@ class Flickr(source.Source):
                          'path_alias'))
 
   def __init__(self, access_token_key, access_token_secret,
-               user_id=None, path_alias=None):
+               user_id=None, path_alias=None, max_workers=1):
     """Constructor.
 
     If they are not provided, user_id and path_alias will be looked up via the
@@ -50,11 +55,15 @@ class Flickr(source.Source):
       user_id: string, the logged in user's Flickr nsid. (optional)
       path_alias: string, the logged in user's path_alias, replaces user_id in
         canonical profile and photo urls (optional)
+      max_workers: int, optional, max number of concurrent API calls to make
+        when fetching comments and favorites for multiple photos. Defaults to 1,
+        ie serial.
     """
     self.access_token_key = access_token_key
     self.access_token_secret = access_token_secret
     self._user_id = user_id
     self._path_alias = path_alias
+    self.max_workers = max_workers
 
   def call_api_method(self, method, params=None):
     """Call a Flickr API method.
@@ -377,13 +386,21 @@ class Flickr(source.Source):
                               etag=None, min_id=None, cache=None,
                               fetch_replies=False, fetch_likes=False,
                               fetch_shares=False, fetch_events=False,
-                              fetch_mentions=False, search_query=None, **kwargs):
+                              fetch_mentions=False, search_query=None,
+                              use_activity_api=False, **kwargs):
     """Fetches Flickr photos and converts them to ActivityStreams activities.
 
     See method docstring in source.py for details.
 
     Mentions are not fetched or included because they don't exist in Flickr.
     https://github.com/snarfed/bridgy/issues/523#issuecomment-155523875
+
+    By default, comments and favorites are fetched with two API calls per
+    photo, up to the constructor's max_workers at once. If use_activity_api is
+    True and group_id is @self for the logged in user, they're instead fetched
+    for all photos at once with flickr.activity.userPhotos. That only includes
+    activity from the last :const:`ACTIVITY_TIMEFRAME`, up to
+    :const:`ACTIVITY_MAX_PAGES` pages.
     """
     if user_id is None:
       user_id = 'me'
@@ -418,36 +435,113 @@ class Flickr(source.Source):
     else:
       photos = photos_resp.get('photos', {}).get('photo', [])
 
-    for photo in photos:
-      activity = self.photo_to_activity(photo)
+    activities = [self.photo_to_activity(photo) for photo in photos]
+
+    if (fetch_replies or fetch_likes) and photos:
+      if (use_activity_api and group_id == source.SELF and not activity_id and
+          user_id in ('me', self._user_id)):
+        extras = self._user_photos_extras()
+        fetched = [extras.get(photo.get('id'), ([], [])) for photo in photos]
+      else:
+        fetched = httputil.map_concurrently(
+          lambda photo: self._fetch_photo_extras(
+            photo.get('id'), fetch_replies=fetch_replies, fetch_likes=fetch_likes),
+          photos, max_workers=self.max_workers)
+
+      for photo, activity, (comments, faves) in zip(photos, activities, fetched):
+        if fetch_replies:
+          replies = [self.comment_to_object(comment, photo.get('id'))
+                     for comment in comments]
+          activity['object']['replies'] = {
+            'items': replies,
+            'totalItems': len(replies),
+          }
+        if fetch_likes:
+          for person in faves:
+            activity['object'].setdefault('tags', []).append(
+              self.like_to_object(person, activity))
+
+    result['items'] = activities
+    return util.trim_nulls(result)
+
+  def _fetch_photo_extras(self, photo_id, fetch_replies=False,
+                          fetch_likes=False):
+    """Fetches a photo's comments and favorites. Thread safe.
 
-      # TODO consider using 'flickr.activity.userPhotos' when group_id=@self,
-      # gives all recent comments and faves, instead of hitting the API for
-      # each photo
-      if fetch_replies:
-        comments_resp = self.call_api_method('flickr.photos.comments.getList', {
-          'photo_id': photo.get('id'),
-        })
-        replies = [
-            self.comment_to_object(comment, photo.get('id'))
-            for comment in comments_resp.get('comments', {}).get('comment', [])
-        ]
-        activity['object']['replies'] = {
-          'items': replies,
-          'totalItems': len(replies),
-        }
-
-      if fetch_likes:
-        faves_resp = self.call_api_method('flickr.photos.getFavorites', {
-          'photo_id': photo.get('id'),
-        })
-        for person in faves_resp.get('photo', {}).get('person', []):
-          activity['object'].setdefault('tags', []).append(
-            self.like_to_object(person, activity))
+    Args:
+      photo_id: string
+      fetch_replies: boolean
+      fetch_likes: boolean
 
-      result['items'].append(activity)
+    Returns:
+      (list of Flickr comment dicts, list of Flickr person dicts) tuple
+    """
+    comments, faves = [], []
+    if fetch_replies:
+      comments = self.call_api_method('flickr.photos.comments.getList', {
+        'photo_id': photo_id,
+      }).get('comments', {}).get('comment', [])
+    if fetch_likes:
+      faves = self.call_api_method('flickr.photos.getFavorites', {
+        'photo_id': photo_id,
+      }).get('photo', {}).get('person', [])
+    return comments, faves
+
+  def _user_photos_extras(self):
+    """Fetches recent comments and favorites on the logged in user's photos.
+
+    Uses flickr.activity.userPhotos, which returns them for all photos at once,
+    and converts them to the same format as flickr.photos.comments.getList and
+    flickr.photos.getFavorites.
 
-    return util.trim_nulls(result)
+    Returns:
+      dict mapping string photo id to (list of Flickr comment dicts, list of
+      Flickr person dicts) tuple
+    """
+    extras = {}
+
+    page = pages = 1
+    while page <= min(pages, ACTIVITY_MAX_PAGES):
+      resp = self.call_api_method('flickr.activity.userPhotos', {
+        'timeframe': ACTIVITY_TIMEFRAME,
+        'per_page': ACTIVITY_PER_PAGE,
+        'page': page,
+      }).get('items', {})
+      pages = int(resp.get('pages') or 1)
+      page += 1
+
+      for item in resp.get('item', []):
+        if item.get('type') != 'photo':
+          continue
+        comments, faves = extras.setdefault(item.get('id'), ([], []))
+        for event in item.get('activity', {}).get('event', []):
+          user = {
+            'iconserver': event.get('iconserver'),
+            'iconfarm': event.get('iconfarm'),
+            'realname': event.get('realname'),
+          }
+          if event.get('type') == 'comment':
+            # comment permalinks only use the last part of the id
+            commentid = event.get('commentid')
+            comments.append({
+              **user,
+              'id': commentid,
+              'author': event.get('user'),
+              'authorname': event.get('username'),
+              'datecreate': event.get('dateadded'),
+              'permalink': self.photo_url(item.get('owner'), item.get('id')) +
+                           '#comment' + (commentid or '').split('-')[-1],
+              '_content': event.get('_content', ''),
+            })
+          elif event.get('type') == 'fave':
+            faves.append({
+              **user,
+              'nsid': event.get('user'),
+              'username': event.get('username'),
+              'favedate': event.get('dateadded'),
+            })
+
+    return extras
 
   def get_actor(self, user_id=None):
     """Get an ActivityStreams object of type 'person' given a Flickr user's nsid.
@@ -18,6 +18,8 @@ from oauth_dropins.webutil.util import json_dumps, json_loads
 import requests
 
 from . import as1
+from . import httputil
+from . import ratelimits
 from . import source
 
 logger = logging.getLogger(__name__)
@@ -154,6 +156,49 @@ mutation {
   }
 }
 """
+# batched notification hydration. aliases map GraphQL fields to their v3 REST
+# names so that issue_to_object etc. generate the same objects for both.
+GRAPHQL_ACTOR_FIELDS = """
+  ... on Bot {""" + GRAPHQL_BOT_FIELDS + """}
+  ... on Organization {""" + GRAPHQL_ORG_FIELDS + """}
+  ... on User {""" + GRAPHQL_USER_FIELDS + """}
+"""
+GRAPHQL_ISSUE_FIELDS = """
+  id number url title body createdAt updated_at: updatedAt
+  author {""" + GRAPHQL_ACTOR_FIELDS + """}
+  labels(first: 100) {nodes {name}}
+"""
+GRAPHQL_ISSUE_COMMENTS = """
+  comments(last: 100) {
+    nodes {
+      id url body createdAt updated_at: updatedAt
+      author {""" + GRAPHQL_ACTOR_FIELDS + """}
+    }
+  }
+"""
+GRAPHQL_ISSUE_REACTIONS = """
+  reactions(last: 100) {
+    nodes {
+      id content createdAt
+      user {""" + GRAPHQL_USER_FIELDS + """}
+    }
+  }
+"""
+# %(i)s is the subject's index. owner and repo are doubly escaped so that
+# graphql() can quote them.
+GRAPHQL_ISSUE_OR_PR_BATCH_ITEM = """
+  subject%(i)s: repository(owner: "%%(owner%(i)s)s", name: "%%(repo%(i)s)s") {
+    issueOrPullRequest(number: %(number)s) {
+      ... on Issue {%(fields)s}
+      ... on PullRequest {%(fields)s merged baseRefName}
+    }
+  }
+"""
+# max number of notification subjects to hydrate in a single GraphQL query
+GRAPHQL_BATCH_SIZE = 20
+# GraphQL error types for deleted issues/PRs and repos, handled like
+# HTTP_NON_FATAL_CODES
+GRAPHQL_NON_FATAL_ERRORS = ('NOT_FOUND',)
 
 # key is unicode emoji string, value is GraphQL ReactionContent enum value.
 # https://developer.github.com/v4/enum/reactioncontent/
@@ -181,6 +226,8 @@ REACTIONS_REST = {
   u'👀': 'eyes',
 }
 REACTIONS_REST_CHARS = {char: name for name, char, in REACTIONS_REST.items()}
+REACTIONS_GRAPHQL_TO_REST = {enum: REACTIONS_REST[char]
+                             for char, enum in REACTIONS_GRAPHQL.items()}
 
 
 # preserve some HTML elements instead of converting them. eg <code> so that
@@ -211,6 +258,11 @@ def replace_placeholders(text):
   return text
 
 
+def _status_code(exception):
+  """Returns an HTTP exception's integer response status code, or None."""
+  return getattr(getattr(exception, 'response', None), 'status_code', None)
+
+
 class GitHub(source.Source):
   """GitHub source class. See file docstring and Source class for details.
 
@@ -247,12 +299,17 @@ class GitHub(source.Source):
   }
   OPTIMIZED_COMMENTS = True
 
-  def __init__(self, access_token=None):
+  def __init__(self, access_token=None, session=None, async_client=None):
     """Constructor.
 
     Args:
       access_token: string, optional OAuth access token
+      session: :class:`requests.Session`, optional, passed through to
+        :meth:`Source.__init__`
+      async_client: :class:`httpx.AsyncClient`, optional, passed through to
+        :meth:`Source.__init__`
     """
+    super().__init__(session=session, async_client=async_client)
     self.access_token = access_token
 
   def user_url(self, username):
@@ -272,35 +329,61 @@ class GitHub(source.Source):
     if len(parts) == 4 and util.is_int(parts[3]):
       return ':'.join((parts[0], parts[1], parts[3]))
 
-  def graphql(self, graphql, kwargs):
+  def graphql(self, graphql, kwargs, ignore_errors=()):
     """Makes a v4 GraphQL API call.
 
     Args:
       graphql: string GraphQL operation
+      ignore_errors: sequence of string GraphQL error types, eg 'NOT_FOUND', to
+        log and ignore instead of raising. The fields they apply to will be
+        None in the returned data.
 
     Returns: dict, parsed JSON response
     """
+    resp = httputil.requests_fn('post', session=self.session)(
+      GRAPHQL_BASE, **self._graphql_kwargs(graphql, kwargs))
+    self._update_rate_limit(resp, 'graphql')
+    resp.raise_for_status()
+    return self._graphql_data(json_loads(resp.text), ignore_errors)
+
+  async def agraphql(self, graphql, kwargs, ignore_errors=()):
+    """Async version of :meth:`graphql`. Requires httpx."""
+    resp = await httputil.arequest('POST', GRAPHQL_BASE, client=self.async_client,
+                                 **self._graphql_kwargs(graphql, kwargs))
+    self._update_rate_limit(resp, 'graphql')
+    resp.raise_for_status()
+    return self._graphql_data(resp.json(), ignore_errors)
+
+  def _graphql_kwargs(self, graphql, kwargs):
+    """Returns the HTTP request kwargs for a GraphQL API call."""
     escaped = {k: (email.utils.quote(v) if isinstance(v, str) else v)
                for k, v in kwargs.items()}
-    resp = util.requests_post(
-      GRAPHQL_BASE, json={'query': graphql % escaped},
-      headers={
+    return {
+      'json': {'query': graphql % escaped},
+      'headers': {
         'Authorization': f'bearer {self.access_token}',
-      })
-    resp.raise_for_status()
-    result = json_loads(resp.text)
+      },
+    }
 
+  @staticmethod
+  def _graphql_data(result, ignore_errors=()):
+    """Returns the data in a GraphQL API response, or raises its errors."""
     errs = result.get('errors')
     if errs:
       logger.warning(result)
-      raise ValueError('\n'.join(e.get('message') for e in errs))
+      fatal = [e for e in errs if e.get('type') not in ignore_errors]
+      if fatal:
+        raise ValueError('\n'.join(e.get('message') for e in fatal))
 
     return result['data']
 
   def rest(self, url, data=None, parse_json=True, **kwargs):
     """Makes a v3 REST API call.
 
-    Uses HTTP POST if data is provided, otherwise GET.
+    Uses HTTP POST if data is provided, otherwise GET. If :attr:`validators`
+    is set, GETs with parse_json=True are sent as conditional requests, and
+    HTTP 304 responses return the stored body. GitHub doesn't count those
+    against the rate limit.
 
     Args:
       data: dict, JSON payload for POST requests
@@ -313,13 +396,107 @@ class GitHub(source.Source):
       'Authorization': f'token {self.access_token}',
     })
 
+    stored = None
+    if data is None and parse_json:
+      kwargs['headers'], stored = self._conditional_headers(
+        url, self.access_token, kwargs['headers'])
+
     if data is None:
-      resp = util.requests_get(url, **kwargs)
+      resp = httputil.requests_fn('get', session=self.session)(url, **kwargs)
     else:
-      resp = util.requests_post(url, json=data, **kwargs)
+      resp = httputil.requests_fn('post', session=self.session)(
+        url, json=data, **kwargs)
+    self._update_rate_limit(resp, 'core')
+
+    if resp.status_code == 304 and stored is not None:
+      return json_loads(stored)
     resp.raise_for_status()
 
-    return json_loads(resp.text) if parse_json else resp
+    if not parse_json:
+      return resp
+    if data is None:
+      self._store_validators(url, self.access_token, resp.headers, resp.text)
+    return json_loads(resp.text)
+
+  async def arest(self, url, parse_json=True, **kwargs):
+    """Async version of :meth:`rest`. Only supports GET. Requires httpx.
+
+    Like :meth:`rest`, sends conditional requests if :attr:`validators` is set
+    and parse_json is True, and returns HTTP 304 responses as is if
+    parse_json is False.
+
+    Returns: dict decoded from JSON response if parse_json=True, otherwise
+      :class:`httpx.Response`
+    """
+    kwargs['headers'] = kwargs.get('headers') or {}
+    kwargs['headers'].update({
+      'Authorization': f'token {self.access_token}',
+    })
+
+    stored = None
+    if parse_json:
+      kwargs['headers'], stored = self._conditional_headers(
+        url, self.access_token, kwargs['headers'])
+
+    resp = await httputil.arequest('GET', url, client=self.async_client, **kwargs)
+    self._update_rate_limit(resp, 'core')
+
+    # unlike requests, httpx's raise_for_status raises on 3xx
+    if resp.status_code == 304:
+      if not parse_json:
+        return resp
+      elif stored is not None:
+        return json_loads(stored)
+    resp.raise_for_status()
+
+    if not parse_json:
+      return resp
+    self._store_validators(url, self.access_token, resp.headers, resp.text)
+    return json_loads(resp.text)
+
+  def _rate_limit_key(self, resource):
+    """Returns the :class:`ratelimits.RateLimits` key for an API resource.
+
+    GitHub has separate rate limits for each resource, eg core (REST) and
+    graphql. https://docs.github.com/en/rest/rate-limit
+
+    Args:
+      resource: string
+    """
+    return ratelimits.rate_limit_key(self.NAME, self.access_token, resource)
+
+  def _update_rate_limit(self, resp, resource):
+    """Records an API response's rate limit headers.
+
+    Args:
+      resp: :class:`requests.Response` or :class:`httpx.Response`
+      resource: string, default resource if the response doesn't include
+        the X-RateLimit-Resource header
+    """
+    resource = resp.headers.get('X-RateLimit-Resource') or resource
+    ratelimits.rate_limits.update(self._rate_limit_key(resource), resp.headers,
+                              status=resp.status_code)
+
+  def _limit_notifications(self, notifs, use_graphql=False,
+                           fetch_replies=False, fetch_likes=False):
+    """Truncates notifications to what we can hydrate within our rate limit.
+
+    Args:
+      notifs: list of notification dicts
+      use_graphql: boolean
+
+    Returns:
+      list of notification dicts
+    """
+    if use_graphql:
+      batches = -(-len(notifs) // GRAPHQL_BATCH_SIZE)  # ceiling division
+      limit = ratelimits.rate_limits.limit(self._rate_limit_key('graphql'), batches)
+      return notifs[:limit * GRAPHQL_BATCH_SIZE]
+
+    per_notif = 1 + bool(fetch_replies) + bool(fetch_likes)
+    limit = ratelimits.rate_limits.limit(self._rate_limit_key('core'),
+                                     len(notifs) * per_notif)
+    return notifs[:limit // per_notif]
 
   def get_activities_response(self, user_id=None, group_id=None, app_id=None,
                               activity_id=None, start_index=0, count=0,
@@ -327,7 +504,7 @@ class GitHub(source.Source):
                               fetch_replies=False, fetch_likes=False,
                               fetch_shares=False, fetch_events=False,
                               fetch_mentions=False, search_query=None,
-                              public_only=True, **kwargs):
+                              public_only=True, use_graphql=False, **kwargs):
     """Fetches issues and comments and converts them to ActivityStreams activities.
 
     See :meth:`Source.get_activities_response` for details.
@@ -348,6 +525,17 @@ class GitHub(source.Source):
     timestamp, usually the exact value returned in a Last-Modified header. It
     will also be passed to the comments API endpoint as the since= value
     (converted to ISO 8601).
+
+    If hydrating every notification would exceed the remaining API rate limit,
+    as reported in recent responses' X-RateLimit-* headers, only the first
+    notifications that fit are hydrated, and the returned etag is the one
+    passed in, so that the rest are fetched again next time.
+
+    By default, each notification's issue or PR, comments, and reactions are
+    fetched with separate REST API calls, up to 3N+1 in total. If use_graphql
+    is True, they're instead fetched in batched v4 GraphQL queries, one per
+    :const:`GRAPHQL_BATCH_SIZE` notifications. Only the last 100 comments and
+    reactions per issue or PR are included.
     """
     if fetch_shares or fetch_events or fetch_mentions or search_query:
       raise NotImplementedError()
@@ -357,9 +545,7 @@ class GitHub(source.Source):
     activities = []
 
     if activity_id:
-      parts = tuple(activity_id.split(':'))
-      if len(parts) != 3:
-        raise ValueError('GitHub activity ids must be of the form USER:REPO:ISSUE_OR_PR')
+      parts = self._activity_id_parts(activity_id)
       try:
         issue = self.rest(REST_ISSUE % parts)
         activities = [self.issue_to_object(issue)]
@@ -373,63 +559,277 @@ class GitHub(source.Source):
     else:
       resp = self.rest(REST_NOTIFICATIONS, parse_json=False,
                        headers={'If-Modified-Since': etag} if etag else None)
-      etag = resp.headers.get('Last-Modified')
       notifs = [] if resp.status_code == 304 else json_loads(resp.text)
+      limited = self._limit_notifications(
+        notifs, use_graphql=use_graphql, fetch_replies=fetch_replies,
+        fetch_likes=fetch_likes)
+      if len(limited) == len(notifs):
+        etag = resp.headers.get('Last-Modified')
+      notifs = limited
+
+      if use_graphql:
+        for query, vars, notif_batch in self._graphql_batches(
+            notifs, fetch_replies=fetch_replies, fetch_likes=fetch_likes):
+          data = self.graphql(query, vars, ignore_errors=GRAPHQL_NON_FATAL_ERRORS)
+          activities.extend(self._graphql_batch_to_objects(
+            data, notif_batch, since=since, fetch_replies=fetch_replies,
+            fetch_likes=fetch_likes))
+
+      else:
+        for notif in notifs:
+          subject_url = self._notification_subject_url(notif)
+          if not subject_url:
+            continue
+
+          try:
+            issue = self.rest(subject_url)
+          except requests.HTTPError as e:
+            if e.response.status_code in HTTP_NON_FATAL_CODES:
+              util.interpret_http_exception(e)
+              continue
+            raise
+
+          obj = self._notification_issue_to_object(notif, issue)
+
+          comments_url = self._comments_url(issue, since)
+          if fetch_replies and comments_url:
+            self._set_replies(obj, self.rest(comments_url))
+
+          if fetch_likes:
+            self._add_reactions(obj, self.rest(self._reactions_url(issue)))
+
+          activities.append(obj)
 
-      for notif in notifs:
-        id = notif.get('id')
-        subject_url = notif.get('subject').get('url')
+    response = self.make_activities_base_response(util.trim_nulls(activities))
+    response['etag'] = etag
+    return response
+
+  async def aget_activities_response(
+      self, user_id=None, group_id=None, app_id=None, activity_id=None,
+      start_index=0, count=0, etag=None, min_id=None, cache=None,
+      fetch_replies=False, fetch_likes=False, fetch_shares=False,
+      fetch_events=False, fetch_mentions=False, search_query=None,
+      public_only=True, use_graphql=False, **kwargs):
+    """Async version of :meth:`get_activities_response`.
+
+    Notifications are hydrated concurrently, up to
+    :const:`httputil.ASYNC_MAX_CONCURRENCY` at once. Requires httpx.
+    """
+    if fetch_shares or fetch_events or fetch_mentions or search_query:
+      raise NotImplementedError()
+
+    etag_parsed = email.utils.parsedate(etag)
+    since = datetime.datetime(*etag_parsed[:6]) if etag_parsed else None
+    activities = []
+
+    if activity_id:
+      parts = self._activity_id_parts(activity_id)
+      try:
+        issue = await self.arest(REST_ISSUE % parts)
+        activities = [self.issue_to_object(issue)]
+      except BaseException as e:
+        if _status_code(e) not in HTTP_NON_FATAL_CODES:
+          raise
+
+    else:
+      resp = await self.arest(
+        REST_NOTIFICATIONS, parse_json=False,
+        headers={'If-Modified-Since': etag} if etag else None)
+      notifs = [] if resp.status_code == 304 else resp.json()
+      limited = self._limit_notifications(
+        notifs, use_graphql=use_graphql, fetch_replies=fetch_replies,
+        fetch_likes=fetch_likes)
+      if len(limited) == len(notifs):
+        etag = resp.headers.get('Last-Modified')
+      notifs = limited
+
+      if use_graphql:
+        for query, vars, notif_batch in self._graphql_batches(
+            notifs, fetch_replies=fetch_replies, fetch_likes=fetch_likes):
+          data = await self.agraphql(query, vars,
+                                     ignore_errors=GRAPHQL_NON_FATAL_ERRORS)
+          activities.extend(self._graphql_batch_to_objects(
+            data, notif_batch, since=since, fetch_replies=fetch_replies,
+            fetch_likes=fetch_likes))
+        notifs = []
+
+      async def hydrate(notif):
+        subject_url = self._notification_subject_url(notif)
         if not subject_url:
-          logger.info(f'Skipping thread {id}, missing subject!')
-          continue
-        split = subject_url.split('/')
-        if len(split) <= 2 or split[-2] not in ('issues', 'pulls'):
-          logger.info(
-            'Skipping thread %s with subject %s, only issues and PRs right now',
-            id, subject_url)
-          continue
+          return None
 
         try:
-          issue = self.rest(subject_url)
-        except requests.HTTPError as e:
-          if e.response.status_code in HTTP_NON_FATAL_CODES:
-            util.interpret_http_exception(e)
-            continue
+          issue = await self.arest(subject_url)
+        except BaseException as e:
+          if _status_code(e) in HTTP_NON_FATAL_CODES:
+            logger.info(f'Skipping {subject_url}: {e}')
+            return None
           raise
 
-        obj = self.issue_to_object(issue)
-
-        private = notif.get('repository', {}).get('private')
-        if private is not None:
-          obj['to'] = [{
-            'objectType': 'group',
-            'alias': '@private' if private else '@public',
-          }]
+        obj = self._notification_issue_to_object(notif, issue)
 
-        comments_url = issue.get('comments_url')
+        comments_url = self._comments_url(issue, since)
         if fetch_replies and comments_url:
-          if since:
-            comments_url += f'?since={since.isoformat()}' + 'Z'
-          comments = self.rest(comments_url)
-          comment_objs = list(util.trim_nulls(
-            self.comment_to_object(c) for c in comments))
-          obj['replies'] = {
-            'items': comment_objs,
-            'totalItems': len(comment_objs),
-          }
+          self._set_replies(obj, await self.arest(comments_url))
 
         if fetch_likes:
-          issue_url = issue['url'].replace('pulls', 'issues')
-          reactions = self.rest(issue_url + '/reactions')
-          obj.setdefault('tags', []).extend(
-            self.reaction_to_object(r, obj) for r in reactions)
+          self._add_reactions(obj, await self.arest(self._reactions_url(issue)))
+
+        return obj
 
-        activities.append(obj)
+      activities += [obj for obj in await httputil.amap_concurrently(hydrate, notifs)
+                     if obj]
 
     response = self.make_activities_base_response(util.trim_nulls(activities))
     response['etag'] = etag
     return response
 
+  @staticmethod
+  def _activity_id_parts(activity_id):
+    """Splits a USER:REPO:ISSUE_OR_PR activity id into a tuple."""
+    parts = tuple(activity_id.split(':'))
+    if len(parts) != 3:
+      raise ValueError('GitHub activity ids must be of the form USER:REPO:ISSUE_OR_PR')
+    return parts
+
+  @staticmethod
+  def _notification_subject_url(notif):
+    """Returns a notification's issue or PR API URL, or None to skip it."""
+    id = notif.get('id')
+    subject_url = notif.get('subject').get('url')
+    if not subject_url:
+      logger.info(f'Skipping thread {id}, missing subject!')
+      return None
+    split = subject_url.split('/')
+    if len(split) <= 2 or split[-2] not in ('issues', 'pulls'):
+      logger.info(
+        'Skipping thread %s with subject %s, only issues and PRs right now',
+        id, subject_url)
+      return None
+    return subject_url
+
+  def _notification_issue_to_object(self, notif, issue):
+    """Converts a notification's issue or PR to an object with audience."""
+    obj = self.issue_to_object(issue)
+
+    private = notif.get('repository', {}).get('private')
+    if private is not None:
+      obj['to'] = [{
+        'objectType': 'group',
+        'alias': '@private' if private else '@public',
+      }]
+
+    return obj
+
+  @staticmethod
+  def _comments_url(issue, since=None):
+    """Returns an issue's comments API URL, limited to since if provided."""
+    comments_url = issue.get('comments_url')
+    if comments_url and since:
+      comments_url += f'?since={since.isoformat()}' + 'Z'
+    return comments_url
+
+  @staticmethod
+  def _reactions_url(issue):
+    return issue['url'].replace('pulls', 'issues') + '/reactions'
+
+  def _set_replies(self, obj, comments):
+    comment_objs = list(util.trim_nulls(
+      self.comment_to_object(c) for c in comments))
+    obj['replies'] = {
+      'items': comment_objs,
+      'totalItems': len(comment_objs),
+    }
+
+  def _add_reactions(self, obj, reactions):
+    obj.setdefault('tags', []).extend(
+      self.reaction_to_object(r, obj) for r in reactions)
+
+  def _graphql_batches(self, notifs, fetch_replies=False, fetch_likes=False):
+    """Generates batched GraphQL queries that hydrate notification subjects.
+
+    Args:
+      notifs: sequence of v3 REST notification dicts
+      fetch_replies: boolean, whether to include comments
+      fetch_likes: boolean, whether to include reactions
+
+    Returns:
+      generator of (string query, dict graphql() kwargs, list of notifications)
+      tuples. The i'th notification's subject is aliased subject{i} in the
+      query's results.
+    """
+    fields = GRAPHQL_ISSUE_FIELDS
+    if fetch_replies:
+      fields += GRAPHQL_ISSUE_COMMENTS
+    if fetch_likes:
+      fields += GRAPHQL_ISSUE_REACTIONS
+
+    subjects = []
+    for notif in notifs:
+      subject_url = self._notification_subject_url(notif)
+      if subject_url:
+        # eg https://api.github.com/repos/OWNER/REPO/issues/NUMBER
+        path = urllib.parse.urlparse(subject_url).path.strip('/').split('/')
+        if len(path) == 5 and util.is_int(path[4]):
+          subjects.append((notif, path[1], path[2], path[4]))
+
+    for start in range(0, len(subjects), GRAPHQL_BATCH_SIZE):
+      batch = subjects[start:start + GRAPHQL_BATCH_SIZE]
+      query = 'query {%s}' % ''.join(
+        GRAPHQL_ISSUE_OR_PR_BATCH_ITEM % {'i': i, 'number': int(number),
+                                          'fields': fields}
+        for i, (_, _, _, number) in enumerate(batch))
+      vars = {}
+      for i, (_, owner, repo, _) in enumerate(batch):
+        vars.update({f'owner{i}': owner, f'repo{i}': repo})
+      yield query, vars, [notif for notif, _, _, _ in batch]
+
+  def _graphql_batch_to_objects(self, data, notifs, since=None,
+                                fetch_replies=False, fetch_likes=False):
+    """Converts a :meth:`_graphql_batches` query's results to objects.
+
+    Args:
+      data: dict, GraphQL response data
+      notifs: list of v3 REST notification dicts in the batch
+      since: :class:`datetime.datetime`, optional. If provided, only comments
+        updated at or after this time are included.
+      fetch_replies: boolean
+      fetch_likes: boolean
+
+    Returns:
+      list of ActivityStreams objects. Deleted subjects are omitted.
+    """
+    since_str = since.isoformat() + 'Z' if since else None
+
+    objs = []
+    for i, notif in enumerate(notifs):
+      issue = (data.get(f'subject{i}') or {}).get('issueOrPullRequest')
+      if not issue:
+        logger.info(f"Skipping thread {notif.get('id')}, subject not found")
+        continue
+
+      # convert to v3 REST shapes
+      issue['labels'] = (issue.get('labels') or {}).get('nodes') or []
+      if 'baseRefName' in issue:
+        issue['base'] = {'ref': issue.pop('baseRefName')}
+
+      obj = self._notification_issue_to_object(notif, issue)
+
+      if fetch_replies:
+        comments = [c for c in (issue.get('comments') or {}).get('nodes') or []
+                    if not since_str or (c.get('updated_at') or '') >= since_str]
+        self._set_replies(obj, comments)
+
+      if fetch_likes:
+        reactions = (issue.get('reactions') or {}).get('nodes') or []
+        for r in reactions:
+          r['content'] = REACTIONS_GRAPHQL_TO_REST.get(r.get('content'))
+        self._add_reactions(obj, reactions)
+
+      objs.append(obj)
+
+    return objs
+
   def get_actor(self, user_id=None):
     """Fetches nd returns a user.
 
@@ -444,6 +844,15 @@ class GitHub(source.Source):
 
     return self.user_to_actor(user)
 
+  async def aget_actor(self, user_id=None):
+    """Async version of :meth:`get_actor`."""
+    if user_id:
+      user = (await self.agraphql(GRAPHQL_USER, {'login': user_id}))['user']
+    else:
+      user = (await self.agraphql(GRAPHQL_VIEWER, {}))['viewer']
+
+    return self.user_to_actor(user)
+
   def get_comment(self, comment_id, **kwargs):
     """Fetches and returns a comment.
 
@@ -453,6 +862,31 @@ class GitHub(source.Source):
 
     Returns: dict, an ActivityStreams comment object
     """
+    rest_parts, node_id = self._comment_id_parts(comment_id)
+    if rest_parts:
+      comment = self.rest(REST_COMMENT % rest_parts)
+    else:
+      comment = self.graphql(GRAPHQL_COMMENT, {'id': node_id})['node']
+
+    return self.comment_to_object(comment)
+
+  async def aget_comment(self, comment_id, **kwargs):
+    """Async version of :meth:`get_comment`."""
+    rest_parts, node_id = self._comment_id_parts(comment_id)
+    if rest_parts:
+      comment = await self.arest(REST_COMMENT % rest_parts)
+    else:
+      comment = (await self.agraphql(GRAPHQL_COMMENT, {'id': node_id}))['node']
+
+    return self.comment_to_object(comment)
+
+  @staticmethod
+  def _comment_id_parts(comment_id):
+    """Parses a comment id for :meth:`get_comment`.
+
+    Returns:
+      (tuple of REST_COMMENT parts or None, string GraphQL node id or None)
+    """
     parts = comment_id.split(':')
     if len(parts) != 3:
       raise ValueError('GitHub comment ids must be of the form USER:REPO:COMMENT_ID')
@@ -460,11 +894,9 @@ class GitHub(source.Source):
     id = parts[-1]
     if util.is_int(id):  # REST API id
       parts.insert(2, 'issues')
-      comment = self.rest(REST_COMMENT % tuple(parts))
+      return tuple(parts), None
     else:  # GraphQL node id
-      comment = self.graphql(GRAPHQL_COMMENT, {'id': id})['node']
-
-    return self.comment_to_object(comment)
+      return None, id
 
   def render_markdown(self, markdown, owner, repo):
     """Uses the GitHub API to render GitHub-flavored Markdown to HTML.
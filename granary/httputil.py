@@ -0,0 +1,359 @@
+"""HTTP request plumbing: sessions, concurrency, and conditional requests."""
+import asyncio
+import concurrent.futures
+import hashlib
+import http.cookiejar
+import io
+import logging
+import threading
+import urllib.error, urllib.parse, urllib.request, urllib.response
+
+from oauth_dropins.webutil import util
+import requests
+
+try:
+  import httpx
+except ImportError:
+  httpx = None
+
+from .caches import MemoryCache
+
+logger = logging.getLogger(__name__)
+
+# max number of HTTP requests that the async API, eg aget_activities_response(),
+# makes at once per call
+ASYNC_MAX_CONCURRENCY = 10
+
+
+def map_concurrently(fn, inputs, max_workers=1, executor=None):
+  """Calls a function on each input, optionally in parallel on a thread pool.
+
+  Used to fan out independent per-activity HTTP fetches, e.g. likes and shares.
+  Results are returned in the same order as inputs. If any call raises an
+  exception, the first one (in input order) is re-raised here.
+
+  Args:
+    fn: callable that takes a single input
+    inputs: sequence of inputs
+    max_workers: int, max number of threads to use. If 1 or None, calls fn
+      serially in the current thread.
+    executor: :class:`concurrent.futures.Executor`, optional, long-lived pool
+      to run on instead of a new one for this call, eg so that per-thread
+      state survives across calls
+
+  Returns:
+    list of fn's return values
+  """
+  inputs = list(inputs)
+  if not max_workers or max_workers <= 1 or len(inputs) <= 1:
+    return [fn(input) for input in inputs]
+
+  if executor is not None:
+    return list(executor.map(fn, inputs))
+
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=min(max_workers, len(inputs))) as executor:
+    return list(executor.map(fn, inputs))
+
+
+class PooledSession(requests.Session):
+  """A :class:`requests.Session` with keep-alive connection pools per host.
+
+  Pass one to a :class:`source.Source` constructor's session kwarg to make its
+  API calls reuse HTTP/1.1 connections instead of opening (and TLS
+  handshaking) new ones for every call. Thread safe, so one session can be
+  shared across worker threads and across multiple :class:`source.Source`
+  instances.
+
+  Doesn't store cookies from responses, so that they don't leak across the
+  different users' sources that share a session. Pass cookies explicitly in
+  each request's headers instead.
+
+  Attributes:
+    max_per_host: int, optional, max number of concurrent requests to any
+      single host. Requests beyond that block until an earlier one finishes.
+  """
+  def __init__(self, pool_size=10, max_hosts=10, max_per_host=None):
+    """Constructor.
+
+    Args:
+      pool_size: int, max number of connections to keep open per host. Should
+        be at least the number of threads that will share the session.
+      max_hosts: int, max number of hosts to keep connection pools for
+      max_per_host: int, optional, max number of concurrent requests per host
+    """
+    super().__init__()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max_hosts,
+                                            pool_maxsize=pool_size)
+    self.mount('http://', adapter)
+    self.mount('https://', adapter)
+    self.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+    self.max_per_host = max_per_host
+    self._host_semaphores = {}
+    self._host_semaphores_lock = threading.Lock()
+
+  def _host_semaphore(self, url):
+    host = urllib.parse.urlparse(url).netloc
+    with self._host_semaphores_lock:
+      if host not in self._host_semaphores:
+        self._host_semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+      return self._host_semaphores[host]
+
+  def request(self, method, url, *args, **kwargs):
+    if not self.max_per_host:
+      return super().request(method, url, *args, **kwargs)
+
+    with self._host_semaphore(url):
+      return super().request(method, url, *args, **kwargs)
+
+
+class ValidatorStore(object):
+  """Stores HTTP validators and response bodies for conditional GETs.
+
+  Silo API wrappers send a stored response's ETag and Last-Modified back in
+  If-None-Match and If-Modified-Since headers, and replay its body if the silo
+  responds with HTTP 304 Not Modified. Set an instance as
+  :attr:`source.Source.validators` to use it.
+
+  Entries are keyed by URL and credential, hashed, so that access tokens don't
+  end up in cache keys.
+
+  Attributes:
+    cache: :class:`caches.Cache` or dict, where the validators and bodies are stored
+  """
+  def __init__(self, cache=None):
+    """Constructor.
+
+    Args:
+      cache: :class:`caches.Cache` or dict, optional. Defaults to a new
+        :class:`caches.MemoryCache`.
+    """
+    self.cache = MemoryCache() if cache is None else cache
+
+  @staticmethod
+  def _key(url, credential):
+    hashed = hashlib.sha256(f'{credential or ""} {url}'.encode()).hexdigest()
+    return f'V {hashed}'
+
+  def lookup(self, url, credential=None):
+    """Returns the conditional request headers and stored body for a URL.
+
+    Args:
+      url: string
+      credential: string, eg access token, optional
+
+    Returns:
+      (dict headers, string body) tuple. headers has If-None-Match and/or
+      If-Modified-Since, or is empty if nothing is stored for this URL, in
+      which case body is None.
+    """
+    entry = self.cache.get(self._key(url, credential))
+    if not entry:
+      return {}, None
+
+    headers = {}
+    if entry.get('etag'):
+      headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+      headers['If-Modified-Since'] = entry['last_modified']
+    return headers, entry.get('body')
+
+  def store(self, url, credential, headers, body):
+    """Stores a successful response's validators and body.
+
+    Does nothing if the response doesn't have an ETag or Last-Modified header.
+
+    Args:
+      url: string
+      credential: string, eg access token, optional
+      headers: dict-like HTTP response headers
+      body: string or bytes response body
+    """
+    headers = {k.lower(): v for k, v in (headers or {}).items()}
+    etag = headers.get('etag')
+    last_modified = headers.get('last-modified')
+    if not (etag or last_modified):
+      return
+
+    if isinstance(body, bytes):
+      body = body.decode()
+    self.cache[self._key(url, credential)] = {
+      'etag': etag,
+      'last_modified': last_modified,
+      'body': body,
+    }
+
+
+async def amap_concurrently(fn, inputs, max_concurrency=ASYNC_MAX_CONCURRENCY):
+  """Async counterpart to :func:`map_concurrently`.
+
+  Results are returned in the same order as inputs. If any call raises an
+  exception, it's re-raised here.
+
+  Args:
+    fn: coroutine function that takes a single input
+    inputs: sequence of inputs
+    max_concurrency: int, max number of calls to run at once
+
+  Returns:
+    list of fn's return values
+  """
+  semaphore = asyncio.Semaphore(max_concurrency)
+
+  async def run(input):
+    async with semaphore:
+      return await fn(input)
+
+  return await asyncio.gather(*(run(input) for input in inputs))
+
+
+async def arequest(method, url, client=None, **kwargs):
+  """Makes an HTTP request asynchronously. Async counterpart to :func:`requests_fn`.
+
+  Requires the httpx package, eg ``pip install granary[async]``.
+
+  Args:
+    method: string HTTP method, eg 'GET'
+    url: string
+    client: :class:`httpx.AsyncClient`, optional. If not provided, uses a new
+      client just for this request.
+    kwargs: passed through to :meth:`httpx.AsyncClient.request`, eg headers,
+      params, json
+
+  Returns:
+    :class:`httpx.Response`
+  """
+  if httpx is None:
+    raise NotImplementedError('The async API requires the httpx package')
+
+  if kwargs.get('headers') is None:
+    kwargs['headers'] = {}
+  kwargs['headers'].setdefault('User-Agent', util.user_agent)
+  kwargs.setdefault('timeout', util.HTTP_TIMEOUT)
+
+  logger.info(f'httpx {method} {url}')
+  if client is None:
+    async with httpx.AsyncClient(follow_redirects=True) as client:
+      resp = await client.request(method, url, **kwargs)
+  else:
+    resp = await client.request(method, url, **kwargs)
+
+  logger.info(f'Received {resp.status_code}')
+  return resp
+
+
+def requests_fn(fn, session=None):
+  """Returns a function that makes HTTP requests, like :func:`util.requests_fn`.
+
+  Args:
+    fn: 'get', 'head', 'post', or 'delete'
+    session: :class:`requests.Session`, optional. If provided, requests are
+      made through it so that they reuse its pooled connections. Otherwise,
+      returns :func:`util.requests_get` etc.
+  """
+  if session is None:
+    return getattr(util, f'requests_{fn}')
+
+  # this follows util.requests_fn, including its gateway kwarg, IDN retry, and
+  # response size limit. util.requests_fn always calls the requests module's
+  # functions, so it can't use a session.
+  def call(url, *args, **kwargs):
+    logger.info(f'requests.{fn} {url} (session)')
+
+    gateway = kwargs.pop('gateway', None)
+    kwargs.setdefault('timeout', util.HTTP_TIMEOUT)
+    # stream to short circuit on too-long response bodies (below)
+    kwargs.setdefault('stream', True)
+    if kwargs.get('headers') is None:
+      kwargs['headers'] = {}
+    kwargs['headers'].setdefault('User-Agent', util.user_agent)
+
+    try:
+      # use getattr so that stubbing out with mox still works
+      resp = getattr(session, fn)(url, *args, **kwargs)
+      if gateway:
+        resp.raise_for_status()
+    except (ValueError, requests.URLRequired) as e:
+      if isinstance(e, requests.exceptions.InvalidURL):
+        punycode = util.domain2idna(url)
+        if punycode != url:
+          # the domain is valid idn2003 but not idn2008. encode and try again.
+          resp = call(punycode, *args, gateway=gateway, **kwargs)
+          resp.url = resp.url.replace(urllib.parse.urlparse(punycode).netloc,
+                                      urllib.parse.urlparse(url).netloc)
+          return resp
+      if gateway:
+        util.abort(400, f'Bad URL {url} : {e}')
+      raise
+    except requests.RequestException as e:
+      if gateway:
+        msg = str(e)
+        if e.response is not None:
+          msg += f' ; {e.response.text}'
+        util.abort(502, msg)
+      raise
+
+    # check response size for text/ and application/ Content-Types
+    type = resp.headers.get('Content-Type', '')
+    if type.startswith('text/') or type.startswith('application/'):
+      length = resp.headers.get('Content-Length')
+      length = int(length) if util.is_int(length) else len(resp.text)
+      if length > util.MAX_HTTP_RESPONSE_SIZE:
+        resp.close()
+        resp.status_code = util.HTTP_RESPONSE_TOO_BIG_STATUS_CODE
+        resp._text = f'Content-Length {length} is larger than our limit {util.MAX_HTTP_RESPONSE_SIZE}.'
+        resp._content = resp._text.encode('utf-8')
+        if gateway:
+          resp.raise_for_status()
+
+    logger.info(f'Received {resp.status_code}')
+    return resp
+
+  return call
+
+
+def urlopen(url_or_req, session=None, **kwargs):
+  """Like :func:`util.urlopen`, but optionally makes the request via a session.
+
+  If session is provided, returns a :func:`urllib.request.urlopen`-style
+  response, raises :class:`urllib.error.HTTPError` on HTTP 304, 4xx, and 5xx,
+  and raises :class:`urllib.error.URLError` on connection failures, timeouts,
+  and other transport errors, so that callers can treat it like any other
+  urlopen call.
+
+  Args:
+    url_or_req: string URL or :class:`urllib.request.Request`
+    session: :class:`requests.Session`, optional
+    kwargs: passed through to :func:`util.urlopen`
+  """
+  if session is None:
+    return util.urlopen(url_or_req, **kwargs)
+
+  if isinstance(url_or_req, urllib.request.Request):
+    req = url_or_req
+  else:
+    req = urllib.request.Request(url_or_req, data=kwargs.get('data'))
+
+  data = req.data
+  if isinstance(data, str):
+    data = data.encode()
+  headers = dict(req.header_items())
+  headers.setdefault('User-Agent', util.user_agent)
+  method = req.get_method()
+  url = req.get_full_url()
+
+  logger.info(f'urlopen {method} {url} (session)')
+  try:
+    resp = session.request(method, url, data=data, headers=headers,
+                           timeout=kwargs.get('timeout', util.HTTP_TIMEOUT))
+  except requests.RequestException as e:
+    raise urllib.error.URLError(e)
+  logger.info(f'Received {resp.status_code}')
+
+  fp = io.BytesIO(resp.content)
+  if resp.status_code == 304 or resp.status_code // 100 in (4, 5):
+    raise urllib.error.HTTPError(url, resp.status_code, resp.reason,
+                                 resp.headers, fp)
+  return urllib.response.addinfourl(fp, resp.headers, resp.url,
+                                    resp.status_code)
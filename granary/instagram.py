@@ -8,6 +8,7 @@ https://groups.google.com/forum/#!searchin/instagram-api-developers/private
 """
 import datetime
 import itertools
+import json
 import logging
 import operator
 import re
@@ -20,6 +21,7 @@ from oauth_dropins.webutil.util import json_dumps, json_loads
 import requests
 
 from . import as1
+from . import httputil
 from . import source
 
 logger = logging.getLogger(__name__)
@@ -48,15 +50,33 @@ HTML_PRELOAD_RE = re.compile(
 HTML_LIKES_URL = HTML_BASE_URL + 'graphql/query/?query_hash=d5d763b1e2acf209d62d22d184488e57&variables={"shortcode":"%s","include_reel":false,"first":100}'
 HTML_COMMENTS_URL = 'https://i.instagram.com/api/v1/media/%s/comments/?can_support_threading=true&permalink_enabled=false'
 
-HTML_DATA_RE = re.compile(r"""
-  <script\ type="text/javascript">
-  window\.(_sharedData\ =|__additionalDataLoaded\('[^']+',)\ *
-  (.+?)
-  \)?;</script>""", re.VERBOSE)
-HTML_DEFINES_RE = re.compile(r"""
-  handleWithCustomApplyEach\(ScheduledApplyEach, *
-  (.+?)
-  \);}\);}""", re.VERBOSE)
+# Finds the JSON data islands and preload links in scraped HTML in one pass.
+# The JSON itself is decoded separately, starting at each match's end offset.
+HTML_SCAN_RE = re.compile(r"""
+  (?P<data><script\ type="text/javascript">
+    window\.(_sharedData\ =|__additionalDataLoaded\('[^']+',)\ *)
+  |(?P<defines>handleWithCustomApplyEach\(ScheduledApplyEach,\ *)
+  |<link\ [^>]*?href="(?P<preload>/graphql/query/[^"]*)"
+  """, re.VERBOSE)
+HTML_DATA_END_RE = re.compile(r'\s*\)?;</script>')
+# keys that scraped_json_to_activities reads. data islands without any of them
+# aren't decoded.
+HTML_DATA_KEYS_RE = re.compile(
+  r'"(entry_data|feed_items|items|user|viewer|shortcode_media)"')
+# top level keys in data islands that scraped_json_to_activities reads. the
+# other top level values aren't decoded into the result.
+HTML_DATA_TOP_LEVEL_KEYS = frozenset((
+  'config',
+  'data',
+  'entry_data',
+  'feed_items',
+  'graphql',
+  'items',
+  'user',
+))
+HTML_DATA_MEMBER_RE = re.compile(r'\s*"((?:[^"\\]|\\.)*)"\s*:\s*')
+HTML_DATA_SEPARATOR_RE = re.compile(r'\s*([,}])')
+HTML_XIG_SHARED_DATA_RE = re.compile(r'\["XIGSharedData",\s*\[[^\]]*\],\s*')
 
 # duplicated in bridgy/browser-extension/instagram.js and
 # instagram-atom/browser-extension/instagram.js
@@ -81,6 +101,134 @@ AUTO_ALT_TEXT_PREFIXES = (
 )
 
 
+NULLS = (None, {}, [], '')
+
+
+def _trim_null_pairs(pairs):
+  """JSON object_pairs_hook that trims nulls like :func:`util.trim_nulls`.
+
+  Objects are decoded innermost first, so this trims the whole value in the
+  same pass as decoding it.
+  """
+  obj = {}
+  for key, val in dict(pairs).items():
+    if isinstance(val, list):
+      val = _trim_null_list(val)
+    if val not in NULLS:
+      obj[key] = val
+  return obj
+
+
+def _trim_null_list(vals):
+  vals = (_trim_null_list(v) if isinstance(v, list) else v for v in vals)
+  return [v for v in vals if v]
+
+
+TRIMMING_DECODER = json.JSONDecoder(object_pairs_hook=_trim_null_pairs)
+DECODER = json.JSONDecoder()
+
+
+def _decode_data_island(input, start):
+  """Decodes and trims a window._sharedData etc JSON blob in scraped HTML.
+
+  If the blob is an object, only decodes the top level values that
+  :meth:`Instagram.scraped_json_to_activities` reads, ie
+  :const:`HTML_DATA_TOP_LEVEL_KEYS`. The rest are skipped.
+
+  Args:
+    input: string, HTML
+    start: integer, offset of the start of the JSON blob in input
+
+  Returns:
+    dict, or None if the blob is incomplete or has no media or user data
+  """
+  end = input.find('</script>', start)
+  if end == -1 or not HTML_DATA_KEYS_RE.search(input, start, end):
+    return None
+
+  if input.startswith('{', start):
+    data, end = _decode_top_level_keys(input, start)
+  else:
+    data, end = TRIMMING_DECODER.raw_decode(input, start)
+    if isinstance(data, list):
+      data = _trim_null_list(data)
+
+  if not HTML_DATA_END_RE.match(input, end):
+    return None
+
+  return data
+
+
+def _decode_top_level_keys(input, start):
+  """Decodes and trims a JSON object's values in :const:`HTML_DATA_TOP_LEVEL_KEYS`.
+
+  The other values are parsed with the plain decoder, without the trimming
+  object hook, only to find where they end, and then dropped.
+
+  Args:
+    input: string, HTML
+    start: integer, offset of the object's opening brace in input
+
+  Returns:
+    (dict, integer offset just past the object's closing brace) tuple
+
+  Raises:
+    :class:`json.JSONDecodeError` if the object is malformed
+  """
+  obj = {}
+  sep = HTML_DATA_SEPARATOR_RE.match(input, start + 1)
+  if sep and sep[1] == '}':
+    return obj, sep.end()
+
+  pos = start + 1
+  while True:
+    member = HTML_DATA_MEMBER_RE.match(input, pos)
+    if not member:
+      raise json.JSONDecodeError('Expecting property name', input, pos)
+
+    key = member[1]
+    if key in HTML_DATA_TOP_LEVEL_KEYS:
+      val, pos = TRIMMING_DECODER.raw_decode(input, member.end())
+      if isinstance(val, list):
+        val = _trim_null_list(val)
+      if val in NULLS:
+        obj.pop(key, None)
+      else:
+        obj[key] = val
+    else:
+      _, pos = DECODER.raw_decode(input, member.end())
+
+    sep = HTML_DATA_SEPARATOR_RE.match(input, pos)
+    if not sep:
+      raise json.JSONDecodeError("Expecting ',' delimiter", input, pos)
+    pos = sep.end()
+    if sep[1] == '}':
+      return obj, pos
+
+
+def _xig_shared_data(input, start):
+  """Finds XIGSharedData defines in a handleWithCustomApplyEach script.
+
+  Only decodes the XIGSharedData defines themselves, not the rest of the
+  script's defines.
+
+  Args:
+    input: string, HTML
+    start: integer, offset of the start of the defines JSON in input
+
+  Returns:
+    generator of string, raw serialized JSON from each define
+  """
+  end = input.find('</script>', start)
+  if end == -1:
+    return
+
+  for match in HTML_XIG_SHARED_DATA_RE.finditer(input, start, end):
+    define, _ = json.JSONDecoder().raw_decode(input, match.end())
+    if isinstance(define, dict):
+      yield define.get('raw', '{}')
+
+
 class Instagram(source.Source):
   """Instagram source class. See file docstring and Source class for details."""
 
@@ -99,7 +247,7 @@ class Instagram(source.Source):
   """
 
   def __init__(self, access_token=None, allow_comment_creation=False,
-               scrape=False, cookie=None):
+               scrape=False, cookie=None, session=None, max_workers=1):
     """Constructor.
 
     If an OAuth access token is provided, it will be passed on to Instagram.
@@ -113,18 +261,27 @@ class Instagram(source.Source):
       scrape: boolean, whether to scrape instagram.com's HTML (True) or use
         the API (False)
       cookie: string, optional sessionid cookie to use when scraping.
+      session: :class:`requests.Session`, optional, passed through to
+        :meth:`Source.__init__`
+      max_workers: int, optional, max number of post pages to fetch and parse
+        concurrently when scraping with fetch_replies or fetch_likes. Defaults
+        to 1, ie serial. If greater than 1 and session isn't provided, creates
+        a :class:`httputil.PooledSession` with that many connections per host.
     """
+    super().__init__(session=session, pool_size=max_workers)
     self.access_token = access_token
     self.allow_comment_creation = allow_comment_creation
     self.scrape = scrape
     self.cookie = cookie
+    self.max_workers = max_workers
 
   def urlopen(self, url, **kwargs):
     """Wraps :func:`urllib2.urlopen()` and passes through the access token."""
     if self.access_token:
       # TODO add access_token to the data parameter for POST requests
       url = util.add_query_params(url, [('access_token', self.access_token)])
-    resp = util.urlopen(urllib.request.Request(url, **kwargs))
+    resp = httputil.urlopen(urllib.request.Request(url, **kwargs),
+                          session=self.session)
     return (resp if kwargs.get('data')
             else source.load_json(resp.read(), url).get('data'))
 
@@ -327,7 +484,7 @@ class Instagram(source.Source):
         cookie = 'sessionid=' + cookie
       get_kwargs['headers'] = {'Cookie': cookie, **HEADERS}
 
-    resp = util.requests_get(url, **get_kwargs)
+    resp = httputil.requests_fn('get', session=self.session)(url, **get_kwargs)
     location = resp.headers.get('Location', '')
     if ((cookie and 'not-logged-in' in resp.text) or
         (resp.status_code in (301, 302) and
@@ -345,10 +502,10 @@ class Instagram(source.Source):
                                                    count=count)
 
     if fetch_extras:
-      if cache is None:
-        # for convenience, throwaway object just for this method
-        cache = {}
+      cache = self._cache_or_default(cache)
 
+      # collect the posts whose likes or comments have changed
+      to_fetch = []  # list of (index, dict of cache updates) tuples
       for i, activity in enumerate(activities):
         obj = activity['object']
         _, id = util.parse_tag_uri(activity['id'])
@@ -359,17 +516,28 @@ class Instagram(source.Source):
 
         if (likes and likes != cache.get(likes_key) or
             comments and comments != cache.get(comments_key)):
-          if not activity_id and not shortcode:
-            url = activity['url'].replace(self.BASE_URL, HTML_BASE_URL)
-            resp = util.requests_get(url, **get_kwargs)
-            resp.raise_for_status()
-          # otherwise resp is a fetch of just this activity; reuse it
-
-          full_activity, _ = self.scraped_to_activities(
-            resp.text, cookie=cookie, count=count, fetch_extras=fetch_extras)
-          if full_activity:
-            activities[i] = full_activity[0]
-            cache.update({likes_key: likes, comments_key: comments})
+          to_fetch.append((i, {likes_key: likes, comments_key: comments}))
+
+      def fetch(i):
+        """Fetches and parses a post's page. Runs on a worker thread."""
+        page = resp
+        if not activity_id and not shortcode:
+          url = activities[i]['url'].replace(self.BASE_URL, HTML_BASE_URL)
+          page = httputil.requests_fn('get', session=self.session)(
+            url, **get_kwargs)
+          page.raise_for_status()
+        # otherwise resp is a fetch of just this activity; reuse it
+
+        full_activity, _ = self.scraped_to_activities(
+          page.text, cookie=cookie, count=count, fetch_extras=fetch_extras)
+        return full_activity
+
+      fetched = httputil.map_concurrently(fetch, [i for i, _ in to_fetch],
+                                        max_workers=self.max_workers)
+      for (i, cache_updates), full_activity in zip(to_fetch, fetched):
+        if full_activity:
+          activities[i] = full_activity[0]
+          cache.update(cache_updates)
 
     resp = self.make_activities_base_response(activities)
     resp['actor'] = actor
@@ -823,32 +991,43 @@ class Instagram(source.Source):
       return self.scraped_json_to_activities(
         input, cookie=cookie, count=count, fetch_extras=fetch_extras)
 
-    # extract JSON data blob from HTML
-    matches = HTML_DATA_RE.findall(input)
-    if matches:
-      data = [util.trim_nulls(json_loads(match[1])) for match in matches]
+    # find JSON data islands and preload links in the HTML
+    data_starts = []
+    defines_start = preload = None
+    for match in HTML_SCAN_RE.finditer(input):
+      if match['data']:
+        data_starts.append(match.end())
+      elif match['defines']:
+        if defines_start is None:
+          defines_start = match.end()
+      elif preload is None:
+        href = xml.sax.saxutils.unescape(match['preload'])
+        if HTML_PRELOAD_RE.match(href):
+          preload = href
+
+    data = []
+    for start in data_starts:
+      blob = _decode_data_island(input, start)
+      if blob:
+        data.append(blob)
+    if data:
       activities, actor = self.scraped_json_to_activities(
         data, cookie=cookie, count=count, fetch_extras=fetch_extras)
       if activities or actor:
         return activities, actor
 
-    match = HTML_DEFINES_RE.search(input)
-    if match:
-      data = json_loads(match[1])
-      for define in data.get('define', []):
-        if len(define) >= 3 and define[0] == 'XIGSharedData':
-          xigshared = define[2].get('raw', '{}')
-          activities, actor = self.scraped_json_to_activities(
-            json_loads(xigshared), cookie=cookie, count=count, fetch_extras=fetch_extras)
-          if activities or actor:
-            return activities, actor
+    if defines_start is not None:
+      for xigshared in _xig_shared_data(input, defines_start):
+        activities, actor = self.scraped_json_to_activities(
+          json_loads(xigshared), cookie=cookie, count=count,
+          fetch_extras=fetch_extras)
+        if activities or actor:
+          return activities, actor
 
     # As of 2018-02-15, embedded JSON in logged in https://www.instagram.com/
     # sometimes has no useful data. Need to do a second header link fetch.
-    soup = util.parse_html(input)
-    link = soup.find('link', href=HTML_PRELOAD_RE)
-    if link:
-      url = urllib.parse.urljoin(HTML_BASE_URL, link['href'])
+    if preload:
+      url = urllib.parse.urljoin(HTML_BASE_URL, preload)
       return self.scraped_json_to_activities(
         self._scrape_json(url, cookie=cookie), cookie=cookie, count=count,
         fetch_extras=fetch_extras)
@@ -1081,8 +1260,7 @@ class Instagram(source.Source):
 
     return []
 
-  @staticmethod
-  def _scrape_json(url, cookie=None):
+  def _scrape_json(self, url, cookie=None):
     """Fetches and returns JSON from www.instagram.com."""
     if not cookie:
       return {}
@@ -1091,7 +1269,8 @@ class Instagram(source.Source):
       cookie = 'sessionid=' + cookie
     headers = {'Cookie': cookie, **HEADERS}
 
-    resp = util.requests_get(url, allow_redirects=False, headers=headers)
+    resp = httputil.requests_fn('get', session=self.session)(
+      url, allow_redirects=False, headers=headers)
     resp.raise_for_status()
 
     try:
@@ -7,15 +7,21 @@ independent of AP. API docs: https://docs.joinmastodon.org/api/
 May also be used for services with Mastodon-compatible APIs, eg Pleroma:
 https://docs-develop.pleroma.social/backend/API/differences_in_mastoapi_responses/
 """
+import hashlib
 import itertools
 import logging
 import re
+import tempfile
+import threading
+import time
 import urllib.parse
 
 from oauth_dropins.webutil import util
 from oauth_dropins.webutil.util import json_dumps, json_loads
 import requests
 
+from . import httputil
+from . import ratelimits
 from . import source
 
 logger = logging.getLogger(__name__)
@@ -36,6 +42,18 @@ API_STATUSES = '/api/v1/statuses'
 API_TIMELINE = '/api/v1/timelines/home'
 API_VERIFY_CREDENTIALS = '/api/v1/accounts/verify_credentials'
 
+# maps extras cache key prefix to API path, for replies, likes, and reposts
+EXTRAS_PATHS = {
+  'AMRE': API_CONTEXT,
+  'AMF': API_FAVORITED_BY,
+  'AMRB': API_REBLOGGED_BY,
+}
+
+# https://docs.joinmastodon.org/methods/notifications/
+NOTIFICATIONS_MENTIONS_PARAMS = {
+  'exclude_types': ['follow', 'favourite', 'reblog'],
+}
+
 # https://docs.joinmastodon.org/user/posting/#text
 DEFAULT_TRUNCATE_TEXT_LENGTH = 500
 
@@ -54,6 +72,20 @@ MEDIA_TYPES = {
 # https://github.com/tootsuite/mastodon/commit/5f511324b6#diff-11783d64d04391768226f7d45a610898R40
 MAX_MEDIA = 4
 
+# max number of concurrent media uploads to each instance, shared by all
+# Mastodon objects in this process
+MAX_CONCURRENT_UPLOADS = 4
+_upload_semaphores = {}  # maps instance base URL to BoundedSemaphore
+_upload_semaphores_lock = threading.Lock()
+
+# Mastodon deletes uploaded media that isn't attached to a status after a day.
+# https://github.com/mastodon/mastodon/blob/main/app/lib/vacuum/media_attachments_vacuum.rb
+MEDIA_REUSE_SECS = 12 * 60 * 60
+# when media_cache is set, media is downloaded and hashed before it's uploaded.
+# files up to this size are buffered in memory, larger ones on disk.
+MEDIA_SPOOL_SIZE = 10 * 1024 * 1024
+MEDIA_READ_SIZE = 64 * 1024
+
 # copied from Mastodon's source on 2019-10-21, then revised the lookbehind
 # https://github.com/tootsuite/mastodon/blob/6bee7b820dcde6d487e93b8699d4aab3e49bedc4/app/models/account.rb#L52-L53
 USERNAME_RE = re.compile(r'[a-z0-9_]+([a-z0-9_\.-]+[a-z0-9_]+)?', re.IGNORECASE)
@@ -87,7 +119,8 @@ class Mastodon(source.Source):
   TRUNCATE_URL_LENGTH = 23
 
   def __init__(self, instance, access_token, user_id=None,
-               truncate_text_length=None):
+               truncate_text_length=None, max_workers=1, session=None,
+               async_client=None, media_cache=None):
     """Constructor.
 
     If user_id is not provided, it will be fetched via the API.
@@ -99,7 +132,21 @@ class Mastodon(source.Source):
       access_token: string, optional OAuth access token
       truncate_text_length: int, optional character limit for toots, overrides
         the default of 500
+      max_workers: int, optional, max number of concurrent HTTP requests to
+        make when fetching each status's replies, likes, and reposts and
+        uploading media. Defaults to 1, ie serially. If more than 1 and session
+        isn't provided, all API calls share a new :class:`httputil.PooledSession`.
+      session: :class:`requests.Session`, optional, passed through to
+        :meth:`Source.__init__`
+      async_client: :class:`httpx.AsyncClient`, optional, passed through to
+        :meth:`Source.__init__`
+      media_cache: :class:`caches.Cache` or dict, optional, caches uploaded
+        media ids by content hash and description, so that retried posts don't
+        upload the same files again
     """
+    super().__init__(session=session, async_client=async_client,
+                     pool_size=max_workers)
+
     assert instance
     self.instance = self.BASE_URL = instance
     assert access_token
@@ -108,6 +155,8 @@ class Mastodon(source.Source):
       truncate_text_length if truncate_text_length is not None
       else DEFAULT_TRUNCATE_TEXT_LENGTH)
     self.DOMAIN = util.domain_from_link(instance)
+    self.max_workers = max_workers
+    self.media_cache = media_cache
 
     if user_id:
       self.user_id = user_id
@@ -119,20 +168,33 @@ class Mastodon(source.Source):
     return urllib.parse.urljoin(self.instance, '@' + username)
 
   def _get(self, *args, **kwargs):
-    return self._api(util.requests_get, *args, **kwargs)
+    return self._api('get', *args, **kwargs)
 
   def _post(self, *args, **kwargs):
-    return self._api(util.requests_post, *args, **kwargs)
+    return self._api('post', *args, **kwargs)
 
   def _delete(self, *args, **kwargs):
-    return self._api(util.requests_delete, *args, **kwargs)
+    return self._api('delete', *args, **kwargs)
 
   def _api(self, fn, path, return_json=True, *args, **kwargs):
     headers = kwargs.setdefault('headers', {})
     headers['Authorization'] = 'Bearer ' + self.access_token
 
     url = urllib.parse.urljoin(self.instance, path)
-    resp = fn(url, *args, **kwargs)
+    # conditional GET, if we have validators. key on the URL with query params.
+    key_url = url
+    if kwargs.get('params'):
+      key_url += '?' + urllib.parse.urlencode(kwargs['params'])
+    stored = None
+    if fn == 'get' and return_json and 'json' not in kwargs:
+      kwargs['headers'], stored = self._conditional_headers(
+        key_url, self.access_token, headers)
+
+    resp = httputil.requests_fn(fn, session=self.session)(url, *args, **kwargs)
+    ratelimits.rate_limits.update(self._rate_limit_key(), resp.headers,
+                              status=resp.status_code)
+    if resp.status_code == 304 and stored is not None:
+      return json_loads(stored)
     try:
       resp.raise_for_status()
     except BaseException as e:
@@ -141,10 +203,32 @@ class Mastodon(source.Source):
 
     if not return_json:
       return resp
-    if fn == util.requests_delete:
+    if fn == 'delete':
       return {}
-    else:
-      return json_loads(resp.text)
+    if fn == 'get' and 'json' not in kwargs:
+      self._store_validators(key_url, self.access_token, resp.headers,
+                             resp.text)
+    return json_loads(resp.text)
+
+  def _rate_limit_key(self):
+    """Returns the :class:`ratelimits.RateLimits` key for this account.
+
+    Mastodon rate limits each account across all endpoints.
+    https://docs.joinmastodon.org/api/rate-limits/
+    """
+    return ratelimits.rate_limit_key(self.NAME, f'{self.instance} {self.access_token}')
+
+  async def _aget(self, path, **kwargs):
+    """Async version of :meth:`_get`. Requires httpx."""
+    headers = kwargs.setdefault('headers', {})
+    headers['Authorization'] = 'Bearer ' + self.access_token
+
+    url = urllib.parse.urljoin(self.instance, path)
+    resp = await httputil.arequest('GET', url, client=self.async_client, **kwargs)
+    ratelimits.rate_limits.update(self._rate_limit_key(), resp.headers,
+                              status=resp.status_code)
+    resp.raise_for_status()
+    return resp.json()
 
   @classmethod
   def embed_post(cls, obj):
@@ -174,8 +258,84 @@ class Mastodon(source.Source):
                               start_index=0, count=0, cache=None, **kwargs):
     """Fetches toots and converts them to ActivityStreams activities.
 
+    Replies, likes, and reposts are fetched with separate API calls per status.
+    They're all run together on a worker pool of up to the constructor's
+    max_workers threads.
+
     See :meth:`Source.get_activities_response` for details.
     """
+    cache = self._cache_or_default(cache)
+
+    path, kw = self._statuses_request(
+      user_id=user_id, group_id=group_id, activity_id=activity_id,
+      fetch_events=fetch_events, search_query=search_query,
+      start_index=start_index, count=count)
+    statuses = self._extract_statuses(self._get(path, **kw), activity_id,
+                                      group_id)
+
+    activities, extras = self._plan_extras(
+      statuses[start_index:], include_shares=include_shares,
+      fetch_replies=fetch_replies, fetch_likes=fetch_likes,
+      fetch_shares=fetch_shares, cache=cache)
+
+    # fetch them all on one worker pool, then merge them in, in order
+    fetched = httputil.map_concurrently(
+      lambda extra: self._get(EXTRAS_PATHS[extra[0]] % extra[1]['id']),
+      extras, max_workers=self.max_workers)
+    self._merge_extras(extras, fetched, cache)
+
+    if fetch_mentions:
+      activities.extend(self._mentions_to_activities(
+        self._get(API_NOTIFICATIONS, json=NOTIFICATIONS_MENTIONS_PARAMS)))
+
+    return self.make_activities_base_response(util.trim_nulls(activities))
+
+  async def aget_activities_response(
+      self, user_id=None, group_id=None, app_id=None, activity_id=None,
+      fetch_replies=False, fetch_likes=False, fetch_shares=False,
+      include_shares=True, fetch_events=False, fetch_mentions=False,
+      search_query=None, start_index=0, count=0, cache=None, **kwargs):
+    """Async version of :meth:`get_activities_response`.
+
+    Replies, likes, and reposts are fetched concurrently, up to
+    :const:`httputil.ASYNC_MAX_CONCURRENCY` at once. Requires httpx.
+    """
+    cache = self._cache_or_default(cache)
+
+    path, kw = self._statuses_request(
+      user_id=user_id, group_id=group_id, activity_id=activity_id,
+      fetch_events=fetch_events, search_query=search_query,
+      start_index=start_index, count=count)
+    statuses = self._extract_statuses(await self._aget(path, **kw),
+                                      activity_id, group_id)
+
+    activities, extras = self._plan_extras(
+      statuses[start_index:], include_shares=include_shares,
+      fetch_replies=fetch_replies, fetch_likes=fetch_likes,
+      fetch_shares=fetch_shares, cache=cache)
+
+    fetched = await httputil.amap_concurrently(
+      lambda extra: self._aget(EXTRAS_PATHS[extra[0]] % extra[1]['id']),
+      extras)
+    self._merge_extras(extras, fetched, cache)
+
+    if fetch_mentions:
+      activities.extend(self._mentions_to_activities(
+        await self._aget(API_NOTIFICATIONS, json=NOTIFICATIONS_MENTIONS_PARAMS)))
+
+    return self.make_activities_base_response(util.trim_nulls(activities))
+
+  def _statuses_request(self, user_id=None, group_id=None, activity_id=None,
+                        fetch_events=False, search_query=None, start_index=0,
+                        count=0):
+    """Returns the API path and kwargs to fetch statuses with.
+
+    Shared by :meth:`get_activities_response` and
+    :meth:`aget_activities_response`.
+
+    Returns:
+      (string path, dict kwargs) tuple
+    """
     if user_id and group_id in (source.FRIENDS, source.ALL):
       raise ValueError(f"{self.NAME} doesn't support group_id {group_id} with user_id")
 
@@ -189,29 +349,46 @@ class Mastodon(source.Source):
       params['limit'] = count + start_index
 
     if activity_id:
-      statuses = [self._get(API_STATUS % activity_id)]
+      return API_STATUS % activity_id, {}
     elif group_id in (None, source.FRIENDS):
-      statuses = self._get(API_TIMELINE, params=params)
+      return API_TIMELINE, {'params': params}
     elif group_id == source.SEARCH:
       if not search_query:
         raise ValueError('search requires search_query parameter')
-      statuses = self._get(API_SEARCH, params={
+      return API_SEARCH, {'params': {
         'q': search_query,
         'resolve': True,
         'offset': start_index,
         **params,
-      }).get('statuses', [])
+      }}
     else:  # eg group_id SELF
-      statuses = self._get(API_ACCOUNT_STATUSES % user_id, params=params)
+      return API_ACCOUNT_STATUSES % user_id, {'params': params}
 
-    activities = []
+  @staticmethod
+  def _extract_statuses(resp, activity_id, group_id):
+    """Returns the list of statuses in a :meth:`_statuses_request` response."""
+    if activity_id:
+      return [resp]
+    elif group_id == source.SEARCH:
+      return resp.get('statuses', [])
+    return resp
+
+  def _plan_extras(self, statuses, include_shares=True, fetch_replies=False,
+                   fetch_likes=False, fetch_shares=False, cache=None):
+    """Converts statuses to activities and collects the extras to fetch.
 
-    if cache is None:
-      # for convenience, throwaway object just for this method
-      cache = {}
+    Only collects as many extras as the account's remaining rate limit budget
+    allows. The rest are fetched on a later call, since their cached counts
+    aren't updated.
 
-    # fetch extras if necessary
-    for status in statuses[start_index:]:
+    Returns:
+      (list of activities, list of (kind, status, activity) tuples) tuple.
+      kind is a cache key prefix in :const:`EXTRAS_PATHS`.
+    """
+    activities = []
+    extras = []
+
+    for status in statuses:
       if not include_shares and status.get('reblog'):
         continue
       activity = self.postprocess_activity(self.status_to_activity(status))
@@ -221,39 +398,45 @@ class Mastodon(source.Source):
       if not id:
         continue
 
+      for kind, fetch, field in (('AMRE', fetch_replies, 'replies_count'),
+                                 ('AMF', fetch_likes, 'favourites_count'),
+                                 ('AMRB', fetch_shares, 'reblogs_count')):
+        count = status.get(field)
+        if fetch and count and count != cache.get(f'{kind} {id}'):
+          extras.append((kind, status, activity))
+
+    limit = ratelimits.rate_limits.limit(self._rate_limit_key(), len(extras))
+    return activities, extras[:limit]
+
+  def _merge_extras(self, extras, fetched, cache):
+    """Merges fetched replies, likes, and reposts into their activities.
+
+    Args:
+      extras: list of (kind, status, activity) tuples from :meth:`_plan_extras`
+      fetched: list of decoded JSON API responses, one per extra
+      cache: dict, updated with the new counts
+    """
+    for (kind, status, activity), resp in zip(extras, fetched):
       obj = activity['object']
-      count = status.get('replies_count')
-      if fetch_replies and count and count != cache.get('AMRE ' + id):
-        context = self._get(API_CONTEXT % id)
+      tags = obj.setdefault('tags', [])
+      if kind == 'AMRE':
         obj['replies'] = {
           'items': [self.status_to_activity(reply)
-                    for reply in context.get('descendants', [])]
+                    for reply in resp.get('descendants', [])]
         }
-        cache['AMRE ' + id] = count
-
-      tags = obj.setdefault('tags', [])
-      count = status.get('favourites_count')
-      if fetch_likes and count and count != cache.get('AMF ' + id):
-        likers = self._get(API_FAVORITED_BY % id)
-        tags.extend(self._make_like(status, l) for l in likers)
-        cache['AMF ' + id] = count
-
-      count = status.get('reblogs_count')
-      if fetch_shares and count and count != cache.get('AMRB ' + id):
-        sharers = self._get(API_REBLOGGED_BY % id)
-        tags.extend(self._make_share(status, s) for s in sharers)
-        cache['AMRB ' + id] = count
-
-    if fetch_mentions:
-      # https://docs.joinmastodon.org/methods/notifications/
-      notifs = self._get(API_NOTIFICATIONS, json={
-        'exclude_types': ['follow', 'favourite', 'reblog'],
-      })
-      activities.extend(self.status_to_activity(n['status']) for n in notifs
-                        if n.get('status') and n.get('type') == 'mention')
+        count = status.get('replies_count')
+      elif kind == 'AMF':
+        tags.extend(self._make_like(status, l) for l in resp)
+        count = status.get('favourites_count')
+      else:
+        tags.extend(self._make_share(status, s) for s in resp)
+        count = status.get('reblogs_count')
+      cache[f'{kind} {status["id"]}'] = count
 
-    resp = self.make_activities_base_response(util.trim_nulls(activities))
-    return resp
+  def _mentions_to_activities(self, notifs):
+    """Converts mention notifications to activities."""
+    return [self.status_to_activity(n['status']) for n in notifs
+            if n.get('status') and n.get('type') == 'mention']
 
   def get_actor(self, user_id=None):
     """Fetches and returns an account.
@@ -266,6 +449,12 @@ class Mastodon(source.Source):
       user_id = self.user_id
     return self.user_to_actor(self._get(API_ACCOUNT % user_id))
 
+  async def aget_actor(self, user_id=None):
+    """Async version of :meth:`get_actor`."""
+    if user_id is None:
+      user_id = self.user_id
+    return self.user_to_actor(await self._aget(API_ACCOUNT % user_id))
+
   def get_comment(self, comment_id, **kwargs):
     """Fetches and returns a comment.
 
@@ -280,6 +469,10 @@ class Mastodon(source.Source):
     """
     return self.status_to_object(self._get(API_STATUS % comment_id))
 
+  async def aget_comment(self, comment_id, **kwargs):
+    """Async version of :meth:`get_comment`."""
+    return self.status_to_object(await self._aget(API_STATUS % comment_id))
+
   def status_to_activity(self, status):
     """Converts a status to an activity.
 
@@ -682,11 +875,17 @@ class Mastodon(source.Source):
                                       description=preview_description)
 
       else:
-        ids = self.upload_media(videos + images)
-        if ids:
-          data['media_ids'] = ids
+        uploaded = self._upload_media(videos + images)
+        if uploaded:
+          data['media_ids'] = [id for id, _ in uploaded]
         resp = self._post(API_STATUSES, json=data)
 
+        # attached media can't be reused in another status
+        if self.media_cache is not None:
+          for _, key in uploaded:
+            if key:
+              self.media_cache.pop(key, None)
+
     else:
       return source.creation_result(
         abort=False,
@@ -755,36 +954,118 @@ class Mastodon(source.Source):
     https://docs.joinmastodon.org/methods/statuses/media/
     https://docs.joinmastodon.org/user/posting/#attachments
 
+    Uploads up to the constructor's max_workers files at once, and up to
+    :const:`MAX_CONCURRENT_UPLOADS` to each instance across all
+    :class:`Mastodon` objects. If media_cache is set, reuses media that's
+    already been uploaded but not attached to a status yet, and only returns
+    one id for media with the same contents and alt text.
+
     Args:
       media: sequence of AS image or stream objects, eg:
         [{'url': 'http://picture', 'displayName': 'a thing'}, ...]
 
-    Returns: list of string media ids for uploaded files
+    Returns: list of string media ids for uploaded files, in the same order
     """
-    uploaded = set()  # URLs uploaded so far; for de-duping
-    ids = []
+    return [id for id, _ in self._upload_media(media)]
 
+  def _upload_media(self, media):
+    """Uploads media. Details in :meth:`upload_media`.
+
+    Returns: list of (string media id, string media_cache key or None) tuples
+    """
+    uploaded = set()  # URLs uploaded so far; for de-duping
+    to_upload = []
     for obj in media:
       url = util.get_url(obj, key='stream') or util.get_url(obj)
-      if not url or url in uploaded:
-        continue
+      if url and url not in uploaded:
+        to_upload.append(obj)
+        uploaded.add(url)
+
+    results = httputil.map_concurrently(self._upload_one, to_upload,
+                                      max_workers=self.max_workers)
+
+    # different URLs with the same contents and alt text share a media_cache
+    # key, and so maybe a media id, which can only be attached once
+    keys = set()
+    deduped = []
+    for id, key in results:
+      if key:
+        if key in keys:
+          logger.info(f'Skipping duplicate media {id}')
+          continue
+        keys.add(key)
+      deduped.append((id, key))
 
-      data = {}
-      alt = obj.get('displayName')
-      if alt:
-        data['description'] = util.ellipsize(alt, chars=MAX_ALT_LENGTH)
+    return deduped
 
-      # TODO: mime type check?
-      with util.requests_get(url, stream=True) as fetch:
-        fetch.raise_for_status()
-        upload = self._post(API_MEDIA, files={'file': fetch.raw}, data=data)
+  def _upload_one(self, obj):
+    """Uploads a single image or video.
 
-      logger.info(f'Got: {upload}')
-      media_id = upload['id']
-      ids.append(media_id)
-      uploaded.add(url)
+    Args:
+      obj: AS image or stream object
 
-    return ids
+    Returns: (string media id, string media_cache key or None) tuple
+    """
+    url = util.get_url(obj, key='stream') or util.get_url(obj)
+
+    data = {}
+    alt = obj.get('displayName')
+    if alt:
+      data['description'] = util.ellipsize(alt, chars=MAX_ALT_LENGTH)
+
+    # TODO: mime type check?
+    with util.requests_get(url, stream=True) as fetch:
+      fetch.raise_for_status()
+
+      if self.media_cache is None:
+        with self._upload_semaphore():
+          upload = self._post(API_MEDIA, files={'file': fetch.raw}, data=data)
+        logger.info(f'Got: {upload}')
+        return upload['id'], None
+
+      with tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_SIZE) as file:
+        hash = hashlib.sha256()
+        for chunk in iter(lambda: fetch.raw.read(MEDIA_READ_SIZE), b''):
+          hash.update(chunk)
+          file.write(chunk)
+
+        key = self._media_cache_key(hash.hexdigest(), data.get('description'))
+        cached = self.media_cache.get(key)
+        if cached and cached.get('expires', 0) > time.time():
+          logger.info(f'Reusing media id {cached["id"]} for {url}')
+          return cached['id'], key
+
+        file.seek(0)
+        with self._upload_semaphore():
+          upload = self._post(API_MEDIA, files={'file': file}, data=data)
+
+    logger.info(f'Got: {upload}')
+    self.media_cache[key] = {
+      'id': upload['id'],
+      'expires': time.time() + MEDIA_REUSE_SECS,
+    }
+    return upload['id'], key
+
+  def _media_cache_key(self, content_hash, description):
+    """Returns the media_cache key for uploaded media.
+
+    Media belongs to the account that uploaded it, so the key includes the
+    access token. It's hashed so that the token doesn't end up in the cache.
+
+    Args:
+      content_hash: string, hex SHA-256 hash of the file contents
+      description: string, alt text, or None
+    """
+    key = f'{self.instance} {self.access_token} {content_hash} {description or ""}'
+    return f'MMU {hashlib.sha256(key.encode()).hexdigest()}'
+
+  def _upload_semaphore(self):
+    """Returns the semaphore that caps concurrent uploads to this instance."""
+    with _upload_semaphores_lock:
+      if self.instance not in _upload_semaphores:
+        _upload_semaphores[self.instance] = threading.BoundedSemaphore(
+          MAX_CONCURRENT_UPLOADS)
+      return _upload_semaphores[self.instance]
 
   def delete(self, id):
     """Deletes a toot. The authenticated user must have authored it.
@@ -0,0 +1,188 @@
+"""API rate limit budgets, shared across silos and accounts."""
+import datetime
+import hashlib
+import logging
+import threading
+import time
+
+import dateutil.parser
+from oauth_dropins.webutil import util
+from oauth_dropins.webutil.util import json_loads
+
+logger = logging.getLogger(__name__)
+
+# seconds to wait after being rate limited when the silo doesn't say how long
+RATE_LIMIT_DEFAULT_BACKOFF = 60
+
+
+def parse_rate_limit_headers(headers, status=None):
+  """Extracts an API rate limit budget from HTTP response headers.
+
+  Understands Twitter's x-rate-limit-*, GitHub's and Mastodon's
+  X-RateLimit-*, the IETF draft RateLimit-*, Facebook's X-App-Usage and
+  X-Business-Use-Case-Usage, and Retry-After on HTTP 429 and 503.
+
+  Args:
+    headers: dict-like HTTP response headers, eg :class:`http.client.HTTPMessage`
+      or :class:`requests.structures.CaseInsensitiveDict`
+    status: int HTTP response status code, optional
+
+  Returns:
+    (int remaining, float reset) tuple. remaining is the number of calls left,
+    reset is the POSIX timestamp when the budget resets. Either may be None if
+    unknown.
+  """
+  headers = {k.lower(): v for k, v in (headers or {}).items()}
+  now = time.time()
+
+  def parse_reset(val):
+    if util.is_int(val):
+      # large values are timestamps, small values are seconds from now
+      val = int(val)
+      return float(val) if val > 1000000000 else now + val
+    try:
+      parsed = dateutil.parser.parse(val)
+    except (ValueError, OverflowError):
+      return None
+    if not parsed.tzinfo:
+      parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+  remaining = reset = None
+  for name in ('x-rate-limit-remaining', 'x-ratelimit-remaining',
+               'ratelimit-remaining'):
+    if util.is_int(headers.get(name)):
+      remaining = int(headers[name])
+      break
+
+  for name in ('x-rate-limit-reset', 'x-ratelimit-reset', 'ratelimit-reset'):
+    if headers.get(name):
+      reset = parse_reset(headers[name])
+      break
+
+  # Facebook reports usage as percentages of the limit
+  # https://developers.facebook.com/docs/graph-api/overview/rate-limiting/
+  for name in ('x-app-usage', 'x-business-use-case-usage'):
+    try:
+      usage = json_loads(headers.get(name) or '{}')
+    except ValueError:
+      continue
+    if name == 'x-business-use-case-usage':
+      usages = [u for us in usage.values() if isinstance(us, list) for u in us]
+    else:
+      usages = [usage]
+    for u in usages:
+      if not isinstance(u, dict):
+        continue
+      if any(util.is_int(v) and int(v) >= 100 for k, v in u.items()
+             if k != 'estimated_time_to_regain_access'):
+        remaining = 0
+        minutes = u.get('estimated_time_to_regain_access')
+        if util.is_int(minutes) and int(minutes):
+          reset = now + int(minutes) * 60
+
+  retry_after = headers.get('retry-after')
+  if status == 429 or (status == 503 and retry_after):
+    remaining = 0
+    if retry_after:
+      reset = parse_reset(retry_after) or reset
+
+  if remaining == 0 and not reset:
+    reset = now + RATE_LIMIT_DEFAULT_BACKOFF
+
+  return remaining, reset
+
+
+def rate_limit_key(silo, credential, bucket=None):
+  """Returns a key for a rate limit budget in :class:`RateLimits`.
+
+  Args:
+    silo: string, the silo's name
+    credential: string, identifies the account or app the budget belongs to,
+      eg an access token. Hashed, so that it doesn't show up in logs.
+    bucket: string, optional, the rate limit bucket within the account, eg an
+      API endpoint, for silos that rate limit endpoints separately
+
+  Returns:
+    tuple
+  """
+  hashed = hashlib.sha256((credential or '').encode()).hexdigest()[:16]
+  return (silo, hashed, bucket)
+
+
+class RateLimits(object):
+  """Registry of silo API rate limit budgets. Thread safe.
+
+  Silos call :meth:`update` with every API response's headers, then
+  :meth:`limit` to plan how many extra calls, eg for replies and likes, they
+  can make before they'd get rate limited. The global instance is
+  :data:`rate_limits`.
+  """
+  def __init__(self):
+    # maps key to (remaining, reset) tuple
+    self._budgets = {}
+    self._lock = threading.Lock()
+
+  def update(self, key, headers, status=None):
+    """Updates a budget from an API response's headers.
+
+    Args:
+      key: from :func:`rate_limit_key`
+      headers: dict-like HTTP response headers
+      status: int HTTP response status code, optional
+    """
+    remaining, reset = parse_rate_limit_headers(headers, status=status)
+    if remaining is not None:
+      with self._lock:
+        self._budgets[key] = (remaining, reset)
+
+  def remaining(self, key):
+    """Returns the number of calls left in a budget, or None if unknown."""
+    with self._lock:
+      remaining, reset = self._budgets.get(key, (None, None))
+      if reset is not None and reset <= time.time():
+        self._budgets.pop(key, None)
+        return None
+      return remaining
+
+  def reset(self, key):
+    """Returns the POSIX timestamp when a budget resets, or None if unknown."""
+    with self._lock:
+      return self._budgets.get(key, (None, None))[1]
+
+  def limit(self, key, count):
+    """Reserves up to count calls from a budget.
+
+    The reserved calls are deducted from the budget until the next
+    :meth:`update` replaces it with the silo's own count.
+
+    Args:
+      key: from :func:`rate_limit_key`
+      count: int, number of calls we want to make
+
+    Returns:
+      int, count if the budget is unknown or large enough, otherwise the number
+      of calls left in it
+    """
+    remaining = self.remaining(key)
+    if remaining is None:
+      return count
+
+    allowed = max(min(count, remaining), 0)
+    if allowed < count:
+      logger.warning(f'Rate limit budget {key} only has {remaining} calls left; skipping {count - allowed}. Results will be incomplete!')
+
+    with self._lock:
+      if key in self._budgets:
+        remaining, reset = self._budgets[key]
+        self._budgets[key] = (remaining - allowed, reset)
+
+    return allowed
+
+  def clear(self):
+    with self._lock:
+      self._budgets.clear()
+
+
+# global rate limit registry, shared by all sources
+rate_limits = RateLimits()
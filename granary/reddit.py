@@ -1,7 +1,7 @@
 # coding=utf-8
 """Reddit source class.
 
-Not thread safe!
+Thread safe. PRAW itself isn't, so each thread gets its own PRAW client.
 
 Reddit API docs:
 https://github.com/reddit-archive/reddit/wiki/API
@@ -11,21 +11,25 @@ https://www.reddit.com/prefs/apps
 PRAW API docs:
 https://praw.readthedocs.io/
 """
+import concurrent.futures
 import logging
 import threading
 import urllib.parse
 
-from cachetools import cachedmethod, TTLCache
+from cachetools import TTLCache
 from oauth_dropins import reddit
 from oauth_dropins.webutil import util
 import praw
 from prawcore.exceptions import NotFound
 
+from . import httputil
 from . import source
 
 logger = logging.getLogger(__name__)
 
 USER_CACHE_TIME = 5 * 60  # 5 minute expiration, in seconds
+# default user cache, shared by all instances in this process. Values are user
+# dicts as returned by oauth_dropins.reddit.praw_to_user, keyed by username.
 user_cache = TTLCache(1000, USER_CACHE_TIME)
 user_cache_lock = threading.RLock()
 
@@ -37,16 +41,96 @@ class Reddit(source.Source):
   BASE_URL = 'https://reddit.com'
   NAME = 'Reddit'
   OPTIMIZED_COMMENTS = True
+  user_cache = user_cache
 
-  def __init__(self, refresh_token):
-    self.api = praw.Reddit(
-      client_id=reddit.REDDIT_APP_KEY,
-      client_secret=reddit.REDDIT_APP_SECRET,
-      refresh_token=refresh_token,
-      user_agent=util.user_agent,
-      # https://praw.readthedocs.io/en/stable/getting_started/configuration/options.html#basic-configuration-options
-      check_for_updates=False)
-    self.api.read_only = True
+  def __init__(self, refresh_token, session=None, max_workers=1,
+               user_cache=None, bulk_users=False):
+    """Constructor.
+
+    Args:
+      refresh_token: string, OAuth refresh token
+      session: :class:`requests.Session`, optional, passed through to
+        :meth:`Source.__init__` and used by PRAW
+      max_workers: int, optional, max number of comment trees to fetch
+        concurrently in :meth:`get_activities_response` with fetch_replies.
+        Defaults to 1, ie serial.
+      user_cache: :class:`caches.Cache` or dict, optional, where to cache
+        fetched user data. Pass a :class:`caches.MemcacheCache` or file-backed
+        :class:`caches.SqliteCache` to share it across processes. Defaults to
+        an in-process :class:`cachetools.TTLCache` with a 5m expiration.
+      bulk_users: boolean, whether to resolve all of a response's authors up
+        front in batched ``/api/user_data_by_account_ids`` calls, 100 users
+        per request, instead of one profile request per author. Batched user
+        data doesn't include profile descriptions, so actors resolved this
+        way don't include the URLs in them.
+    """
+    super().__init__(session=session)
+    self.refresh_token = refresh_token
+    self.max_workers = max_workers
+    if user_cache is not None:
+      self.user_cache = user_cache
+    self.bulk_users = bulk_users
+    self._local = threading.local()
+    self._api = None
+    self._executor = None
+    self._executor_lock = threading.Lock()
+
+  @property
+  def api(self):
+    """The current thread's PRAW client. Created on first use in each thread.
+
+    If set explicitly, eg to a mock, that object is shared by all threads.
+    """
+    if self._api is not None:
+      return self._api
+
+    api = getattr(self._local, 'api', None)
+    if api is None:
+      api = self._local.api = praw.Reddit(
+        client_id=reddit.REDDIT_APP_KEY,
+        client_secret=reddit.REDDIT_APP_SECRET,
+        refresh_token=self.refresh_token,
+        user_agent=util.user_agent,
+        # https://praw.readthedocs.io/en/stable/getting_started/configuration/options.html#basic-configuration-options
+        check_for_updates=False,
+        requestor_kwargs={'session': self.session} if self.session else None)
+      api.read_only = True
+    return api
+
+  @api.setter
+  def api(self, api):
+    self._api = api
+
+  @property
+  def executor(self):
+    """Long-lived thread pool for concurrent fetches, with max_workers threads.
+
+    Created on first use. Its threads, and so their PRAW clients and OAuth
+    access tokens, are reused across calls until :meth:`close`.
+    """
+    with self._executor_lock:
+      if self._executor is None:
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+          max_workers=self.max_workers, thread_name_prefix='reddit')
+      return self._executor
+
+  def close(self):
+    """Shuts down :attr:`executor`'s threads, if it's been created.
+
+    Safe to call more than once. The next concurrent fetch creates a new pool.
+    Also called on exit when used as a context manager, eg
+    ``with Reddit(...) as r:``.
+    """
+    with self._executor_lock:
+      executor, self._executor = self._executor, None
+    if executor is not None:
+      executor.shutdown()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
 
   @classmethod
   def post_id(self, url):
@@ -62,8 +146,6 @@ class Reddit(source.Source):
     if len(path_parts) >= 2:
       return path_parts[-2]
 
-  @cachedmethod(lambda self: user_cache, lock=lambda self: user_cache_lock,
-                key=lambda self, user: getattr(user, 'name', None))
   def praw_to_actor(self, praw_user):
     """Converts a PRAW Redditor to an actor.
 
@@ -71,9 +153,9 @@ class Reddit(source.Source):
 
     https://praw.readthedocs.io/en/latest/code_overview/models/redditor.html
 
-    Caches fetched user data for 5m to avoid repeating user profile API requests
-    when fetching multiple comments or posts from the same author. Background:
-    https://github.com/snarfed/bridgy/issues/1021
+    Caches fetched user data in :attr:`user_cache` to avoid repeating user
+    profile API requests when fetching multiple comments or posts from the same
+    author. Background: https://github.com/snarfed/bridgy/issues/1021
 
     Ideally this would be part of PRAW, but they seem uninterested:
     https://github.com/praw-dev/praw/issues/131
@@ -85,14 +167,78 @@ class Reddit(source.Source):
     Returns:
       an ActivityStreams actor dict, ready to be JSON-encoded
     """
-    try:
-      user = reddit.praw_to_user(praw_user)
-    except NotFound:
-      logger.debug(f'User not found: {praw_user} {repr(praw_user)}', exc_info=True)
-      return {}
+    name = getattr(praw_user, 'name', None)
+    user = self._cached_user(name) if name else None
+
+    if user is None:
+      try:
+        user = reddit.praw_to_user(praw_user)
+      except NotFound:
+        logger.debug(f'User not found: {praw_user} {repr(praw_user)}', exc_info=True)
+        user = {}
+      if name:
+        self._cache_user(name, user)
 
     return self.user_to_actor(user)
 
+  def _cached_user(self, name):
+    """Returns a user's cached data dict, or None if it's not cached.
+
+    Prefers a full profile over a partial one from :meth:`_resolve_users`.
+
+    Args:
+      name: string, username
+    """
+    with user_cache_lock:
+      user = self.user_cache.get(f'RU {name}')
+      if user is None:
+        user = self.user_cache.get(f'RUP {name}')
+      return user
+
+  def _cache_user(self, name, user, partial=False):
+    """Stores a user's data dict in :attr:`user_cache`.
+
+    Partial users are stored under their own keys so that they never
+    overwrite full profiles.
+
+    Args:
+      name: string, username
+      user: dict, JSON user, or {} if they weren't found
+      partial: boolean, whether user is from a bulk partial user lookup
+    """
+    with user_cache_lock:
+      self.user_cache[f'{"RUP" if partial else "RU"} {name}'] = user
+
+  def _resolve_users(self, things):
+    """Fetches and caches the authors of PRAW submissions or comments in bulk.
+
+    Loads every author who isn't already in :attr:`user_cache` with PRAW's
+    :meth:`praw.models.Redditors.partial_redditors`, which fetches up to 100
+    users per request from ``/api/user_data_by_account_ids``.
+
+    Args:
+      things: sequence of PRAW Submission and/or Comment objects
+    """
+    fullnames = {}
+    for thing in things:
+      author = getattr(thing, 'author', None)
+      name = getattr(author, 'name', None)
+      fullname = getattr(thing, 'author_fullname', None)
+      if name and fullname and self._cached_user(name) is None:
+        fullnames[fullname] = name
+
+    if not fullnames:
+      return
+
+    for partial in self.api.redditors.partial_redditors(list(fullnames)):
+      name = getattr(partial, 'name', None) or fullnames.get(partial.fullname)
+      self._cache_user(name, util.trim_nulls({
+        'name': name,
+        'id': partial.fullname[len('t2_'):],
+        'icon_img': getattr(partial, 'profile_img', None),
+        'created_utc': getattr(partial, 'created_utc', None),
+      }), partial=True)
+
   def user_to_actor(self, user):
     """Converts a dict user to an actor.
 
@@ -235,30 +381,64 @@ class Reddit(source.Source):
 
     Only includes top level comments!
 
+    If there's a cache, loads the comment counts of the submissions that are
+    already in it with one batched ``info()`` call, then only fetches the
+    comment trees of the new submissions and the ones whose counts have
+    changed since they were cached. Fetches up
+    to the constructor's max_workers comment trees at once, on
+    :attr:`executor`.
+
     Args:
       activities: list of activity dicts
       cache: dict, cache as described in get_activities_response()
     """
-    for activity in activities:
-      id = util.parse_tag_uri(activity.get('id'))[1]
-      subm = self.api.submission(id=id)
+    if cache is None:
+      cache = self.cache
+
+    ids = [util.parse_tag_uri(activity.get('id'))[1] for activity in activities]
+    if not ids:
+      return
+
+    cached = {}
+    if cache is not None:
+      cached = {id: cache.get(f'ARR {id}') for id in ids}
+      cached = {id: count for id, count in cached.items() if count is not None}
+
+    num_comments = {}
+    if cached:
+      num_comments = {
+        subm.id: subm.num_comments
+        for subm in self.api.info(fullnames=[f't3_{id}' for id in cached])
+      }
 
-      cache_key = f'ARR {id}'
-      if cache and cache.get(cache_key) == subm.num_comments:
-        continue
+    to_fetch = [(id, activity) for id, activity in zip(ids, activities)
+                if not (id in num_comments and cached[id] == num_comments[id])]
+    if not to_fetch:
+      return
 
+    def fetch(id):
+      """Fetches a submission's top level comments. Runs on a worker thread."""
+      subm = self.api.submission(id=id)
       # for v0 we will use just the top level comments because threading is hard.
       # feature request: https://github.com/snarfed/bridgy/issues/1014
       subm.comments.replace_more()
-      replies = [self.praw_to_activity(top_level_comment, 'comment')
-                 for top_level_comment in subm.comments]
-      items = [r.get('object') for r in replies]
+      comments = list(subm.comments)
+      if self.bulk_users:
+        self._resolve_users(comments)
+      replies = [self.praw_to_activity(comment, 'comment') for comment in comments]
+      return [r.get('object') for r in replies], subm.num_comments
+
+    fetched = httputil.map_concurrently(
+      fetch, [id for id, _ in to_fetch], max_workers=self.max_workers,
+      executor=self.executor if self.max_workers > 1 else None)
+
+    for (id, activity), (items, count) in zip(to_fetch, fetched):
       activity['object']['replies'] = {
         'items': items,
         'totalItems': len(items),
       }
       if cache is not None:
-        cache[cache_key] = subm.num_comments
+        cache[f'ARR {id}'] = num_comments.get(id, count)
 
   def get_activities_response(self, user_id=None, group_id=None, app_id=None,
                               activity_id=None, start_index=0, count=None,
@@ -277,6 +457,10 @@ class Reddit(source.Source):
     else:
       submissions = self._redditor(user_id).submissions.new(limit=count)
 
+    submissions = list(submissions)
+    if self.bulk_users:
+      self._resolve_users(submissions)
+
     activities = [self.praw_to_activity(s, 'submission') for s in submissions]
 
     if fetch_replies:
@@ -14,6 +14,7 @@ Notably:
 from datetime import datetime, time, timezone
 import logging
 import mimetypes
+from xml.etree import ElementTree
 
 import dateutil.parser
 from feedgen.feed import FeedGenerator
@@ -22,6 +23,7 @@ import mf2util
 from oauth_dropins.webutil import util
 
 from . import microformats2
+from . import source
 
 logger = logging.getLogger(__name__)
 
@@ -185,16 +187,98 @@ def to_activities(rss):
     list of ActivityStreams activity dicts
   """
   parsed = feedparser.parse(rss)
-  activities = []
+  actor = _feed_to_actor(parsed.get('feed', {}))
+  return util.trim_nulls([_entry_to_activity(entry, actor)
+                          for entry in parsed.get('entries', [])])
 
-  feed = parsed.get('feed', {})
-  actor = {
+
+def iter_to_activities(rss):
+  """Converts an RSS feed to ActivityStreams 1 activities, incrementally.
+
+  Generator version of :func:`to_activities`. Parses the feed one <item> at a
+  time and discards each one once it's converted, so memory use stays bounded
+  regardless of the feed's size. Each item is still interpreted by
+  feedparser, so the results match :func:`to_activities`. Unlike feedparser,
+  though, this doesn't recover from malformed XML. It raises at the first
+  error, like :func:`atom.iter_atom_to_activities`.
+
+  Feed-level metadata, eg title and image, is only picked up for the fallback
+  author if it appears before the first item.
+
+  Args:
+    rss: RSS document with top-level <rss> element. Unicode or byte string,
+      file-like object, or iterable of chunks, eg
+      :meth:`requests.Response.iter_content`.
+
+  Yields:
+    ActivityStreams activity dicts
+
+  Raises:
+    :class:`ElementTree.ParseError` if the XML is malformed
+  """
+  ancestors = []
+  actor = None
+
+  for event, elem in source.xml_iterparse(rss):
+    if event == 'start':
+      ancestors.append(elem)
+      continue
+
+    ancestors.pop()
+    if (not ancestors or len(ancestors) > 2 or
+        elem.tag.split('}')[-1] not in ('item', 'entry')):
+      continue
+
+    ancestors[-1].remove(elem)
+    if actor is None:
+      header = feedparser.parse(ElementTree.tostring(ancestors[0], 'utf-8'))
+      actor = _feed_to_actor(header.get('feed', {}))
+
+    # wrap the item in shallow copies of its ancestors so that feedparser sees
+    # a complete feed
+    wrapper = parent = None
+    for ancestor in ancestors:
+      shallow = ElementTree.Element(ancestor.tag, ancestor.attrib)
+      if parent is None:
+        wrapper = shallow
+      else:
+        parent.append(shallow)
+      parent = shallow
+    parent.append(elem)
+
+    parsed = feedparser.parse(ElementTree.tostring(wrapper, 'utf-8'))
+    for entry in parsed.get('entries', []):
+      yield util.trim_nulls(_entry_to_activity(entry, actor))
+
+
+def _feed_to_actor(feed):
+  """Converts a feedparser feed to an ActivityStreams 1 actor.
+
+  Args:
+    feed: dict, feedparser feed metadata
+
+  Returns:
+    dict, ActivityStreams actor
+  """
+  return {
     'displayName': feed.get('title'),
     'url': feed.get('link'),
     'summary': feed.get('info') or feed.get('description'),
     'image': [{'url': feed.get('image', {}).get('href') or feed.get('logo')}],
   }
 
+
+def _entry_to_activity(entry, actor):
+  """Converts a feedparser entry to an ActivityStreams 1 activity.
+
+  Args:
+    entry: dict, feedparser entry
+    actor: dict, ActivityStreams actor for the feed. Used as the author if the
+      entry doesn't have one.
+
+  Returns:
+    dict, ActivityStreams activity
+  """
   def iso_datetime(field):
     # check for existence because feedparser returns 'published' for 'updated'
     # when you [] or .get() it
@@ -207,53 +291,50 @@ def to_activities(rss):
   def as_int(val):
     return int(val) if util.is_int(val) else val
 
-  for entry in parsed.get('entries', []):
-    id = entry.get('id')
-    uri = entry.get('uri') or entry.get('link')
-
-    attachments = []
-    for e in entry.get('enclosures', []):
-      url = e.get('href')
-      if url:
-        mime = e.get('type') or mimetypes.guess_type(url)[0] or ''
-        type = mime.split('/')[0]
-        attachments.append({
-          'stream': {
-            'url': url,
-            'size': as_int(e.get('length')),
-            'duration': as_int(entry.get('itunes_duration')),
-          },
-          'objectType': type if type in ENCLOSURE_TYPES else None,
-        })
-
-    detail = entry.get('author_detail', {})
-    author = util.trim_nulls({
-      'displayName': detail.get('name') or entry.get('author'),
-      'url': detail.get('href'),
-      'email': detail.get('email'),
-    })
-    if not author:
-      author = actor
-
-    activities.append({
-      'objectType': 'activity',
-      'verb': 'create',
-      'id': id,
+  id = entry.get('id')
+  uri = entry.get('uri') or entry.get('link')
+
+  attachments = []
+  for e in entry.get('enclosures', []):
+    url = e.get('href')
+    if url:
+      mime = e.get('type') or mimetypes.guess_type(url)[0] or ''
+      type = mime.split('/')[0]
+      attachments.append({
+        'stream': {
+          'url': url,
+          'size': as_int(e.get('length')),
+          'duration': as_int(entry.get('itunes_duration')),
+        },
+        'objectType': type if type in ENCLOSURE_TYPES else None,
+      })
+
+  detail = entry.get('author_detail', {})
+  author = util.trim_nulls({
+    'displayName': detail.get('name') or entry.get('author'),
+    'url': detail.get('href'),
+    'email': detail.get('email'),
+  })
+  if not author:
+    author = actor
+
+  return {
+    'objectType': 'activity',
+    'verb': 'create',
+    'id': id,
+    'url': uri,
+    'actor': author,
+    'object': {
+      'objectType': 'article',
+      'id': id or uri,
       'url': uri,
-      'actor': author,
-      'object': {
-        'objectType': 'article',
-        'id': id or uri,
-        'url': uri,
-        'displayName': entry.get('title'),
-        'content': entry.get('content', [{}])[0].get('value') or entry.get('description'),
-        'published': iso_datetime('published'),
-        'updated': iso_datetime('updated'),
-        'author': author,
-        'tags': [{'displayName': tag.get('term') for tag in entry.get('tags', [])}],
-        'attachments': attachments,
-        'stream': [a['stream'] for a in attachments],
-      },
-    })
-
-  return util.trim_nulls(activities)
+      'displayName': entry.get('title'),
+      'content': entry.get('content', [{}])[0].get('value') or entry.get('description'),
+      'published': iso_datetime('published'),
+      'updated': iso_datetime('updated'),
+      'author': author,
+      'tags': [{'displayName': tag.get('term') for tag in entry.get('tags', [])}],
+      'attachments': attachments,
+      'stream': [a['stream'] for a in attachments],
+    },
+  }
@@ -9,20 +9,28 @@ activity's privacy settings. It's set to a group with alias @public or @private,
 or unset if unknown.
 http://activitystrea.ms/specs/json/targeting/1.0/#anchor3
 """
+import asyncio
 import collections
+import contextlib
 import copy
+import functools
 from html import escape, unescape
 import logging
 import re
-import urllib.parse
+import threading
+import urllib.error, urllib.parse
+from xml.etree import ElementTree
 
 import brevity
 from bs4 import BeautifulSoup
+from bs4.element import Tag
+import cachetools
 import html2text
 from oauth_dropins.webutil import util
 from oauth_dropins.webutil.util import json_dumps, json_loads
 
 from . import as1
+from . import httputil
 
 logger = logging.getLogger(__name__)
 
@@ -40,6 +48,16 @@ OMIT_LINK = 'omit'
 INCLUDE_LINK = 'include'
 INCLUDE_IF_TRUNCATED = 'if truncated'
 HTML_ENTITY_RE = re.compile(r'&#?[a-zA-Z0-9]+;')
+# matches anything that Python's html.parser would parse as a start tag
+HTML_TAG_RE = re.compile(r'<[a-zA-Z][^>]*>')
+
+# max number of html_to_text results to cache
+HTML_TO_TEXT_CACHE_SIZE = 1000
+# max number of idle html2text converters to keep for each set of options
+HTML2TEXT_POOL_SIZE = 8
+
+# number of bytes or characters that xml_iterparse feeds to its parser at once
+XML_PARSE_CHUNK_SIZE = 64 * 1024
 
 # maps lower case string short name to Source subclass. populated by SourceMeta.
 sources = {}
@@ -53,15 +71,108 @@ class RateLimited(BaseException):
 
   Attributes:
     partial: the partial result, if any. Usually a list.
+    reset: float POSIX timestamp when the rate limit resets, if known
   """
   def __init__(self, *args, **kwargs):
     self.partial = kwargs.pop('partial', None)
+    self.reset = kwargs.pop('reset', None)
     super(RateLimited, self).__init__(*args, **kwargs)
 
 
+# hacky monkey patch fix for html2text escaping sequences that are significant
+# in markdown syntax. the X\\Y replacement depends on knowledge of html2text's
+# internals, specifically that it replaces RE_MD_*_MATCHER with \1\\\2. :(:(:(
+html2text.config.RE_MD_DOT_MATCHER = \
+  html2text.config.RE_MD_PLUS_MATCHER = \
+  html2text.config.RE_MD_DASH_MATCHER = \
+  re.compile(r'(X)\\(Y)')
+
+html_to_text_cache = cachetools.LRUCache(HTML_TO_TEXT_CACHE_SIZE)
+html_to_text_cache_lock = threading.RLock()
+
+
+class HTML2TextPool:
+  """Pool of reusable, configured :class:`html2text.HTML2Text` converters.
+
+  Converters are keyed by base URL and options. :class:`html2text.HTML2Text`
+  isn't thread safe, so each one is only lent out to one caller at a time, and
+  its parser state is reset when it's returned.
+  """
+  def __init__(self, size=HTML2TEXT_POOL_SIZE):
+    """Constructor.
+
+    Args:
+      size: integer, max number of idle converters to keep per key
+    """
+    self.size = size
+    self._idle = collections.defaultdict(list)
+    self._initial_states = {}
+    self._lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def converter(self, baseurl='', **options):
+    """Lends out a converter.
+
+    Args:
+      baseurl: str, base URL to use when resolving relative URLs
+      **options: html2text options
+
+    Yields:
+      :class:`html2text.HTML2Text`
+    """
+    key = (baseurl, tuple(sorted(options.items())))
+    try:
+      hash(key)
+    except TypeError:  # unhashable option value, so it can't be pooled
+      yield self._new_converter(baseurl, options)
+      return
+
+    with self._lock:
+      idle = self._idle[key]
+      h = idle.pop() if idle else None
+
+    if h is None:
+      h = self._new_converter(baseurl, options)
+      with self._lock:
+        self._initial_states.setdefault(key, self._copy_state(vars(h)))
+
+    try:
+      yield h
+    finally:
+      # restore the freshly constructed and configured state
+      state = vars(h)
+      state.clear()
+      state.update(self._copy_state(self._initial_states[key]))
+
+      with self._lock:
+        if len(idle) < self.size:
+          idle.append(h)
+
+  @staticmethod
+  def _new_converter(baseurl, options):
+    """Returns a new converter configured with the given options."""
+    h = html2text.HTML2Text(baseurl=baseurl)
+    for name, val in options.items():
+      setattr(h, name, val)
+    return h
+
+  @staticmethod
+  def _copy_state(state):
+    """Copies a converter's attributes, including its lists and dicts, eg
+    outtextlist and tag_stack."""
+    return {name: val.copy() if isinstance(val, (list, dict)) else val
+            for name, val in state.items()}
+
+
+html2text_pool = HTML2TextPool()
+
+
 def html_to_text(html, baseurl='', **kwargs):
   """Converts string html to string text with html2text.
 
+  Uses pooled converters from :data:`html2text_pool`, and caches results in an
+  LRU cache, :data:`html_to_text_cache`.
+
   Args:
     baseurl: str, base URL to use when resolving relative URLs. Passed through
       to HTML2Text().
@@ -69,26 +180,121 @@ def html_to_text(html, baseurl='', **kwargs):
       https://github.com/Alir3z4/html2text/blob/master/docs/usage.md#available-options
   """
   if html:
-    h = html2text.HTML2Text(baseurl=baseurl)
-    h.unicode_snob = True
-    h.body_width = 0  # don't wrap lines
-    h.ignore_links = True
-    h.ignore_images = True
-    for key, val in kwargs.items():
-      setattr(h, key, val)
-
-    # hacky monkey patch fix for html2text escaping sequences that are
-    # significant in markdown syntax. the X\\Y replacement depends on knowledge
-    # of html2text's internals, specifically that it replaces RE_MD_*_MATCHER
-    # with \1\\\2. :(:(:(
-    html2text.config.RE_MD_DOT_MATCHER = \
-      html2text.config.RE_MD_PLUS_MATCHER = \
-      html2text.config.RE_MD_DASH_MATCHER = \
-      re.compile(r'(X)\\(Y)')
-
-    return '\n'.join(
-      # strip trailing whitespace that html2text adds to ends of some lines
-      line.rstrip() for line in unescape(h.handle(html)).splitlines())
+    options = {
+      'unicode_snob': True,
+      'body_width': 0,  # don't wrap lines
+      'ignore_links': True,
+      'ignore_images': True,
+      **kwargs,
+    }
+
+    try:
+      key = (html, baseurl, tuple(sorted(options.items())))
+      hash(key)
+    except TypeError:  # unhashable option value
+      key = None
+
+    if key:
+      with html_to_text_cache_lock:
+        text = html_to_text_cache.get(key)
+      if text is not None:
+        return text
+
+    with html2text_pool.converter(baseurl=baseurl, **options) as h:
+      text = '\n'.join(
+        # strip trailing whitespace that html2text adds to ends of some lines
+        line.rstrip() for line in unescape(h.handle(html)).splitlines())
+
+    if key:
+      with html_to_text_cache_lock:
+        html_to_text_cache[key] = text
+    return text
+
+
+def looks_like_html(text):
+  """Returns True if text has any HTML tags or entities, False otherwise.
+
+  Cheaper than parsing it. Only counts tags that Python's :mod:`html.parser`
+  would parse as tags.
+
+  Args:
+    text: str
+  """
+  return bool(HTML_TAG_RE.search(text) or HTML_ENTITY_RE.search(text))
+
+
+def xml_iterparse(input):
+  """Parses XML incrementally. Yields elements as they're parsed.
+
+  Like :func:`ElementTree.iterparse`, but accepts strings and iterables of
+  chunks, eg :meth:`requests.Response.iter_content`, as well as file-like
+  objects. Callers should remove elements from their parents once they're
+  done with them to keep memory use bounded.
+
+  Args:
+    input: unicode or byte string, file-like object with read(), or iterable
+      of unicode or byte string chunks
+
+  Yields:
+    (event, element) tuples. event is 'start' or 'end'.
+
+  Raises:
+    :class:`ElementTree.ParseError` if the XML is malformed or incomplete
+  """
+  if isinstance(input, (str, bytes)):
+    chunks = (input[i:i + XML_PARSE_CHUNK_SIZE]
+              for i in range(0, len(input), XML_PARSE_CHUNK_SIZE))
+  elif hasattr(input, 'read'):
+    def read():
+      while True:
+        chunk = input.read(XML_PARSE_CHUNK_SIZE)
+        if not chunk:
+          return
+        yield chunk
+    chunks = read()
+  else:
+    chunks = input
+
+  parser = ElementTree.XMLPullParser(events=('start', 'end'))
+  for chunk in chunks:
+    parser.feed(chunk)
+    yield from parser.read_events()
+
+  parser.close()
+  yield from parser.read_events()
+
+
+# BeautifulSoup parser for targeted scraping parses. lxml is the only one that
+# supports parse_only for all of our inputs. It's optional, so full parses use
+# util.beautifulsoup_parser.
+SCRAPE_PARSER = 'lxml'
+
+
+def parse_scraped_html(input, parse_only=None):
+  """Parses scraped HTML, optionally only the parts that a scraper uses.
+
+  Scrapers call this instead of :func:`util.parse_html` so that they can skip
+  building the tree for the parts of large pages that they don't look at, and
+  so that their callers can parse a page once and pass the same soup to
+  multiple scrape methods.
+
+  Args:
+    input: unicode HTML string, :class:`requests.Response`, or an already
+      parsed :class:`bs4.BeautifulSoup` or :class:`bs4.element.Tag`, which is
+      returned as is. Note that scrapers may modify it.
+    parse_only: :class:`bs4.SoupStrainer`, optional. If provided, only
+      elements that match it, and their descendants, are parsed, with
+      :const:`SCRAPE_PARSER`, which requires ``lxml``. Otherwise, uses
+      :data:`util.beautifulsoup_parser`.
+
+  Returns:
+    :class:`bs4.BeautifulSoup` or :class:`bs4.element.Tag`
+  """
+  if isinstance(input, Tag):
+    return input
+  if parse_only is None:
+    return util.parse_html(input)
+  return util.parse_html(input, features=SCRAPE_PARSER, parse_only=parse_only)
 
 
 def load_json(body, url):
@@ -165,12 +371,49 @@ class Source(object, metaclass=SourceMeta):
   * OPTIMIZED_COMMENTS: boolean, whether :meth:`get_comment()` is optimized and
     only fetches the requested comment. If False, :meth:`get_comment()` fetches
     many or all of the post's comments to find the requested one.
+
+  Attributes:
+
+  * cache: :class:`caches.Cache` or dict, optional, default cache for
+    :meth:`get_activities_response` calls that don't pass one. Set it on an
+    instance, or on :class:`Source` itself to share one cache across all silos.
+    Silos' cache keys are only unique within one account or instance, eg
+    Mastodon's ``AMRE <id>`` keys collide across servers, so instances for
+    different accounts or servers should each get their own cache, eg a
+    :class:`caches.MemcacheCache` with a per-instance prefix, not share one.
+  * validators: :class:`httputil.ValidatorStore`, optional. If set, API GETs
+    send conditional requests based on previous responses' ETag and
+    Last-Modified headers, and reuse the previous response body on HTTP 304.
   """
   POST_ID_RE = None
   HTML2TEXT_OPTIONS = {}
   TRUNCATE_TEXT_LENGTH = None
   TRUNCATE_URL_LENGTH = None
   OPTIMIZED_COMMENTS = False
+  session = None
+  async_client = None
+  cache = None
+  validators = None
+
+  def __init__(self, session=None, async_client=None, pool_size=None):
+    """Constructor.
+
+    Args:
+      session: :class:`requests.Session`, optional, used for this source's
+        HTTP requests. Usually a :class:`httputil.PooledSession`. If not
+        provided, each request opens its own connection.
+      async_client: :class:`httpx.AsyncClient`, optional, used for this
+        source's HTTP requests in the async API, eg
+        :meth:`aget_activities_response`. If not provided, each request uses
+        its own client.
+      pool_size: int, optional. If greater than 1 and session isn't provided,
+        creates a :class:`httputil.PooledSession` with this many connections
+        per host. Silos pass their max_workers here.
+    """
+    if session is None and pool_size and pool_size > 1:
+      session = httputil.PooledSession(pool_size=pool_size)
+    self.session = session
+    self.async_client = async_client
 
   def user_url(self, user_id):
     """Returns the URL for a user's profile."""
@@ -195,6 +438,88 @@ class Source(object, metaclass=SourceMeta):
     """
     return self.get_activities_response(*args, **kwargs)['items']
 
+  async def aget_activities(self, *args, **kwargs):
+    """Async version of :meth:`get_activities`."""
+    return (await self.aget_activities_response(*args, **kwargs))['items']
+
+  async def aget_activities_response(self, *args, **kwargs):
+    """Async version of :meth:`get_activities_response`.
+
+    This default implementation runs :meth:`get_activities_response` in the
+    event loop's default executor, ie on a thread. Subclasses may override it
+    with a natively async implementation.
+    """
+    return await self._run_in_executor(self.get_activities_response,
+                                       *args, **kwargs)
+
+  async def aget_actor(self, *args, **kwargs):
+    """Async version of :meth:`get_actor`. Runs it in the default executor.
+
+    Subclasses may override this with a natively async implementation.
+    """
+    return await self._run_in_executor(self.get_actor, *args, **kwargs)
+
+  async def aget_comment(self, *args, **kwargs):
+    """Async version of :meth:`get_comment`. Runs it in the default executor.
+
+    Subclasses may override this with a natively async implementation.
+    """
+    return await self._run_in_executor(self.get_comment, *args, **kwargs)
+
+  def _cache_or_default(self, cache):
+    """Returns the cache to use for a :meth:`get_activities_response` call.
+
+    Args:
+      cache: :class:`caches.Cache` or dict, the call's cache kwarg, or None
+
+    Returns:
+      cache if it's not None, otherwise :attr:`cache` if it's set, otherwise a
+      new throwaway dict just for this call
+    """
+    if cache is not None:
+      return cache
+    elif self.cache is not None:
+      return self.cache
+    return {}
+
+  def _conditional_headers(self, url, credential, headers=None):
+    """Adds conditional request headers from :attr:`validators` to a GET.
+
+    Leaves headers as is if :attr:`validators` isn't set, or if they already
+    have If-None-Match or If-Modified-Since, eg from an etag kwarg. The caller
+    handles those requests' HTTP 304 responses itself.
+
+    Args:
+      url: string
+      credential: string, eg access token
+      headers: dict, request headers, optional
+
+    Returns:
+      (dict headers, string body) tuple. body is the stored response body to
+      use if the silo returns HTTP 304, or None.
+    """
+    headers = dict(headers or {})
+    if (self.validators is None or
+        any(h.lower() in ('if-none-match', 'if-modified-since') for h in headers)):
+      return headers, None
+
+    conditional, body = self.validators.lookup(url, credential)
+    if body is None:
+      return headers, None
+
+    headers.update(conditional)
+    return headers, body
+
+  def _store_validators(self, url, credential, headers, body):
+    """Stores a GET response in :attr:`validators`, if it's set."""
+    if self.validators is not None:
+      self.validators.store(url, credential, headers, body)
+
+  @staticmethod
+  async def _run_in_executor(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(
+      None, functools.partial(fn, *args, **kwargs))
+
   def get_activities_response(
     self, user_id=None, group_id=None, app_id=None, activity_id=None,
     start_index=0, count=0, etag=None, min_id=None, cache=None,
@@ -233,9 +558,9 @@ class Source(object, metaclass=SourceMeta):
         only be returned if the ETag has changed. Should include enclosing
         double quotes, e.g. '"ABC123"'
       min_id: only return activities with ids greater than this
-      cache: dict, optional, used to cache metadata like comment and like counts
-        per activity across calls. Used to skip expensive API calls that haven't
-        changed.
+      cache: :class:`caches.Cache` or dict, optional, used to cache metadata like
+        comment and like counts per activity across calls. Used to skip
+        expensive API calls that haven't changed. Defaults to :attr:`cache`.
       fetch_replies: boolean, whether to fetch each activity's replies also
       fetch_likes: boolean, whether to fetch each activity's likes also
       include_shares: boolean, whether to include share activities
@@ -775,20 +1100,29 @@ class Source(object, metaclass=SourceMeta):
     name = obj.get('displayName', '').strip()
     content = obj.get('content', '').strip()
 
+    # sniff whether content is HTML or plain text. only looks for tags that
+    # html.parser would parse, since it's stricter than html5lib and expects
+    # actual HTML tags, and doesn't parse content that isn't HTML at all.
+    # https://www.crummy.com/software/BeautifulSoup/bs4/doc/#differences-between-parsers
+    is_html = looks_like_html(content)
+
     # note that unicode() on a BeautifulSoup object preserves HTML and
     # whitespace, even after modifying the DOM, which is important for
     # formatting.
     #
     # The catch is that it adds a '<html><head></head><body>' header and
     # '</body></html>' footer. ah well. harmless.
-    soup = util.parse_html(content)
-    if strip_first_video_tag:
+    soup = None
+    if is_html and (summary or strip_first_video_tag or strip_quotations):
+      soup = util.parse_html(content)
+
+    if soup and strip_first_video_tag:
       video = soup.video or soup.find(class_='u-video')
       if video:
         video.extract()
         content = str(soup)
 
-    if strip_quotations:
+    if soup and strip_quotations:
       quotations = soup.find_all(class_='u-quotation-of')
       if quotations:
         for q in quotations:
@@ -796,17 +1130,11 @@ class Source(object, metaclass=SourceMeta):
         content = str(soup)
 
     # compare to content with HTML tags stripped
-    if summary == soup.get_text('').strip():
+    if summary and summary == (soup.get_text('').strip() if soup else content):
       # summary and content are the same; prefer content so that we can use its
       # HTML formatting.
       summary = None
 
-    # sniff whether content is HTML or plain text. use html.parser instead of
-    # the default html5lib since html.parser is stricter and expects actual
-    # HTML tags.
-    # https://www.crummy.com/software/BeautifulSoup/bs4/doc/#differences-between-parsers
-    is_html = (bool(BeautifulSoup(content, 'html.parser').find()) or
-               HTML_ENTITY_RE.search(content))
     if is_html and not ignore_formatting:
       content = html_to_text(content, baseurl=(obj.get('url') or ''),
                              **self.HTML2TEXT_OPTIONS)
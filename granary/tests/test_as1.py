@@ -2,8 +2,10 @@
 """Unit tests for as1.py."""
 import copy
 import re
+import time
 
 from oauth_dropins.webutil import testutil
+from oauth_dropins.webutil import util
 
 from .. import as1
 
@@ -364,6 +366,64 @@ class As1Test(testutil.TestCase):
     check(obj, ['http://or.ig/post/redirected', 'http://other/link/redirected'],
           include_redirect_sources=False)
 
+  def test_resolve_redirects_cache(self):
+    self.expect_requests_head('http://sho.rt/post', redirected_url='http://or.ig/post')
+    self.expect_requests_head('http://sho.rt/bad', status_code=404)
+    self.expect_requests_head('http://sho.rt/bad', status_code=404)
+    self.mox.ReplayAll()
+
+    cache = {}
+    urls = ['http://sho.rt/post', 'http://sho.rt/bad', 'http://sho.rt/post']
+    for _ in range(2):
+      self.assertEqual({'http://sho.rt/post': 'http://or.ig/post'},
+                       as1.resolve_redirects(urls, cache=cache))
+
+    self.assertEqual({'R http://sho.rt/post', 'R http://sho.rt/bad'}, set(cache))
+
+    # failures are cached for less time
+    now = time.time()
+    self.assertLess(cache['R http://sho.rt/bad']['expires'],
+                    now + as1.REDIRECT_FAILURE_CACHE_TIME + 1)
+    self.assertGreater(cache['R http://sho.rt/post']['expires'],
+                       now + as1.REDIRECT_FAILURE_CACHE_TIME + 1)
+
+    # ...and refetched when they expire
+    cache['R http://sho.rt/bad']['expires'] = now - 1
+    util.follow_redirects_cache.clear()
+    self.assertEqual({}, as1.resolve_redirects(['http://sho.rt/bad'], cache=cache))
+
+  def test_resolve_redirects_no_cache(self):
+    self.expect_requests_head('http://sho.rt/post', redirected_url='http://or.ig/post')
+    self.mox.ReplayAll()
+
+    self.assertEqual({'http://sho.rt/post': 'http://or.ig/post'},
+                     as1.resolve_redirects(['http://sho.rt/post']))
+
+  def test_original_post_discovery_batch(self):
+    # test_source imports this module
+    from .test_source import serialize_http_mocks
+
+    self.expect_requests_head('http://sho.rt/post', redirected_url='http://or.ig/post'
+                              ).InAnyOrder()
+    self.expect_requests_head('http://other/link').InAnyOrder()
+    self.expect_requests_head('http://next/post').InAnyOrder()
+    self.mox.ReplayAll()
+    serialize_http_mocks(self)
+
+    activities = [{
+      'object': {'content': 'asdf http://sho.rt/post qwert'},
+    }, {
+      'object': {'content': 'asdf http://other/link qwert',
+                 'upstreamDuplicates': ['http://sho.rt/post', 'http://next/post']},
+    }]
+    (orig1, mentions1), (orig2, mentions2) = as1.original_post_discovery_batch(
+      activities, domains=['or.ig', 'next'], max_workers=3)
+    self.assert_equals(['http://or.ig/post', 'http://sho.rt/post'], orig1)
+    self.assert_equals([], mentions1)
+    self.assert_equals(['http://or.ig/post', 'http://sho.rt/post', 'http://next/post'],
+                       orig2)
+    self.assert_equals(['http://other/link'], mentions2)
+
   def test_original_post_discovery_excludes(self):
     """Should exclude reserved hosts, non-http(s) URLs, and missing domains."""
     obj = {
@@ -1,6 +1,8 @@
 # coding=utf-8
 """Unit tests for atom.py."""
 import copy
+import io
+from xml.etree import ElementTree
 
 from mox3 import mox
 from oauth_dropins.webutil import testutil
@@ -126,6 +128,23 @@ class AtomTest(testutil.TestCase):
           ),
           ignore_blanks=True)
 
+  def test_iter_activities_to_atom(self):
+    def activities():
+      for i in range(3):
+        activity = copy.deepcopy(test_twitter.ACTIVITY)
+        activity['object']['content'] = 'x' * atom.STREAM_CHUNK_SIZE
+        yield activity
+
+    expected = atom.activities_to_atom(list(activities()), test_twitter.ACTOR)
+    chunks = list(atom.iter_activities_to_atom(activities(), test_twitter.ACTOR))
+    self.assertGreater(len(chunks), 3)
+    self.assertEqual(expected, ''.join(chunks))
+
+  def test_iter_activities_to_atom_empty(self):
+    self.assertEqual(atom.activities_to_atom([], test_twitter.ACTOR),
+                     ''.join(atom.iter_activities_to_atom(
+                       iter(()), test_twitter.ACTOR)))
+
   def test_activity_to_atom(self):
     self.assert_multiline_equals(
       INSTAGRAM_ENTRY,
@@ -140,6 +159,27 @@ class AtomTest(testutil.TestCase):
     self.assert_equals([INSTAGRAM_ACTIVITY],
                        atom.atom_to_activities(INSTAGRAM_FEED))
 
+  def test_iter_atom_to_activities(self):
+    start = INSTAGRAM_FEED.index('<entry>')
+    end = INSTAGRAM_FEED.index('</entry>') + len('</entry>')
+    entry = INSTAGRAM_FEED[start:end]
+    body = (INSTAGRAM_FEED[:end] + entry * 2 + INSTAGRAM_FEED[end:]).encode()
+
+    chunks = [body[i:i + 100] for i in range(0, len(body), 100)]
+    self.assert_equals([INSTAGRAM_ACTIVITY] * 3,
+                       list(atom.iter_atom_to_activities(chunks)))
+    self.assert_equals([INSTAGRAM_ACTIVITY] * 3,
+                       list(atom.iter_atom_to_activities(io.BytesIO(body))))
+
+  def test_iter_atom_to_activities_not_feed(self):
+    with self.assertRaises(ValueError):
+      list(atom.iter_atom_to_activities(INSTAGRAM_ENTRY))
+
+  def test_iter_atom_to_activities_truncated(self):
+    gen = atom.iter_atom_to_activities(INSTAGRAM_FEED[:-20])
+    with self.assertRaises(ElementTree.ParseError):
+      list(gen)
+
   def test_atom_to_activity_like(self):
     for atom_obj, as_obj in (
         ('foo', {'id': 'foo', 'url': 'foo'}),
@@ -863,6 +903,16 @@ going to Homebrew Website Club
     self.assertEqual(empty, d['g']['3'][2]['9'])
     self.assertEqual(empty, d['g']['3'][2]['7'][0]['9'])
 
+  def test_defaulting_environment(self):
+    template = atom.jinja_env.from_string(
+      '{{ a.b }}|{{ a.x.y.z }}|{{ a["x"]["y"] }}|{{ a.c[0].d }}|{{ a.c[0].x.y }}|'
+      '{{ a.x is mapping }}|{{ "yes" if a.x else "no" }}|{{ a.n.x is defined }}')
+    a = {'b': 'B', 'c': [{'d': 'D'}], 'n': None}
+    orig = copy.deepcopy(a)
+    self.assertEqual('B|||D||True|no|False', template.render(a=a))
+    self.assertEqual(orig, a)
+    self.assertEqual({}, atom.EMPTY)
+
   def test_multiple_objects_uses_first(self):
     activity = {
       'objectType': 'activity',
@@ -0,0 +1,98 @@
+"""Unit tests for bench.py."""
+import contextlib
+import copy
+import io
+import os
+import tempfile
+
+from oauth_dropins.webutil import testutil
+from oauth_dropins.webutil.util import json_loads
+
+from .. import atom, bench
+
+
+class BenchTest(testutil.TestCase):
+
+  def test_synthetic_activities(self):
+    activities = bench.synthetic_activities(5)
+    self.assertEqual(5, len(activities))
+    self.assertEqual([f'https://bench/{i}' for i in range(5)],
+                     [a['object']['id'] for a in activities])
+
+  def test_benchmark_run(self):
+    calls = []
+    result = bench.Benchmark('foo', calls.append, lambda: ([],), items=3).run(
+      min_time=0)
+    self.assertEqual(2, len(calls))  # one timed, one for memory
+    self.assertAlmostEqual(result['ops_per_sec'] * 3, result['items_per_sec'])
+    self.assertGreaterEqual(result['peak_kb'], 0)
+
+  def test_scrape_benchmarks(self):
+    names = [b.name for b in bench.scrape_benchmarks()]
+    self.assertEqual(['scrape/facebook.merge_scraped_reactions/full',
+                      'scrape/facebook.merge_scraped_reactions/targeted'], names)
+
+  def test_check_scrapers(self):
+    self.assertEqual([], bench.check_scrapers())
+
+  def test_defaulter_activities_to_atom(self):
+    activities = bench.synthetic_activities(5)
+    self.assertEqual(
+      atom.activities_to_atom(copy.deepcopy(activities), bench.ACTOR,
+                              title='Bench', host_url='https://bench/'),
+      bench._defaulter_activities_to_atom(activities, bench.ACTOR))
+
+  def test_compare(self):
+    baseline = {
+      'a': {'ops_per_sec': 100, 'peak_kb': 10},
+      'b': {'ops_per_sec': 100, 'peak_kb': 10},
+      'c': {'ops_per_sec': 100, 'peak_kb': 10},
+    }
+    self.assertEqual([
+      'b: 20.0% slower',
+      'c: 50.0% more peak memory',
+    ], bench.compare({
+      'a': {'ops_per_sec': 95, 'peak_kb': 10.5},
+      'b': {'ops_per_sec': 80, 'peak_kb': 10},
+      'c': {'ops_per_sec': 100, 'peak_kb': 15},
+      'new': {'ops_per_sec': 1, 'peak_kb': 1000},
+    }, baseline, threshold=.1))
+
+  def test_main_save_and_compare(self):
+    with tempfile.TemporaryDirectory() as dir:
+      path = os.path.join(dir, 'baseline.json')
+      args = ['--sizes', '3', '--filter', '^feed-3/as2', '--min-time', '0']
+
+      with contextlib.redirect_stdout(io.StringIO()) as out:
+        self.assertEqual(0, bench.main(args + ['--save', path]))
+      self.assertIn('feed-3/as2.from_as1', out.getvalue())
+
+      with open(path) as f:
+        results = json_loads(f.read())['results']
+      self.assertEqual({'feed-3/as2.from_as1', 'feed-3/as2.to_as1'},
+                       set(results))
+
+      # make the baseline impossibly fast so that we regress
+      for result in results.values():
+        result['ops_per_sec'] *= 1000
+      with open(path, 'w') as f:
+        f.write(bench.json_dumps({'results': results}))
+
+      with contextlib.redirect_stdout(io.StringIO()) as out:
+        self.assertEqual(1, bench.main(args + ['--compare', path]))
+      self.assertIn('Regressions:', out.getvalue())
+
+  def test_main_reports_errors(self):
+    def fail(feed):
+      raise ValueError('bad feed')
+
+    self.mox.stubs.Set(bench, 'feed_benchmarks', lambda size: [
+      bench.Benchmark('feed-3/fails', fail, lambda: ([],)),
+      bench.Benchmark('feed-3/works', lambda feed: None, lambda: ([],)),
+    ])
+
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+      self.assertEqual(1, bench.main(['--sizes', '3', '--filter', '^feed-3/',
+                                      '--min-time', '0']))
+    self.assertIn('feed-3/works', out.getvalue())
+    self.assertIn('feed-3/fails: ValueError: bad feed', out.getvalue())
@@ -0,0 +1,106 @@
+# coding=utf-8
+"""Unit tests for caches.py."""
+import os
+import tempfile
+import time
+
+from oauth_dropins.webutil import testutil
+
+from .. import caches
+
+
+class CachesTest(testutil.TestCase):
+
+  def test_memory_cache(self):
+    cache = caches.MemoryCache(maxsize=2)
+    cache['a'] = 1
+    cache['b'] = 2
+    self.assertEqual(1, cache['a'])
+    cache['c'] = 3  # evicts b, the least recently used
+    self.assertIsNone(cache.get('b'))
+    self.assertEqual(3, cache.get('c'))
+    self.assertEqual({'a', 'c'}, set(cache))
+    self.assertEqual({'hits': 2, 'misses': 1}, cache.stats())
+
+  def test_memory_cache_ttl(self):
+    cache = caches.MemoryCache(ttl=.01)
+    cache['a'] = 1
+    self.assertEqual(1, cache['a'])
+    time.sleep(.02)
+    self.assertNotIn('a', cache)
+
+  def test_sqlite_cache(self):
+    with tempfile.TemporaryDirectory() as dir:
+      path = os.path.join(dir, 'cache.db')
+      cache = caches.SqliteCache(path, maxsize=2)
+      cache.update({'a': 1, 'b': {'x': [2]}})
+      self.assertEqual(1, cache['a'])
+      cache['c'] = 3  # evicts b, the least recently used
+      self.assertEqual({'hits': 1, 'misses': 0}, cache.stats())
+      cache.close()
+
+      # persists across instances
+      cache = caches.SqliteCache(path, maxsize=2)
+      self.assertEqual({'a': 1, 'c': 3}, dict(cache))
+      del cache['a']
+      self.assertIsNone(cache.get('a'))
+      with self.assertRaises(KeyError):
+        del cache['a']
+      cache.close()
+
+  def test_sqlite_cache_ttl(self):
+    cache = caches.SqliteCache(ttl=.01)
+    cache['a'] = 1
+    self.assertEqual(1, cache['a'])
+    time.sleep(.02)
+    self.assertNotIn('a', cache)
+    self.assertEqual(0, len(cache))
+
+  def test_sqlite_cache_ttl_purges_without_maxsize(self):
+    cache = caches.SqliteCache(ttl=.01)
+    cache['a'] = 1
+    time.sleep(.02)
+    cache['b'] = 2
+    self.assertEqual([('b',)], cache._execute('SELECT key FROM {table}'))
+
+  def test_sqlite_cache_evicts_only_over_maxsize(self):
+    cache = caches.SqliteCache(maxsize=2)
+    evicts = []
+    evict = cache._evict
+    cache._evict = lambda now: evicts.append(now) or evict(now)
+
+    cache['a'] = 1
+    cache['b'] = 2
+    cache['b'] = 3  # overwrites, doesn't grow
+    self.assertEqual([], evicts)
+
+    cache['c'] = 4
+    self.assertEqual(1, len(evicts))
+    self.assertEqual({'b': 3, 'c': 4}, dict(cache))
+
+  def test_memcache_cache(self):
+    class FakeMemcacheClient:
+      """Local stand-in for a memcached client, eg pymemcache's."""
+      def __init__(self):
+        self.data = {}
+        self.expires = {}
+      def get(self, key):
+        assert ' ' not in key
+        return self.data.get(key)
+      def set(self, key, value, expire=0):
+        self.data[key] = value.encode()
+        self.expires[key] = expire
+      def delete(self, key):
+        self.data.pop(key, None)
+
+    client = FakeMemcacheClient()
+    cache = caches.MemcacheCache(client, ttl=60)
+    self.assertTrue(cache)
+    cache['ATR 123'] = 4
+    self.assertEqual({'granary:ATR%20123': b'4'}, client.data)
+    self.assertEqual({'granary:ATR%20123': 60}, client.expires)
+    self.assertEqual(4, cache['ATR 123'])
+    self.assertIsNone(cache.get('ATR 456'))
+    del cache['ATR 123']
+    self.assertNotIn('ATR 123', cache)
+    self.assertEqual({'hits': 1, 'misses': 2}, cache.stats())
@@ -12,6 +12,7 @@ import oauth_dropins.facebook
 from oauth_dropins.webutil import testutil
 from oauth_dropins.webutil import util
 from oauth_dropins.webutil.util import json_dumps, json_loads
+import requests
 
 from .. import facebook
 from ..facebook import (
@@ -33,10 +34,14 @@ from ..facebook import (
   M_HTML_BASE_URL,
   SCRAPE_USER_AGENT
 )
+from .. import httputil
+from .. import ratelimits
 from .. import source
+from .test_source import serialize_http_mocks
 
 API_ME_POSTS = API_SELF_POSTS % ('me', 0)
 API_ME_PHOTOS = API_PHOTOS_UPLOADED % 'me'
+API_ME_ALBUMS = API_ALBUMS % 'me'
 
 # test data
 def tag_uri(name):
@@ -1361,6 +1366,7 @@ class FacebookTest(testutil.TestCase):
     super(FacebookTest, self).setUp()
     self.fb = Facebook()
     self.fbscrape = Facebook(scrape=True, cookie_c_user='CU', cookie_xs='XS')
+    ratelimits.rate_limits.clear()
     self.mox.StubOutWithMock(facebook, 'now_fn')
 
   def expect_urlopen(self, url, response=None, **kwargs):
@@ -1369,6 +1375,31 @@ class FacebookTest(testutil.TestCase):
     return super(FacebookTest, self).expect_urlopen(
       url, response=json_dumps(response), **kwargs)
 
+  def expect_batch(self, *reqs):
+    """Expects a batch API call.
+
+    Args:
+      reqs: (request, response) tuples. request may be a string relative URL
+        or a dict request in Facebook's batch format. response may be a
+        (status code, body) tuple or just a body, which defaults to status 200.
+    """
+    batch = []
+    resps = []
+    for req, resp in reqs:
+      if not isinstance(req, dict):
+        req = {'relative_url': req}
+      batch.append({'method': 'GET', **req})
+      code, body = resp if isinstance(resp, tuple) else (200, resp)
+      resps.append({'code': code, 'body': json_dumps(body)})
+
+    return self.expect_urlopen(
+      '', data='batch=' + json_dumps(batch, sort_keys=True), response=resps)
+
+  def expect_self(self, posts, photos={}, albums={}, *extras):
+    """Expects the @self feed batch API call."""
+    self.expect_batch((API_ME_POSTS, posts), (API_ME_PHOTOS, photos),
+                      (API_ME_ALBUMS, albums), *extras)
+
   def expect_requests_get(self, url, resp='', cookie=None, **kwargs):
     kwargs.setdefault('allow_redirects', False)
     # override user agent for facebook scraping (specific to facebook tests)
@@ -1434,6 +1465,15 @@ class FacebookTest(testutil.TestCase):
     self.assertNotIn('tags', got[1])
     self.assertNotIn('tags', got[1]['object'])
 
+  def test_get_activities_skips_extras_when_rate_limited(self):
+    self.expect_urlopen('me/home?offset=0', {'data': [POST]}, response_headers={
+      'X-App-Usage': '{"call_count": 100, "total_cputime": 25, "total_time": 25}',
+    })
+    self.mox.ReplayAll()
+
+    got = self.fb.get_activities(fetch_shares=True, fetch_replies=True)
+    self.assertEqual(1, len(got))
+
   def test_get_activities_home_returns_bool(self):
     self.expect_urlopen('me/home?offset=0', True)
     self.mox.ReplayAll()
@@ -1458,15 +1498,13 @@ class FacebookTest(testutil.TestCase):
     self.assertNotIn('tags', got[0])
 
   def test_get_activities_self_empty(self):
-    self.expect_urlopen(API_ME_POSTS, {})
-    self.expect_urlopen(API_ME_PHOTOS, {})
+    self.expect_self({})
     self.mox.ReplayAll()
     self.assert_equals([], self.fb.get_activities(group_id=source.SELF))
 
   def test_get_activities_self_photo_and_event(self):
-    self.expect_urlopen(API_ME_POSTS, {'data': [PHOTO_POST]})
-    self.expect_urlopen(API_ME_PHOTOS, {'data': [PHOTO]})
-    self.expect_urlopen(API_USER_EVENTS, {'data': [EVENT]})
+    self.expect_self({'data': [PHOTO_POST]}, {'data': [PHOTO]}, {},
+                     (API_USER_EVENTS, {'data': [EVENT]}))
 
     self.mox.ReplayAll()
     self.assert_equals(
@@ -1475,7 +1513,7 @@ class FacebookTest(testutil.TestCase):
 
   def test_get_activities_self_merge_photos(self):
     """https://github.com/snarfed/bridgy/issues/562"""
-    self.expect_urlopen(API_ME_POSTS, {'data': [
+    self.expect_self({'data': [
       {'id': '1', 'object_id': '11',   # has photo but no album
        'privacy': {'value': 'EVERYONE'}},
       {'id': '3', 'object_id': '33'},  # has photo but no album
@@ -1484,16 +1522,14 @@ class FacebookTest(testutil.TestCase):
        'privacy': {'value': 'CUSTOM'}},
       {'id': '7', 'object_id': '77',   # ditto, and photo has no album
        'privacy': {'value': 'CUSTOM'}},
-    ]})
-    self.expect_urlopen(API_ME_PHOTOS, {'data': [
+    ]}, {'data': [
       {'id': '11'},
       {'id': '22', 'album': {'id': '222'}},  # no matching post
       {'id': '33', 'album': {'id': '333'}},  # no matching album
       {'id': '44', 'album': {'id': '444'}},  # no matching post or album
       {'id': '66', 'album': {'id': '666'}},  # consolidated posts...
       {'id': '77'},
-    ]})
-    self.expect_urlopen(API_ALBUMS % 'me', {'data': [
+    ]}, {'data': [
       {'id': '222', 'privacy': 'friends'},   # no post
       {'id': '666', 'privacy': 'everyone'},  # consolidated post
     ]})
@@ -1511,43 +1547,56 @@ class FacebookTest(testutil.TestCase):
         for activity in self.fb.get_activities(group_id=source.SELF)])
 
   def test_get_activities_user_id_merge_photos(self):
-    self.expect_urlopen(API_SELF_POSTS % ('567', 0), {'data': []})
-    self.expect_urlopen(API_PHOTOS_UPLOADED % '567', {'data': [
-      {'album': {'id': '222'}},
-    ]})
-    self.expect_urlopen(API_ALBUMS % '567', {'data': []})
+    self.expect_batch((API_SELF_POSTS % ('567', 0), {'data': []}),
+                      (API_PHOTOS_UPLOADED % '567', {'data': [
+                        {'album': {'id': '222'}},
+                      ]}),
+                      (API_ALBUMS % '567', {'data': []}))
 
     self.mox.ReplayAll()
     self.assert_equals([], self.fb.get_activities(user_id='567', group_id=source.SELF))
 
+  def test_get_activities_self_etag(self):
+    self.expect_urlopen('', data=mox.IgnoreArg(), response=[
+      {'code': 304, 'headers': [{'name': 'ETag', 'value': '"new"'}]},
+      {'code': 200, 'body': '{}'},
+      {'code': 200, 'body': '{}'},
+    ]).WithSideEffects(lambda req, **kwargs: self.assertIn(
+      '"headers":[{"name":"If-None-Match","value":"\\"old\\""}]',
+      urllib.parse.unquote(req.data)))
+    self.mox.ReplayAll()
+
+    resp = self.fb.get_activities_response(group_id=source.SELF, etag='"old"')
+    self.assert_equals([], resp['items'])
+    self.assertEqual('"new"', resp['etag'])
+
+  def test_get_activities_self_photos_error(self):
+    self.expect_self({}, (500, 'boom'))
+    self.mox.ReplayAll()
+    with self.assertRaises(urllib.error.HTTPError):
+      self.fb.get_activities(group_id=source.SELF)
+
   def test_get_activities_self_photos_returns_list(self):
-    self.expect_urlopen(API_ME_POSTS, {})
-    self.expect_urlopen(API_ME_PHOTOS, [])
+    self.expect_self({}, [])
     self.mox.ReplayAll()
     self.assert_equals([], self.fb.get_activities(group_id=source.SELF))
 
   def test_get_activities_self_owned_event_rsvps(self):
-    self.expect_urlopen(API_ME_POSTS, {})
-    self.expect_urlopen(API_ME_PHOTOS, {})
-    self.expect_urlopen(API_USER_EVENTS, {'data': [EVENT]})
+    self.expect_self({}, {}, {}, (API_USER_EVENTS, {'data': [EVENT]}))
 
     self.mox.ReplayAll()
     self.assert_equals([EVENT_ACTIVITY], self.fb.get_activities(
       group_id=source.SELF, fetch_events=True, event_owner_id=EVENT['owner']['id']))
 
   def test_get_activities_self_unowned_event_no_rsvps(self):
-    self.expect_urlopen(API_ME_POSTS, {})
-    self.expect_urlopen(API_ME_PHOTOS, {})
-    self.expect_urlopen(API_USER_EVENTS, {'data': [EVENT]})
+    self.expect_self({}, {}, {}, (API_USER_EVENTS, {'data': [EVENT]}))
 
     self.mox.ReplayAll()
     self.assert_equals([], self.fb.get_activities(
       group_id=source.SELF, fetch_events=True, event_owner_id='xyz'))
 
   def test_get_activities_self_events_returns_list(self):
-    self.expect_urlopen(API_ME_POSTS, {})
-    self.expect_urlopen(API_ME_PHOTOS, {})
-    self.expect_urlopen(API_USER_EVENTS, [])
+    self.expect_self({}, {}, {}, (API_USER_EVENTS, []))
     self.mox.ReplayAll()
     self.assert_equals([], self.fb.get_activities(
       group_id=source.SELF, fetch_events=True))
@@ -1659,15 +1708,26 @@ class FacebookTest(testutil.TestCase):
       self.assertNotIn('tags', activity)
       self.assertNotIn('tags', activity['object'])
 
+  def test_get_activities_sharedposts_400_in_batch(self):
+    self.expect_urlopen('me/home?offset=0', {'data': [{'id': '1_2'}]})
+    self.expect_batch((API_SHARES % '1_2', (400, {})),
+                      (API_COMMENTS_ALL % '1_2', {'1_2': {'data': COMMENTS}}))
+    self.mox.ReplayAll()
+
+    got = self.fb.get_activities(fetch_shares=True, fetch_replies=True)
+    self.assertNotIn('tags', got[0]['object'])
+    self.assertEqual(len(COMMENTS), len(got[0]['object']['replies']['items']))
+
   def test_get_activities_too_many_ids(self):
     ids = ['1', '2', '3', '4', '5']
     self.expect_urlopen('me/home?offset=0', {'data': [{'id': id} for id in ids]})
-    self.expect_urlopen(API_SHARES % '1,2', {'1': {'data': [{'id': '222'}]}})
-    self.expect_urlopen(API_SHARES % '3,4', {'2': {'data': [{'id': '444'}]}})
-    self.expect_urlopen(API_SHARES % '5', {})
-    self.expect_urlopen(API_COMMENTS_ALL % '1,2', {'1': {'data': [{'id': '111'}]}})
-    self.expect_urlopen(API_COMMENTS_ALL % '3,4', {'1': {'data': [{'id': '333'}]}})
-    self.expect_urlopen(API_COMMENTS_ALL % '5', {})
+    self.expect_batch(
+      (API_SHARES % '1,2', {'1': {'data': [{'id': '222'}]}}),
+      (API_SHARES % '3,4', {'2': {'data': [{'id': '444'}]}}),
+      (API_SHARES % '5', {}),
+      (API_COMMENTS_ALL % '1,2', {'1': {'data': [{'id': '111'}]}}),
+      (API_COMMENTS_ALL % '3,4', {'1': {'data': [{'id': '333'}]}}),
+      (API_COMMENTS_ALL % '5', {}))
     self.mox.ReplayAll()
 
     try:
@@ -1724,8 +1784,7 @@ class FacebookTest(testutil.TestCase):
     post = {'id': '1', 'status_type': 'shared_story'}
     activity = self.fb.post_to_activity(post)
 
-    self.expect_urlopen(API_ME_POSTS, {'data': [post]})
-    self.expect_urlopen(API_ME_PHOTOS, {})
+    self.expect_self({'data': [post]})
     self.mox.ReplayAll()
     self.assert_equals([activity], self.fb.get_activities(group_id=source.SELF))
 
@@ -1762,24 +1821,18 @@ class FacebookTest(testutil.TestCase):
     self.assert_equals([activity], self.fb.get_activities(fetch_replies=True))
 
   def test_get_activities_skips_extras_if_no_posts(self):
-    self.expect_urlopen(API_ME_POSTS, {'data': []})
-    self.expect_urlopen(API_ME_PHOTOS, {})
+    self.expect_self({'data': []})
     self.mox.ReplayAll()
     self.assert_equals([], self.fb.get_activities(
       group_id=source.SELF, fetch_shares=True, fetch_replies=True))
 
   def test_get_activities_extras_skips_notes_includes_links(self):
     # first call returns just notes
-    self.expect_urlopen(API_ME_POSTS,
-                        {'data': [FB_NOTE, FB_CREATED_NOTE]})
-    self.expect_urlopen(API_ME_PHOTOS, {})
+    self.expect_self({'data': [FB_NOTE, FB_CREATED_NOTE]})
 
     # second call returns notes and link
-    self.expect_urlopen(API_ME_POSTS,
-                        {'data': [FB_NOTE, FB_CREATED_NOTE, FB_LINK]})
-    self.expect_urlopen(API_ME_PHOTOS, {})
-    self.expect_urlopen(API_SHARES % '555', [])
-    self.expect_urlopen(API_COMMENTS_ALL % '555', {})
+    self.expect_self({'data': [FB_NOTE, FB_CREATED_NOTE, FB_LINK]})
+    self.expect_batch((API_SHARES % '555', []), (API_COMMENTS_ALL % '555', {}))
 
     self.mox.ReplayAll()
 
@@ -1789,13 +1842,13 @@ class FacebookTest(testutil.TestCase):
         group_id=source.SELF, fetch_shares=True, fetch_replies=True))
 
   def test_get_activities_matches_extras_with_correct_activity(self):
-    self.expect_urlopen(API_ME_POSTS, {'data': [POST]})
-    self.expect_urlopen(API_ME_PHOTOS, {})
-    self.expect_urlopen(API_USER_EVENTS, {'data': [EVENT]})
-    self.expect_urlopen(API_SHARES % '212038_10100176064482163',
-                        {'212038_10100176064482163': {'data': [SHARE]}})
-    self.expect_urlopen(API_COMMENTS_ALL % '212038_10100176064482163',
-                        {'212038_10100176064482163': {'data': COMMENTS}})
+    self.expect_self({'data': [POST]}, {}, {},
+                     (API_USER_EVENTS, {'data': [EVENT]}))
+    self.expect_batch(
+      (API_SHARES % '212038_10100176064482163',
+       {'212038_10100176064482163': {'data': [SHARE]}}),
+      (API_COMMENTS_ALL % '212038_10100176064482163',
+       {'212038_10100176064482163': {'data': COMMENTS}}))
 
     self.mox.ReplayAll()
     activity = copy.deepcopy(ACTIVITY)
@@ -1804,9 +1857,8 @@ class FacebookTest(testutil.TestCase):
       group_id=source.SELF, fetch_events=True, fetch_shares=True, fetch_replies=True))
 
   def test_get_activities_self_fetch_news(self):
-    self.expect_urlopen(API_ME_POSTS, {'data': [POST]})
-    self.expect_urlopen(API_NEWS_PUBLISHES % 'me', {'data': [FB_NEWS_PUBLISH]})
-    self.expect_urlopen(API_ME_PHOTOS, {})
+    self.expect_self({'data': [POST]}, {}, {},
+                     (API_NEWS_PUBLISHES % 'me', {'data': [FB_NEWS_PUBLISH]}))
     # should only fetch sharedposts for POST, not FB_NEWS_PUBLISH
     self.expect_urlopen(API_SHARES % '212038_10100176064482163', {})
 
@@ -1816,9 +1868,10 @@ class FacebookTest(testutil.TestCase):
     self.assert_equals([ACTIVITY, FB_NEWS_PUBLISH_ACTIVITY], got)
 
   def test_get_activities_user_id_fetch_news(self):
-    self.expect_urlopen(API_SELF_POSTS % ('567', 0), {'data': []})
-    self.expect_urlopen(API_NEWS_PUBLISHES % '567', {'data': [FB_NEWS_PUBLISH]})
-    self.expect_urlopen(API_PHOTOS_UPLOADED % '567', {})
+    self.expect_batch((API_SELF_POSTS % ('567', 0), {'data': []}),
+                      (API_PHOTOS_UPLOADED % '567', {}),
+                      (API_ALBUMS % '567', {}),
+                      (API_NEWS_PUBLISHES % '567', {'data': [FB_NEWS_PUBLISH]}))
 
     self.mox.ReplayAll()
     got = self.fb.get_activities(group_id=source.SELF, user_id='567', fetch_news=True)
@@ -1897,6 +1950,53 @@ class FacebookTest(testutil.TestCase):
                                               fetch_replies=True, fetch_likes=True)
     self.assert_equals(expected, activities)
 
+  def test_get_activities_scrape_fetch_replies_likes_concurrently_cached(self):
+    # mox mocks aren't thread safe
+    self.mox.stubs.Set(facebook, 'now_fn', lambda: datetime(1999, 1, 1))
+
+    for i in range(2):
+      self.expect_requests_get('212038?v=timeline', MBASIC_HTML_TIMELINE,
+                               cookie='c_user=CU; xs=XS')
+      if i == 0:
+        # second poll, posts are unchanged, so they're not refetched
+        for id, html in (('123', MBASIC_HTML_POST.replace('456', '123')),
+                         ('456', MBASIC_HTML_POST)):
+          self.expect_requests_get(id, html, cookie='c_user=CU; xs=XS').InAnyOrder()
+          self.expect_requests_get(
+            f'ufi/reaction/profile/browser/?ft_ent_identifier={id}',
+            MBASIC_HTML_REACTIONS, cookie='c_user=CU; xs=XS',
+          ).InAnyOrder()
+    self.mox.ReplayAll()
+    serialize_http_mocks(self)
+
+    fb = Facebook(scrape=True, cookie_c_user='CU', cookie_xs='XS',
+                  max_workers=2, scrape_cache={})
+    fb.session = requests  # route through the mocked out requests functions
+
+    expected = copy.deepcopy(MBASIC_ACTIVITIES_REPLIES_REACTIONS)
+    obj_123 = expected[0]['object']
+    obj_456 = expected[1]['object']
+    del obj_123['published']
+    obj_456.pop('fb_reaction_count', None)
+    obj_123['content'] = obj_456['content']
+    obj_123['to'] = obj_456['to']
+
+    for _ in range(2):
+      self.assert_equals(expected, fb.get_activities(
+        user_id='212038', group_id=source.SELF, fetch_replies=True,
+        fetch_likes=True))
+    self.assertEqual(4, len(fb.scrape_cache))
+
+  def test_scraped_fingerprint(self):
+    activity = copy.deepcopy(MBASIC_FEED_ACTIVITIES[0])
+    fingerprint = Facebook._scraped_fingerprint(activity)
+
+    activity['object']['published'] = '2000-01-01T00:00:00'
+    self.assertEqual(fingerprint, Facebook._scraped_fingerprint(activity))
+
+    activity['object']['replies'] = {'totalItems': 99}
+    self.assertNotEqual(fingerprint, Facebook._scraped_fingerprint(activity))
+
   def test_get_activities_scrape_post(self):
     facebook.now_fn().MultipleTimes().AndReturn(datetime(1999, 1, 1))
     self.expect_requests_get('456', MBASIC_HTML_POST, cookie='c_user=CU; xs=XS',
@@ -1971,6 +2071,12 @@ class FacebookTest(testutil.TestCase):
     self.mox.ReplayAll()
     self.assertIsNone(self.fb.get_share('1', '2', '78'))
 
+  def test_get_share_missing_with_user_id_prefix(self):
+    # doesn't fetch the share object unless it's in the shares list
+    self.expect_urlopen(API_SHARES % '1_2', {'1_2': {'data': [{'id': '34_56'}]}})
+    self.mox.ReplayAll()
+    self.assertIsNone(self.fb.get_share('1', '2', '34_78'))
+
   def test_get_share_400s(self):
     self.expect_urlopen(API_SHARES % '1_2', {}, status=400)
     self.mox.ReplayAll()
@@ -3242,6 +3348,40 @@ cc Sam G, Michael M<br />""", preview.description)
         {'relative_url': 'abc', 'headers': {'X': 'Y', 'U': 'V'}},
         {'relative_url': 'def'})))
 
+  def test_urlopen_batch_full_conditional_replays_304(self):
+    self.expect_urlopen('',
+      data='batch=[{"method":"GET","relative_url":"abc"},'
+                  '{"method":"GET","relative_url":"def"}]',
+      response=[{'code': 200, 'body': '{"a": 1}',
+                 'headers': [{'name': 'ETag', 'value': '"xyz"'}]},
+                {'code': 200, 'body': '{"d": 2}'}])
+    self.expect_urlopen('',
+      data='batch=[{"headers":[{"name":"If-None-Match","value":"\\"xyz\\""}],'
+                   '"method":"GET","relative_url":"abc"},'
+                  '{"method":"GET","relative_url":"def"}]',
+      response=[{'code': 304}, {'code': 200, 'body': '{"d": 3}'}])
+    self.mox.ReplayAll()
+
+    self.fb.validators = httputil.ValidatorStore()
+    for d in 2, 3:
+      self.assert_equals([{'a': 1}, {'d': d}], [
+        resp['body'] for resp in self.fb.urlopen_batch_full(
+          [{'relative_url': 'abc'}, {'relative_url': 'def'}])])
+
+  def test_urlopen_batch_full_chunks(self):
+    self.expect_urlopen('',
+      data='batch=[{"method":"GET","relative_url":"a"},'
+                  '{"method":"GET","relative_url":"b"}]',
+      response=[{'code': 200, 'body': '1'}, {'code': 200, 'body': '2'}])
+    self.expect_urlopen('',
+      data='batch=[{"method":"GET","relative_url":"c"}]',
+      response=[{'code': 200, 'body': '3'}])
+    self.mox.ReplayAll()
+
+    self.mox.stubs.Set(facebook, 'MAX_BATCH', 2)
+    self.assert_equals([1, 2, 3], [r['body'] for r in self.fb.urlopen_batch_full(
+      [{'relative_url': 'a'}, {'relative_url': 'b'}, {'relative_url': 'c'}])])
+
   def test_urlopen_batch_full_errors(self):
     resps = [{'code': 501},
              {'code': 499, 'body': 'error body'}]
@@ -3334,6 +3474,14 @@ cc Sam G, Michael M<br />""", preview.description)
     got, _ = self.fb.scraped_to_activities(str(soup))
     self.assert_equals(expected, got)
 
+  def test_scraped_to_activities_soup(self):
+    facebook.now_fn().MultipleTimes().AndReturn(datetime(1999, 1, 1))
+    self.mox.ReplayAll()
+
+    soup = util.parse_html(MBASIC_HTML_TIMELINE, features='lxml')
+    got, _ = self.fb.scraped_to_activities(soup)
+    self.assert_equals(MBASIC_FEED_ACTIVITIES, got)
+
   def test_scraped_to_activities_profile(self):
     """mbasic.facebook.com HTML profile.
 
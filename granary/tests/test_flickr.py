@@ -14,6 +14,7 @@ import requests
 
 from .. import flickr
 from .. import source
+from .test_source import serialize_http_mocks
 
 # test data
 def tag_uri(name):
@@ -673,6 +674,120 @@ class FlickrTest(testutil.TestCase):
       [ACTIVITY_WITH_FAVES], self.flickr.get_activities(
         activity_id='5227922370', fetch_likes=True))
 
+  def test_get_activities_extras_concurrently(self):
+    self.expect_call_api_method(
+      'flickr.photos.getContactsPhotos', {
+        'extras': flickr.Flickr.API_EXTRAS,
+        'per_page': 50,
+      }, json_dumps(CONTACTS_PHOTOS))
+    for id in '1234', '2345':
+      self.expect_call_api_method('flickr.photos.comments.getList', {
+        'photo_id': id,
+      }, json_dumps(PHOTO_COMMENTS)).InAnyOrder()
+      self.expect_call_api_method('flickr.photos.getFavorites', {
+        'photo_id': id,
+      }, json_dumps(PHOTO_FAVORITES)).InAnyOrder()
+    self.mox.ReplayAll()
+    serialize_http_mocks(self)
+
+    fl = flickr.Flickr('key', 'secret', max_workers=2)
+    got = fl.get_activities(fetch_replies=True, fetch_likes=True)
+    self.assertEqual(['tag:flickr.com:1234', 'tag:flickr.com:2345'],
+                     [a['id'] for a in got])
+    for activity in got:
+      self.assertEqual(1, activity['object']['replies']['totalItems'])
+      self.assertEqual(1, len([t for t in activity['object']['tags']
+                               if t.get('verb') == 'like']))
+
+  def test_get_activities_use_activity_api(self):
+    self.expect_call_api_method(
+      'flickr.people.getPhotos', {
+        'extras': flickr.Flickr.API_EXTRAS,
+        'per_page': 50,
+        'user_id': 'me',
+      }, json_dumps(CONTACTS_PHOTOS))
+
+    def user_photos(page, pages, items):
+      self.expect_call_api_method('flickr.activity.userPhotos', {
+        'timeframe': flickr.ACTIVITY_TIMEFRAME,
+        'per_page': flickr.ACTIVITY_PER_PAGE,
+        'page': page,
+      }, json_dumps({'items': {'page': page, 'pages': pages, 'item': items},
+                     'stat': 'ok'}))
+
+    user_photos(1, 2, [{
+      'type': 'photo',
+      'id': '1234',
+      'owner': '5555',
+      'activity': {'event': [{
+        'type': 'comment',
+        'commentid': '5555-1234-789',
+        'user': '36398523@N00',
+        'username': 'if winter ends',
+        'realname': 'Dusty',
+        'iconserver': '108',
+        'iconfarm': 1,
+        'dateadded': '1295288643',
+        '_content': 'Love this!',
+      }, {
+        'type': 'note',
+        'user': '36398523@N00',
+      }]},
+    }])
+    user_photos(2, 2, [{
+      'type': 'photo',
+      'id': '2345',
+      'owner': '6666',
+      'activity': {'event': [{
+        'type': 'fave',
+        'user': '95922884@N00',
+        'username': 'absentmindedprof',
+        'realname': 'Jennifer',
+        'iconserver': '5343',
+        'iconfarm': 6,
+        'dateadded': '1291599546',
+      }]},
+    }])
+    self.mox.ReplayAll()
+
+    got = self.flickr.get_activities(group_id=source.SELF, fetch_replies=True,
+                                     fetch_likes=True, use_activity_api=True)
+
+    self.assert_equals([{
+      'objectType': 'comment',
+      'id': tag_uri('5555-1234-789'),
+      'url': 'https://www.flickr.com/photos/5555/1234/#comment789',
+      'inReplyTo': [{'id': tag_uri('1234')}],
+      'content': 'Love this!',
+      'published': '2011-01-17T18:24:03+00:00',
+      'updated': '2011-01-17T18:24:03+00:00',
+      'author': {
+        'objectType': 'person',
+        'id': tag_uri('36398523@N00'),
+        'displayName': 'Dusty',
+        'username': 'if winter ends',
+        'image': {'url': 'https://farm1.staticflickr.com/108/buddyicons/36398523@N00.jpg'},
+        'url': 'https://www.flickr.com/people/36398523@N00/',
+      },
+    }], got[0]['object']['replies']['items'])
+    self.assertEqual({'totalItems': 0}, got[1]['object']['replies'])
+
+    likes = [t for t in got[1]['object']['tags'] if t.get('verb') == 'like']
+    self.assert_equals([{
+      'objectType': 'activity',
+      'verb': 'like',
+      'id': tag_uri('2345_liked_by_95922884@N00'),
+      'url': 'https://www.flickr.com/photos/6666/2345/#liked-by-95922884@N00',
+      'object': {'url': 'https://www.flickr.com/photos/6666/2345/'},
+      'author': {
+        'objectType': 'person',
+        'id': tag_uri('95922884@N00'),
+        'username': 'absentmindedprof',
+        'displayName': 'Jennifer',
+        'image': {'url': 'https://farm6.staticflickr.com/5343/buddyicons/95922884@N00.jpg'},
+      },
+    }], likes)
+
   def test_favorite_without_display_name(self):
     """Make sure faves fall back to the username if the user did not
     supply a real name.
@@ -1,6 +1,7 @@
 # coding=utf-8
 """Unit tests for github.py.
 """
+import asyncio
 import copy
 from unittest import skip
 
@@ -22,7 +23,10 @@ from ..github import (
   REST_NOTIFICATIONS,
   REST_REACTIONS,
 )
+from .. import httputil
+from .. import ratelimits
 from .. import source
+from .test_source import mock_async_client, requires_httpx
 
 # test data
 def tag_uri(name):
@@ -361,6 +365,7 @@ class GitHubTest(testutil.TestCase):
   def setUp(self):
     super(GitHubTest, self).setUp()
     self.gh = github.GitHub('a-towkin')
+    ratelimits.rate_limits.clear()
     self.batch = []
     self.batch_responses = []
 
@@ -508,6 +513,152 @@ class GitHubTest(testutil.TestCase):
     self.assert_equals([pull_obj, ISSUE_OBJ_WITH_REACTIONS],
                        self.gh.get_activities(fetch_likes=True))
 
+  def test_get_activities_use_graphql(self):
+    deleted = copy.deepcopy(NOTIFICATION_ISSUE_REST)
+    deleted['subject']['url'] = 'https://api.github.com/repos/foo/bar/issues/999'
+    self.expect_rest(REST_NOTIFICATIONS, [NOTIFICATION_PULL_REST,
+                                          NOTIFICATION_ISSUE_REST, deleted],
+                     headers={'If-Modified-Since': 'Thu, 25 Oct 2012 15:16:27 GMT'})
+
+    def check_query(json):
+      query = json['query']
+      for expected in ('subject0: repository(owner: "foo", name: "bar")',
+                       'issueOrPullRequest(number: 123)',
+                       'subject1: repository(owner: "foo", name: "baz")',
+                       'issueOrPullRequest(number: 456)',
+                       'subject2: ', 'comments(last: 100)',
+                       'reactions(last: 100)'):
+        self.assertIn(expected, query)
+      return True
+
+    old_comment = {**COMMENT_GRAPHQL, 'updated_at': '2012-01-01T00:00:00Z'}
+    new_comment = {**COMMENT_GRAPHQL, 'updated_at': '2015-07-23T19:47:58Z'}
+    reaction = {
+      'id': 'MDg6UmVhY3Rpb24xOTg5NDk3MA==',
+      'content': 'THUMBS_UP',
+      'createdAt': '2018-02-21T19:49:16Z',
+      'user': USER_GRAPHQL,
+    }
+    issue = {
+      **ISSUE_GRAPHQL,
+      'updated_at': '2018-02-01T19:11:03Z',
+      'labels': {'nodes': [{'name': 'new silo'}]},
+      'comments': {'nodes': [old_comment, new_comment]},
+      'reactions': {'nodes': [reaction]},
+    }
+    del issue['lastEditedAt']
+    pull = {
+      'id': 'MDExOlB1bGxSZXF1ZXN0MTY3OTMwODA0',
+      'number': 444,
+      'url': 'https://github.com/foo/bar/pull/444',
+      'author': USER_GRAPHQL,
+      'title': 'a PR to merge',
+      'body': 'a PR message',
+      'createdAt': '2018-02-08T10:24:32Z',
+      'updated_at': '2018-02-09T21:14:43Z',
+      'merged': True,
+      'baseRefName': 'master',
+      'labels': {'nodes': []},
+      'comments': {'nodes': []},
+      'reactions': {'nodes': []},
+    }
+    self.expect_requests_post(GRAPHQL_BASE, json=mox.Func(check_query),
+                              headers={'Authorization': 'bearer a-towkin'},
+                              response={
+      'data': {
+        'subject0': {'issueOrPullRequest': pull},
+        'subject1': {'issueOrPullRequest': issue},
+        'subject2': None,
+      },
+      'errors': [{
+        'type': 'NOT_FOUND',
+        'path': ['subject2'],
+        'message': "Could not resolve to a Repository with the name 'foo/bar'.",
+      }],
+    })
+    self.mox.ReplayAll()
+
+    pull_obj = copy.deepcopy(PULL_OBJ)
+    pull_obj.update({
+      'to': [{'objectType': 'group', 'alias': '@private'}],
+      'replies': {'totalItems': 0},
+    })
+    comment_obj = copy.deepcopy(COMMENT_OBJ)
+    comment_obj['id'] = tag_uri('foo:bar:MDEwOlNQ==')
+    issue_obj = copy.deepcopy(ISSUE_OBJ_WITH_REACTIONS)
+    issue_obj['tags'] = ISSUE_OBJ['tags'] + [REACTION_OBJ]
+    issue_obj['replies'] = {'items': [comment_obj], 'totalItems': 1}
+
+    self.assert_equals([pull_obj, issue_obj], self.gh.get_activities(
+      use_graphql=True, fetch_replies=True, fetch_likes=True,
+      etag='Thu, 25 Oct 2012 15:16:27 GMT'))
+
+  def test_get_activities_use_graphql_fatal_error(self):
+    self.expect_rest(REST_NOTIFICATIONS, [NOTIFICATION_ISSUE_REST])
+    self.expect_requests_post(GRAPHQL_BASE, json=mox.IgnoreArg(),
+                              headers={'Authorization': 'bearer a-towkin'},
+                              response={
+      'data': {'subject0': None},
+      'errors': [{'type': 'FORBIDDEN', 'message': 'nope'}],
+    })
+    self.mox.ReplayAll()
+
+    with self.assertRaises(ValueError):
+      self.gh.get_activities(use_graphql=True)
+
+  @requires_httpx
+  def test_aget_activities_fetch_likes(self):
+    deleted = copy.deepcopy(NOTIFICATION_ISSUE_REST)
+    deleted['subject']['url'] = 'https://api.github.com/repos/foo/bar/issues/999'
+    responses = {
+      REST_NOTIFICATIONS: [NOTIFICATION_PULL_REST, deleted,
+                           NOTIFICATION_ISSUE_REST],
+      NOTIFICATION_PULL_REST['subject']['url']: PULL_REST,
+      REST_REACTIONS % ('foo', 'bar', 444): [],
+      NOTIFICATION_ISSUE_REST['subject']['url']: ISSUE_REST,
+      REST_REACTIONS % ('foo', 'bar', 333): [REACTION_REST, REACTION_REST],
+    }
+
+    def handler(request):
+      self.assertEqual('token a-towkin', request.headers['Authorization'])
+      url = str(request.url)
+      if url in responses:
+        return httputil.httpx.Response(200, json=responses[url])
+      return httputil.httpx.Response(404)
+
+    gh = github.GitHub('a-towkin', async_client=mock_async_client(handler))
+    pull_obj = copy.deepcopy(PULL_OBJ)
+    pull_obj['to'] = [{'objectType': 'group', 'alias': '@private'}]
+    self.assert_equals([pull_obj, ISSUE_OBJ_WITH_REACTIONS],
+                       asyncio.run(gh.aget_activities(fetch_likes=True)))
+
+  @requires_httpx
+  def test_aget_activities_304_not_modified(self):
+    etag = 'Thu, 25 Oct 2012 15:16:27 GMT'
+
+    def handler(request):
+      self.assertEqual(REST_NOTIFICATIONS, str(request.url))
+      self.assertEqual(etag, request.headers['If-Modified-Since'])
+      return httputil.httpx.Response(304)
+
+    gh = github.GitHub('a-towkin', async_client=mock_async_client(handler))
+    resp = asyncio.run(gh.aget_activities_response(etag=etag))
+    self.assert_equals([], resp['items'])
+
+  @requires_httpx
+  def test_aget_actor_and_comment(self):
+    def handler(request):
+      if request.url == GRAPHQL_BASE:
+        self.assertEqual('bearer a-towkin', request.headers['Authorization'])
+        return httputil.httpx.Response(200, json={'data': {'user': USER_GRAPHQL}})
+      self.assertEqual(REST_COMMENT % ('foo', 'bar', 'issues', 123),
+                       str(request.url))
+      return httputil.httpx.Response(200, json=COMMENT_REST)
+
+    gh = github.GitHub('a-towkin', async_client=mock_async_client(handler))
+    self.assert_equals(ACTOR, asyncio.run(gh.aget_actor('foo')))
+    self.assert_equals(COMMENT_OBJ, asyncio.run(gh.aget_comment('foo:bar:123')))
+
   def test_get_activities_self_empty(self):
     self.expect_rest(REST_NOTIFICATIONS, [])
     self.mox.ReplayAll()
@@ -539,6 +690,39 @@ class GitHubTest(testutil.TestCase):
     }, self.gh.get_activities_response(etag='Thu, 25 Oct 2012 15:16:27 GMT',
                                        fetch_replies=True))
 
+  def test_get_activities_limited_by_rate_limit_headers(self):
+    self.expect_rest(REST_NOTIFICATIONS,
+                     [NOTIFICATION_ISSUE_REST, NOTIFICATION_PULL_REST],
+                     headers={'If-Modified-Since': 'Thu, 25 Oct 2012 15:16:27 GMT'},
+                     response_headers={
+                       'Last-Modified': 'Fri, 1 Jan 2099 12:00:00 GMT',
+                       'X-RateLimit-Remaining': '3',
+                       'X-RateLimit-Reset': '4102444800',
+                       'X-RateLimit-Resource': 'core',
+                     })
+    self.expect_rest(NOTIFICATION_ISSUE_REST['subject']['url'], ISSUE_REST)
+    self.expect_rest(ISSUE_REST['comments_url'] + '?since=2012-10-25T15:16:27Z',
+                     [COMMENT_REST, COMMENT_REST])
+    self.mox.ReplayAll()
+
+    # only enough budget to hydrate the first notification, so the etag stays
+    # the same and the second is fetched again next time
+    resp = self.gh.get_activities_response(etag='Thu, 25 Oct 2012 15:16:27 GMT',
+                                           fetch_replies=True)
+    self.assert_equals('Thu, 25 Oct 2012 15:16:27 GMT', resp['etag'])
+    self.assert_equals([ISSUE_OBJ_WITH_REPLIES], resp['items'])
+
+  def test_rest_conditional_get_replays_304(self):
+    self.gh.validators = httputil.ValidatorStore()
+    self.expect_rest(REST_ISSUE % ('foo', 'bar', 123), ISSUE_REST,
+                     response_headers={'ETag': 'W/"abc"'})
+    self.expect_rest(REST_ISSUE % ('foo', 'bar', 123), status_code=304,
+                     headers={'If-None-Match': 'W/"abc"'})
+    self.mox.ReplayAll()
+
+    for _ in range(2):
+      self.assert_equals(ISSUE_REST, self.gh.rest(REST_ISSUE % ('foo', 'bar', 123)))
+
   def test_get_activities_etag_returns_304(self):
     self.expect_rest(REST_NOTIFICATIONS, status_code=304,
                      headers={'If-Modified-Since': 'Thu, 25 Oct 2012 15:16:27 GMT'},
@@ -0,0 +1,199 @@
+# coding=utf-8
+"""Unit tests for httputil.py."""
+import asyncio
+import collections
+import threading
+import time
+import urllib.error, urllib.parse, urllib.request
+
+from mox3 import mox
+from oauth_dropins.webutil import testutil
+from oauth_dropins.webutil import util
+import requests
+
+from .. import httputil
+from .test_source import (
+  FakeAdapter,
+  fake_session,
+  mock_async_client,
+  requires_httpx,
+)
+
+
+class HttputilTest(testutil.TestCase):
+
+  def test_map_concurrently(self):
+    for max_workers in None, 1, 3:
+      self.assertEqual([], httputil.map_concurrently(
+        lambda x: x * 2, [], max_workers=max_workers))
+      self.assertEqual([2, 4, 6, 8], httputil.map_concurrently(
+        lambda x: x * 2, (1, 2, 3, 4), max_workers=max_workers))
+
+  def test_map_concurrently_uses_threads(self):
+    threads = set()
+
+    def fn(x):
+      threads.add(threading.get_ident())
+      barrier.wait(timeout=5)
+      return x
+
+    barrier = threading.Barrier(3)
+    self.assertEqual([1, 2, 3],
+                     httputil.map_concurrently(fn, [1, 2, 3], max_workers=3))
+    self.assertEqual(3, len(threads))
+
+  def test_map_concurrently_raises_first_exception(self):
+    def fn(x):
+      if x > 1:
+        raise ValueError(x)
+      return x
+
+    with self.assertRaises(ValueError) as e:
+      httputil.map_concurrently(fn, [1, 2, 3], max_workers=3)
+    self.assertEqual((2,), e.exception.args)
+
+  def test_pooled_session(self):
+    session = httputil.PooledSession(pool_size=7, max_hosts=3)
+    adapter = session.get_adapter('https://foo.com/')
+    self.assertEqual(7, adapter._pool_maxsize)
+    self.assertEqual(3, adapter._pool_connections)
+    self.assertIs(adapter, session.get_adapter('http://bar.com/'))
+
+  def test_pooled_session_doesnt_store_cookies(self):
+    policy = httputil.PooledSession().cookies.get_policy()
+    self.assertTrue(policy.is_not_allowed('foo.com'))
+
+  def test_pooled_session_max_per_host(self):
+    lock = threading.Lock()
+    running = collections.Counter()
+    max_running = collections.Counter()
+
+    class SlowAdapter(FakeAdapter):
+      def send(self, request, **kwargs):
+        host = urllib.parse.urlparse(request.url).netloc
+        with lock:
+          running[host] += 1
+          max_running[host] = max(max_running[host], running[host])
+        time.sleep(.05)
+        with lock:
+          running[host] -= 1
+        return super().send(request, **kwargs)
+
+    session = httputil.PooledSession(max_per_host=2)
+    session.mount('http://', SlowAdapter({}))
+    urls = [f'http://{host}/{i}' for host in ('a', 'b') for i in range(5)]
+    httputil.map_concurrently(session.get, urls, max_workers=10)
+    self.assertEqual({'a': 2, 'b': 2}, max_running)
+
+  def test_urlopen_session(self):
+    session = fake_session({'http://foo/ok': (200, 'hello')})
+    resp = httputil.urlopen('http://foo/ok', session=session)
+    self.assertEqual(200, resp.getcode())
+    self.assertEqual(b'hello', resp.read())
+    self.assertEqual('"xyz"', resp.info().get('ETag'))
+
+    adapter = session.get_adapter('http://foo/')
+    self.assertEqual(util.user_agent, adapter.requests[0].headers['User-Agent'])
+
+  def test_urlopen_session_http_error(self):
+    session = fake_session({'http://foo/bad': (403, 'nope')})
+    with self.assertRaises(urllib.error.HTTPError) as e:
+      httputil.urlopen(urllib.request.Request('http://foo/bad', headers={'X': 'Y'}),
+                     session=session)
+    self.assertEqual(403, e.exception.code)
+    self.assertEqual(b'nope', e.exception.read())
+    self.assertEqual('Y', session.get_adapter('http://foo/').requests[0].headers['X'])
+
+  def test_urlopen_session_not_modified(self):
+    session = fake_session({'http://foo/same': (304, '')})
+    with self.assertRaises(urllib.error.HTTPError) as e:
+      httputil.urlopen('http://foo/same', session=session)
+    self.assertEqual(304, e.exception.code)
+
+  def test_requests_fn_session(self):
+    self.assertIs(util.requests_get, httputil.requests_fn('get'))
+
+    session = fake_session({'http://foo/': (200, 'hello')})
+    resp = httputil.requests_fn('get', session=session)('http://foo/')
+    self.assertEqual('hello', resp.text)
+
+  def test_requests_fn_session_response_too_big(self):
+    self.mox.stubs.Set(util, 'MAX_HTTP_RESPONSE_SIZE', 3)
+    session = fake_session({
+      'http://foo/': (200, 'hello', {'Content-Type': 'text/plain'}),
+    })
+    resp = httputil.requests_fn('get', session=session)('http://foo/')
+    self.assertEqual(util.HTTP_RESPONSE_TOO_BIG_STATUS_CODE, resp.status_code)
+
+  def test_requests_fn_session_stream(self):
+    session = fake_session({'http://foo/': (200, 'hello')})
+    self.mox.StubOutWithMock(session, 'get')
+    session.get('http://foo/', timeout=util.HTTP_TIMEOUT, stream=True,
+                headers={'User-Agent': util.user_agent}
+                ).AndReturn(testutil.requests_response('hello'))
+    self.mox.ReplayAll()
+    self.assertEqual('hello', httputil.requests_fn('get', session=session)(
+      'http://foo/').text)
+
+  def test_urlopen_session_connection_error(self):
+    session = fake_session({})
+    self.mox.StubOutWithMock(session, 'request')
+    session.request('GET', 'http://foo/', data=None, headers=mox.IgnoreArg(),
+                    timeout=util.HTTP_TIMEOUT
+                    ).AndRaise(requests.ConnectionError('nope'))
+    self.mox.ReplayAll()
+
+    with self.assertRaises(urllib.error.URLError):
+      httputil.urlopen('http://foo/', session=session)
+
+  def test_amap_concurrently(self):
+    running = []
+    max_running = []
+
+    async def fn(x):
+      running.append(x)
+      max_running.append(len(running))
+      await asyncio.sleep(.01)
+      running.remove(x)
+      return x * 2
+
+    self.assertEqual([], asyncio.run(httputil.amap_concurrently(fn, [])))
+    self.assertEqual([2, 4, 6, 8], asyncio.run(httputil.amap_concurrently(
+      fn, [1, 2, 3, 4], max_concurrency=2)))
+    self.assertEqual(2, max(max_running))
+
+  @requires_httpx
+  def test_arequest(self):
+    def handler(request):
+      self.assertEqual('GET', request.method)
+      self.assertEqual('http://foo/?x=y', str(request.url))
+      self.assertEqual(util.user_agent, request.headers['User-Agent'])
+      self.assertEqual('bar', request.headers['X-Foo'])
+      return httputil.httpx.Response(200, text='hello')
+
+    resp = asyncio.run(httputil.arequest(
+      'GET', 'http://foo/', client=mock_async_client(handler),
+      params={'x': 'y'}, headers={'X-Foo': 'bar'}))
+    self.assertEqual(200, resp.status_code)
+    self.assertEqual('hello', resp.text)
+
+  def test_validator_store(self):
+    store = httputil.ValidatorStore()
+    self.assertEqual(({}, None), store.lookup('http://foo', 'towkin'))
+
+    # no validators, nothing to store
+    store.store('http://foo', 'towkin', {'Content-Type': 'text/plain'}, 'x')
+    self.assertEqual(({}, None), store.lookup('http://foo', 'towkin'))
+
+    store.store('http://foo', 'towkin', {
+      'ETag': '"abc"',
+      'Last-Modified': 'Fri, 1 Jan 2099 12:00:00 GMT',
+    }, b'{"x": 1}')
+    self.assertEqual(({
+      'If-None-Match': '"abc"',
+      'If-Modified-Since': 'Fri, 1 Jan 2099 12:00:00 GMT',
+    }, '{"x": 1}'), store.lookup('http://foo', 'towkin'))
+
+    # keyed by credential too, hashed
+    self.assertEqual(({}, None), store.lookup('http://foo', 'other'))
+    self.assertNotIn('towkin', ' '.join(store.cache.keys()))
@@ -3,6 +3,7 @@
 """
 import copy
 import datetime
+import json
 import logging
 import urllib.parse
 
@@ -15,6 +16,7 @@ import requests
 from .. import instagram
 from ..instagram import HTML_BASE_URL, Instagram, HEADERS
 from .. import source
+from .test_source import serialize_http_mocks
 
 logger = logging.getLogger(__name__)
 
@@ -1480,6 +1482,34 @@ class InstagramTest(testutil.TestCase):
       'AIL 789_456': 9,
     }, cache)
 
+  def test_get_activities_scrape_fetch_extras_concurrently(self):
+    self.expect_requests_get('x/', HTML_PROFILE_COMPLETE, cookie='kuky')
+    for url, resp in (('p/ABC123/', HTML_PHOTO_COMPLETE),
+                      (instagram.HTML_LIKES_URL % 'ABC123', HTML_PHOTO_LIKES_RESPONSE),
+                      ('p/XYZ789/', HTML_VIDEO_COMPLETE),
+                      (instagram.HTML_LIKES_URL % 'XYZ789', {})):
+      self.expect_requests_get(url, resp, cookie='kuky'
+                               ).InAnyOrder()
+    self.mox.ReplayAll()
+    serialize_http_mocks(self)
+
+    ig = Instagram(max_workers=2)
+    self.assertEqual(2, ig.session.get_adapter(HTML_BASE_URL)._pool_maxsize)
+    ig.session = requests  # route through the mocked out requests functions
+
+    cache = {}
+    got = ig.get_activities(user_id='x', group_id=source.SELF, fetch_likes=True,
+                            fetch_replies=True, scrape=True, cache=cache,
+                            cookie='kuky')
+    self.assertEqual(['tag:instagram.com:123_456', 'tag:instagram.com:789_456'],
+                     [a['id'] for a in got])
+    self.assert_equals({
+      'AIC 123_456': 0,
+      'AIL 123_456': 5,
+      'AIC 789_456': 1,
+      'AIL 789_456': 9,
+    }, cache)
+
   def test_get_activities_scrape_missing_data(self):
     self.expect_requests_get('x/', """
 <!DOCTYPE html>
@@ -2128,6 +2158,57 @@ class InstagramTest(testutil.TestCase):
     self.assert_equals([], activities)
     self.assertIsNone(viewer)
 
+  def test_scraped_to_activities_skips_irrelevant_data(self):
+    # these blobs have no media or user data, so they shouldn't be decoded
+    irrelevant = (
+      """<script type="text/javascript">window.__additionalDataLoaded('x', {bad json);</script>"""
+      '<script type="text/javascript">window._sharedData = {"a": 1};</script>')
+    activities, viewer = self.instagram.scraped_to_activities(
+      irrelevant + HTML_FEED_COMPLETE)
+    self.assert_equals(HTML_ACTIVITIES_FULL, activities)
+    self.assert_equals(HTML_VIEWER, viewer)
+
+  def test_scraped_to_activities_defines_only_decodes_xig_shared_data(self):
+    html = HTML_FEED_COMPLETE_4.replace(
+      '["IntlCurrentLocale"', '["Bad", {bad json}], ["IntlCurrentLocale"')
+    _, viewer = self.instagram.scraped_to_activities(html)
+    self.assert_equals(HTML_VIEWER, viewer)
+
+  def test_decode_data_island_trims_nulls(self):
+    data = {
+      'config': None,
+      'data': {
+        'a': None,
+        'b': [None, 0, [], [[], {}], {'c': ''}, {'d': [False, 'x']}],
+        'e': {'f': {'g': None}},
+        'h': 0,
+        'i': False,
+      },
+      'items': [[], {}],
+      'user': {'j': [[None, 'y']]},
+    }
+    html = f'window._sharedData = {json_dumps(data)};</script>'
+    start = html.index('{')
+    self.assert_equals(util.trim_nulls(data),
+                       instagram._decode_data_island(html, start))
+    self.assertIsNone(instagram._decode_data_island(html[:-9], start))
+
+  def test_decode_data_island_only_decodes_read_keys(self):
+    html = '''window._sharedData = {
+      "country_code" : "US", "user": {"id": "1"},
+      "rollout_hash": {"x": [1, "}", {"y": null}]},
+      "a \\"quoted\\" key": 2,
+      "config": {"viewer": {"username": "me"}}
+    } ;</script>'''
+    self.assert_equals({
+      'user': {'id': '1'},
+      'config': {'viewer': {'username': 'me'}},
+    }, instagram._decode_data_island(html, html.index('{')))
+
+    html = 'window._sharedData = {"user": {"id": "1"} "config": {}};</script>'
+    with self.assertRaises(json.JSONDecodeError):
+      instagram._decode_data_island(html, html.index('{'))
+
   def test_scraped_to_activities_preload_fetch(self):
     """https://github.com/snarfed/granary/issues/140"""
     url = urllib.parse.urljoin(HTML_BASE_URL, HTML_PRELOAD_URL)
@@ -2141,6 +2222,20 @@ class InstagramTest(testutil.TestCase):
                        activities)
     self.assert_equals(HTML_VIEWER, viewer)
 
+  def test_scraped_to_activities_preload_fetch_skips_nonmatching_link(self):
+    url = urllib.parse.urljoin(HTML_BASE_URL, HTML_PRELOAD_URL)
+    self.expect_requests_get(url, HTML_PRELOAD_DATA, cookie='kuky')
+    self.mox.ReplayAll()
+
+    other = '<link rel="preload" href="/graphql/query/?query_hash=xyz&amp;variables=%7B%22a%22%3A1%7D" as="fetch" />'
+    html = (HTML_HEADER_PRELOAD.replace('<link rel="preload"', other + '\n<link rel="preload"')
+            + json_dumps(HTML_USELESS_FEED) + HTML_FOOTER)
+    activities, viewer = self.instagram.scraped_to_activities(html, cookie='kuky')
+
+    self.assert_equals([HTML_PHOTO_ACTIVITY_FULL, HTML_VIDEO_ACTIVITY_FULL],
+                       activities)
+    self.assert_equals(HTML_VIEWER, viewer)
+
   def test_scraped_to_activities_preload_fetch_bad_json(self):
     """https://console.cloud.google.com/errors/CP_w8ai-7JLfvAE"""
     url = urllib.parse.urljoin(HTML_BASE_URL, HTML_PRELOAD_URL)
@@ -1,11 +1,16 @@
 # coding=utf-8
 """Unit tests for mastodon.py."""
+import asyncio
 import copy
 
+from mox3 import mox
 from oauth_dropins.webutil import testutil, util
 from oauth_dropins.webutil.util import json_dumps, json_loads
+import requests
 
+from .. import httputil
 from .. import mastodon
+from .. import ratelimits
 from .. import source
 from ..mastodon import (
   API_ACCOUNT,
@@ -24,6 +29,7 @@ from ..mastodon import (
   API_TIMELINE,
   API_VERIFY_CREDENTIALS,
 )
+from .test_source import mock_async_client, requires_httpx, serialize_http_mocks
 
 def tag_uri(name):
   return util.tag_uri('foo.com', name)
@@ -310,6 +316,7 @@ class MastodonTest(testutil.TestCase):
     super(MastodonTest, self).setUp()
     self.mastodon = mastodon.Mastodon(INSTANCE, user_id=ACCOUNT['id'],
                                       access_token='towkin')
+    ratelimits.rate_limits.clear()
 
   def expect_get(self, *args, **kwargs):
     return self._expect_api(self.expect_requests_get, *args, **kwargs)
@@ -513,6 +520,124 @@ class MastodonTest(testutil.TestCase):
       self.mastodon.get_activities(fetch_replies=True, fetch_shares=True,
                                    fetch_likes=True, cache=cache)
 
+  def test_get_activities_extras_limited_by_rate_limit_headers(self):
+    status = {**STATUS_WITH_COUNTS, 'replies_count': 0}
+    self.expect_get(API_TIMELINE, params={}, response=[status],
+                    response_headers={
+                      'X-RateLimit-Remaining': '1',
+                      'X-RateLimit-Reset': '2099-01-01T00:00:00.000Z',
+                    })
+    self.expect_get(API_FAVORITED_BY % STATUS['id'], [ACCOUNT])
+    self.mox.ReplayAll()
+
+    cache = {}
+    self.mastodon.get_activities(fetch_likes=True, fetch_shares=True,
+                                 cache=cache)
+    # the reblogs weren't fetched, so they'll be fetched next time
+    self.assertEqual({'AMF 123': 2}, cache)
+
+  def test_get_conditional_replays_304(self):
+    self.mastodon.validators = httputil.ValidatorStore()
+    self.expect_get(API_TIMELINE, params={'limit': 1}, response=[STATUS],
+                    response_headers={'ETag': 'W/"abc"'})
+    # different params, different URL
+    self.expect_get(API_TIMELINE, params={'limit': 2}, response=[STATUS, STATUS])
+    self.expect_get(API_TIMELINE, params={'limit': 1}, status_code=304,
+                    headers={'If-None-Match': 'W/"abc"'})
+    self.mox.ReplayAll()
+
+    self.assertEqual([STATUS], self.mastodon._get(API_TIMELINE, params={'limit': 1}))
+    self.assertEqual([STATUS, STATUS],
+                     self.mastodon._get(API_TIMELINE, params={'limit': 2}))
+    self.assertEqual([STATUS], self.mastodon._get(API_TIMELINE, params={'limit': 1}))
+
+  def test_get_activities_fetch_extras_concurrently(self):
+    statuses = [copy.deepcopy(STATUS_WITH_COUNTS) for _ in range(3)]
+    for i, status in enumerate(statuses):
+      status['id'] += f'_{i}'
+
+    self.expect_get(API_TIMELINE, params={}, response=statuses)
+    for status in statuses:
+      id = status['id']
+      self.expect_get(API_CONTEXT % id, {'descendants': [REPLY_STATUS]}).InAnyOrder()
+      self.expect_get(API_FAVORITED_BY % id, [ACCOUNT]).InAnyOrder()
+      self.expect_get(API_REBLOGGED_BY % id, [ACCOUNT_REMOTE]).InAnyOrder()
+    self.mox.ReplayAll()
+    serialize_http_mocks(self)
+
+    m = mastodon.Mastodon(INSTANCE, user_id=ACCOUNT['id'],
+                          access_token='towkin', max_workers=4)
+    self.assertEqual(4, m.session.get_adapter(INSTANCE)._pool_maxsize)
+    m.session = requests  # route through the mocked out requests functions
+
+    cache = {}
+    got = m.get_activities(fetch_replies=True, fetch_likes=True,
+                           fetch_shares=True, cache=cache)
+    self.assertEqual([s['id'] for s in statuses],
+                     [util.parse_tag_uri(a['id'])[1] for a in got])
+    for activity in got:
+      obj = activity['object']
+      self.assertEqual([REPLY_ACTIVITY], obj['replies']['items'])
+      self.assertEqual(['like', 'share'],
+                       [t['verb'] for t in obj['tags'] if t.get('verb')])
+
+    self.assertEqual({f'{kind} {s["id"]}': s[field]
+                      for s in statuses
+                      for kind, field in (('AMRE', 'replies_count'),
+                                          ('AMF', 'favourites_count'),
+                                          ('AMRB', 'reblogs_count'))},
+                     cache)
+
+  @requires_httpx
+  def test_aget_activities_fetch_extras(self):
+    statuses = [copy.deepcopy(STATUS_WITH_COUNTS) for _ in range(2)]
+    for i, status in enumerate(statuses):
+      status['id'] += f'_{i}'
+
+    responses = {API_TIMELINE: statuses}
+    for status in statuses:
+      id = status['id']
+      responses.update({
+        API_CONTEXT % id: {'descendants': [REPLY_STATUS]},
+        API_FAVORITED_BY % id: [ACCOUNT],
+        API_REBLOGGED_BY % id: [ACCOUNT_REMOTE],
+      })
+
+    paths = []
+    def handler(request):
+      self.assertEqual('Bearer towkin', request.headers['Authorization'])
+      paths.append(request.url.path)
+      return httputil.httpx.Response(200, json=responses[request.url.path])
+
+    m = mastodon.Mastodon(INSTANCE, user_id=ACCOUNT['id'], access_token='towkin',
+                          async_client=mock_async_client(handler))
+    cache = {}
+    got = asyncio.run(m.aget_activities(
+      fetch_replies=True, fetch_likes=True, fetch_shares=True, cache=cache))
+
+    self.assertEqual(7, len(paths))
+    self.assertEqual([s['id'] for s in statuses],
+                     [util.parse_tag_uri(a['id'])[1] for a in got])
+    for activity in got:
+      obj = activity['object']
+      self.assertEqual([REPLY_ACTIVITY], obj['replies']['items'])
+      self.assertEqual(['like', 'share'],
+                       [t['verb'] for t in obj['tags'] if t.get('verb')])
+    self.assertEqual(6, len(cache))
+
+  @requires_httpx
+  def test_aget_actor_and_comment(self):
+    def handler(request):
+      return httputil.httpx.Response(200, json={
+        API_ACCOUNT % 1: ACCOUNT,
+        API_STATUS % 1: STATUS,
+      }[request.url.path])
+
+    m = mastodon.Mastodon(INSTANCE, user_id=ACCOUNT['id'], access_token='towkin',
+                          async_client=mock_async_client(handler))
+    self.assert_equals(ACTOR, asyncio.run(m.aget_actor(1)))
+    self.assert_equals(OBJECT, asyncio.run(m.aget_comment(1)))
+
   def test_get_actor(self):
     self.expect_get(API_ACCOUNT % 1, ACCOUNT)
     self.mox.ReplayAll()
@@ -813,6 +938,87 @@ class MastodonTest(testutil.TestCase):
     result = self.mastodon.create(MEDIA_OBJECT)
     self.assert_equals(STATUS, result.content, result)
 
+  def test_create_with_media_concurrently(self):
+    self.expect_requests_get('http://foo.com/video.mp4', 'pic 2').InAnyOrder()
+    self.expect_requests_get('http://foo.com/image.jpg', 'pic 1').InAnyOrder()
+
+    def file_is(expected):
+      # peeks and rewinds, since mox may compare a call to multiple expectations
+      def check(files):
+        got = files['file'].read()
+        files['file'].seek(0)
+        return got == expected
+      return mox.Func(check)
+
+    for content, data, id in ((b'pic 2', {'description': 'a fun video'}, 'a'),
+                              (b'pic 1', {}, 'b')):
+      requests.post(
+        INSTANCE + API_MEDIA, files=file_is(content), data=data,
+        headers=mox.IgnoreArg(), timeout=mox.IgnoreArg(), stream=True,
+      ).InAnyOrder().AndReturn(testutil.requests_response({'id': id}))
+
+    # status keeps the attachments' order
+    self.expect_post(API_STATUSES, json={
+      'status': 'foo ☕ bar',
+      'media_ids': ['a', 'b'],
+    }, response=STATUS)
+    self.mox.ReplayAll()
+    serialize_http_mocks(self)
+
+    m = mastodon.Mastodon(INSTANCE, user_id=ACCOUNT['id'], access_token='towkin',
+                          max_workers=2, media_cache={})
+    m.session = requests  # route through the mocked out requests functions
+    result = m.create(MEDIA_OBJECT)
+    self.assert_equals(STATUS, result.content, result)
+
+  def test_create_with_media_cache(self):
+    self.mastodon.media_cache = {}
+
+    # first attempt uploads, then fails to create the status
+    self.expect_requests_get('http://foo.com/video.mp4', 'pic 2')
+    self.expect_post(API_MEDIA, {'id': 'a'}, files={'file': b'pic 2'},
+                     data={'description': 'a fun video'})
+    self.expect_requests_get('http://foo.com/image.jpg', 'pic 1')
+    self.expect_post(API_MEDIA, {'id': 'b'}, files={'file': b'pic 1'}, data={})
+    self.expect_post(API_STATUSES, json={
+      'status': 'foo ☕ bar',
+      'media_ids': ['a', 'b'],
+    }, status_code=500)
+
+    # retry reuses the uploads
+    self.expect_requests_get('http://foo.com/video.mp4', 'pic 2')
+    self.expect_requests_get('http://foo.com/image.jpg', 'pic 1')
+    self.expect_post(API_STATUSES, json={
+      'status': 'foo ☕ bar',
+      'media_ids': ['a', 'b'],
+    }, response=STATUS)
+    self.mox.ReplayAll()
+
+    with self.assertRaises(requests.HTTPError):
+      self.mastodon.create(MEDIA_OBJECT)
+    self.assertEqual(2, len(self.mastodon.media_cache))
+    for key in self.mastodon.media_cache:
+      self.assertNotIn('towkin', key)
+
+    result = self.mastodon.create(MEDIA_OBJECT)
+    self.assert_equals(STATUS, result.content, result)
+
+    # attached media can't be reused
+    self.assertEqual({}, self.mastodon.media_cache)
+
+  def test_upload_media_cache_dedupes_same_contents(self):
+    self.mastodon.media_cache = {}
+
+    self.expect_requests_get('http://foo.com/a.jpg', 'pic')
+    self.expect_post(API_MEDIA, {'id': 'a'}, files={'file': b'pic'}, data={})
+    self.expect_requests_get('http://foo.com/b.jpg', 'pic')
+    self.mox.ReplayAll()
+
+    self.assertEqual(['a'], self.mastodon.upload_media([
+      {'url': 'http://foo.com/a.jpg'},
+      {'url': 'http://foo.com/b.jpg'},
+    ]))
+
   def test_create_with_too_many_media(self):
     image_urls = [f'http://my/picture/{i}' for i in range(mastodon.MAX_MEDIA)]
     obj = {
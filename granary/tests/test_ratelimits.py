@@ -0,0 +1,62 @@
+# coding=utf-8
+"""Unit tests for ratelimits.py."""
+import time
+
+from oauth_dropins.webutil import testutil
+
+from .. import ratelimits
+
+
+class RateLimitsTest(testutil.TestCase):
+
+  def test_parse_rate_limit_headers(self):
+    now = time.time()
+    for expected, headers, status in (
+        ((None, None), None, None),
+        ((None, None), {'Content-Type': 'text/html'}, 200),
+        ((5, 1900000000), {'x-rate-limit-remaining': '5',
+                           'x-rate-limit-reset': '1900000000'}, 200),
+        ((5, 1893456000), {'X-RateLimit-Remaining': '5',
+                           'X-RateLimit-Reset': '2030-01-01T00:00:00.000Z'}, 200),
+        ((3, now + 30), {'RateLimit-Remaining': '3', 'RateLimit-Reset': '30'}, 200),
+        ((0, now + 30), {'Retry-After': '30'}, 429),
+        ((0, now + 60), {}, 429),
+        ((None, None), {'Retry-After': '30'}, 200),
+        ((0, now + 60), {'X-App-Usage': '{"call_count": 100, "total_time": 5}'}, 200),
+        ((None, None), {'X-App-Usage': '{"call_count": 50}'}, 200),
+        ((0, now + 300), {'X-Business-Use-Case-Usage': '{"123": [{"call_count": 100, "estimated_time_to_regain_access": 5}]}'}, 200),
+    ):
+      with self.subTest(headers=headers, status=status):
+        remaining, reset = ratelimits.parse_rate_limit_headers(headers, status=status)
+        self.assertEqual(expected[0], remaining)
+        if expected[1] is None:
+          self.assertIsNone(reset)
+        else:
+          self.assertAlmostEqual(expected[1], reset, delta=5)
+
+  def test_rate_limits(self):
+    limits = ratelimits.RateLimits()
+    key = ratelimits.rate_limit_key('Fake', 'towkin', 'foo')
+    self.assertNotIn('towkin', repr(key))
+    self.assertIsNone(limits.remaining(key))
+    self.assertEqual(9, limits.limit(key, 9))
+
+    limits.update(key, {'X-RateLimit-Remaining': '5',
+                        'X-RateLimit-Reset': str(int(time.time()) + 60)})
+    self.assertEqual(5, limits.remaining(key))
+    self.assertEqual(3, limits.limit(key, 3))
+    self.assertEqual(2, limits.limit(key, 3))
+    self.assertEqual(0, limits.limit(key, 3))
+
+    # other buckets are separate
+    self.assertIsNone(limits.remaining(ratelimits.rate_limit_key('Fake', 'towkin')))
+
+    # responses without rate limit headers don't change the budget
+    limits.update(key, {})
+    self.assertEqual(0, limits.remaining(key))
+
+    # expires after reset
+    limits.update(key, {'X-RateLimit-Remaining': '0',
+                        'X-RateLimit-Reset': str(int(time.time()) - 1)})
+    self.assertIsNone(limits.remaining(key))
+    self.assertEqual(9, limits.limit(key, 9))
@@ -2,16 +2,19 @@
 """Unit tests for reddit.py.
 """
 import copy
+import threading
 
 from mox3 import mox
 from oauth_dropins import reddit as oauth_reddit
 from oauth_dropins.webutil import testutil
 from oauth_dropins.webutil import util
 
+from granary import caches
 from granary import reddit
 
 import praw
 from praw.models import Subreddit, User
+from praw.models.redditors import PartialRedditor
 from praw.models.comment_forest import CommentForest
 from praw.models.listing.mixins.redditor import SubListing
 from prawcore.exceptions import NotFound
@@ -273,7 +276,10 @@ class RedditTest(testutil.TestCase):
                        self.reddit.get_activities(search_query='foo bar'))
 
   def test_get_activities_fetch_replies(self):
-    self.api.submission(id='ezv3f2').MultipleTimes().AndReturn(self.submission_selftext)
+    # no cache, so no info() call for comment counts
+    self.submission_selftext.num_comments = 1
+    self.api.submission(id='ezv3f2').AndReturn(self.submission_selftext)
+    self.api.submission(id='ezv3f2').AndReturn(self.submission_selftext)
     self.submission_selftext.comments = CommentForest(self.submission_selftext,
                                                       comments=[self.comment])
     self.mox.StubOutWithMock(self.submission_selftext.comments, 'replace_more')
@@ -285,10 +291,11 @@ class RedditTest(testutil.TestCase):
       self.reddit.get_activities(activity_id='ezv3f2', fetch_replies=True))
 
   def test_get_activities_cache_comments(self):
-    # get first_activities() call, fetches comments
+    # get first_activities() call, not cached yet, so fetches comments without
+    # checking the count first
     self.submission_selftext.num_comments = 1
-    for _ in range(2):
-      self.api.submission(id='ezv3f2').AndReturn(self.submission_selftext)
+    self.api.submission(id='ezv3f2').AndReturn(self.submission_selftext)
+    self.api.submission(id='ezv3f2').AndReturn(self.submission_selftext)
 
     comments = CommentForest(self.submission_selftext, comments=[self.comment])
     self.submission_selftext.comments = comments
@@ -296,20 +303,21 @@ class RedditTest(testutil.TestCase):
     comments.replace_more()
 
     # second call, comment count is unchanged, skips comment fetch
-    for _ in range(2):
-      self.api.submission(id='ezv3f2').AndReturn(self.submission_selftext)
+    self.api.submission(id='ezv3f2').AndReturn(self.submission_selftext)
+    self.api.info(fullnames=['t3_ezv3f2']).AndReturn([self.submission_selftext])
 
-    # third call, comment count is different, skips comment fetch
+    # third call, comment count is different, fetches comments
     other_sub = FakeSubmission(self.redditor)
     other_sub.num_comments = 2
     other_sub.comments = comments
-    for _ in range(2):
-      self.api.submission(id='ezv3f2').AndReturn(other_sub)
+    self.api.submission(id='ezv3f2').AndReturn(other_sub)
+    self.api.info(fullnames=['t3_ezv3f2']).AndReturn([other_sub])
+    self.api.submission(id='ezv3f2').AndReturn(other_sub)
     comments.replace_more()
 
     # fourth call, comment count is unchanged, skips comment fetch
-    for _ in range(2):
-      self.api.submission(id='ezv3f2').AndReturn(other_sub)
+    self.api.submission(id='ezv3f2').AndReturn(other_sub)
+    self.api.info(fullnames=['t3_ezv3f2']).AndReturn([other_sub])
 
     self.mox.ReplayAll()
     cache = {}
@@ -326,6 +334,169 @@ class RedditTest(testutil.TestCase):
         self.reddit.get_activities(activity_id='ezv3f2', fetch_replies=True, cache=cache))
       self.assert_equals(num_comments, cache['ARR ezv3f2'])
 
+  def test_get_activities_fetch_replies_batched_concurrently(self):
+    subs = {}
+    for id, num_comments in ('a', 1), ('b', 2), ('c', 3):
+      sub = subs[id] = FakeSubmission(self.redditor)
+      sub.id = id
+      sub.num_comments = num_comments
+      sub.comments = type('Comments', (list,), {'replace_more': lambda self: None})(
+        [self.comment])
+
+    class FakeApi:
+      """Thread safe stand-in for PRAW."""
+      def __init__(self):
+        self.info_calls = []
+        self.fetched = []
+        self.threads = set()
+      def info(self, fullnames):
+        self.info_calls.append(fullnames)
+        return [subs[name[3:]] for name in fullnames]
+      def submission(self, id):
+        self.fetched.append(id)
+        self.threads.add(threading.current_thread())
+        return subs[id]
+
+
+    r = reddit.Reddit('token-here', max_workers=3)
+    r.api = api = FakeApi()
+    activities = [r.praw_to_activity(sub, 'submission') for sub in subs.values()]
+
+    # b's comment count is unchanged
+    cache = {'ARR a': 0, 'ARR b': 2}
+    r._fetch_replies(activities, cache=cache)
+
+    # c isn't cached, so it's fetched without checking its count
+    self.assertEqual([['t3_a', 't3_b']], api.info_calls)
+    self.assertCountEqual(['a', 'c'], api.fetched)
+    self.assertEqual({'ARR a': 1, 'ARR b': 2, 'ARR c': 3}, cache)
+    self.assertEqual([1, None, 1], [a['object'].get('replies', {}).get('totalItems')
+                                    for a in activities])
+
+    # no cache, so no info() call. reuses the same pool, so its worker threads
+    # and their PRAW clients
+    executor = r.executor
+    r._fetch_replies(activities, cache=None)
+    self.assertEqual(1, len(api.info_calls))
+    self.assertCountEqual(['a', 'c', 'a', 'b', 'c'], api.fetched)
+    self.assertIs(executor, r.executor)
+    self.assertTrue(all(t.name.startswith('reddit') for t in api.threads))
+
+  def test_fetch_replies_skips_info_when_nothing_cached(self):
+    sub = FakeSubmission(self.redditor)
+    sub.id = 'a'
+    sub.num_comments = 0
+    sub.comments = type('Comments', (list,), {'replace_more': lambda self: None})()
+
+    class FakeApi:
+      def __init__(self):
+        self.fetched = []
+      def info(self, fullnames):
+        raise AssertionError('unexpected info() call')
+      def submission(self, id):
+        self.fetched.append(id)
+        return sub
+
+    r = reddit.Reddit('token-here')
+    r.api = api = FakeApi()
+
+    r._fetch_replies([], cache={})
+    self.assertEqual([], api.fetched)
+
+    cache = {}
+    activity = r.praw_to_activity(sub, 'submission')
+    r._fetch_replies([activity], cache=cache)
+    self.assertEqual(['a'], api.fetched)
+    self.assertEqual({'ARR a': 0}, cache)
+
+  def test_close_shuts_down_executor(self):
+    with reddit.Reddit('token-here', max_workers=3) as r:
+      executor = r.executor
+      self.assertEqual(['x'], list(executor.map(str.lower, ['X'])))
+
+    self.assertTrue(executor._shutdown)
+    self.assertIsNone(r._executor)
+    r.close()  # idempotent
+
+    # closing without ever creating the pool is a noop
+    reddit.Reddit('token-here').close()
+
+  def test_get_activities_bulk_users(self):
+    self.reddit.bulk_users = True
+    reddit.user_cache['RU carol'] = {'name': 'carol', 'id': 'c3'}
+
+    subs = []
+    for id, name in ('x', 'alice'), ('y', 'bob'), ('z', 'carol'), ('w', 'alice'):
+      sub = FakeSubmission(util.Struct(name=name))
+      sub.id = id
+      sub.author_fullname = f't2_{name[0]}1'
+      sub.url = None
+      subs.append(sub)
+
+    self.api.redditors = self.mox.CreateMockAnything()
+    self.api.redditor('plfff').AndReturn(self.redditor)
+    self.redditor.submissions = self.mox.CreateMock(SubListing)
+    self.redditor.submissions.new(limit=None).AndReturn(iter(subs))
+    self.api.redditors.partial_redditors(['t2_a1', 't2_b1']).AndReturn([
+      PartialRedditor(fullname='t2_a1', name='alice', created_utc=1576950011.0,
+                      profile_img='http://alice/pic'),
+      PartialRedditor(fullname='t2_b1', name='bob'),
+    ])
+    self.mox.ReplayAll()
+
+    actors = [a['actor'] for a in self.reddit.get_activities(user_id='plfff')]
+    self.assert_equals([{
+      'objectType': 'person',
+      'displayName': 'alice',
+      'id': 'tag:reddit.com:alice',
+      'image': {'url': 'http://alice/pic'},
+      'numeric_id': 'a1',
+      'published': '2019-12-21T17:40:11Z',
+      'url': 'https://reddit.com/user/alice/',
+      'username': 'alice',
+    }, {
+      'objectType': 'person',
+      'displayName': 'bob',
+      'id': 'tag:reddit.com:bob',
+      'numeric_id': 'b1',
+      'url': 'https://reddit.com/user/bob/',
+      'username': 'bob',
+    }], actors[:2])
+    self.assertEqual('c3', actors[2]['numeric_id'])
+    self.assertEqual(actors[0], actors[3])
+
+  def test_partial_user_doesnt_overwrite_full_profile(self):
+    full = {'name': 'bob', 'id': 'b1', 'icon_img': 'http://bob/pic'}
+    self.reddit._cache_user('bob', full)
+    self.reddit._cache_user('bob', {'name': 'bob', 'id': 'b1'}, partial=True)
+    self.assertEqual(full, self.reddit._cached_user('bob'))
+
+  def test_user_cache_pluggable(self):
+    cache = caches.MemoryCache()
+    self.assert_equals(ACTOR, reddit.Reddit('token-here', user_cache=cache)
+                              .praw_to_actor(self.redditor))
+    self.assertEqual(['RU bonkerfield'], list(cache))
+    self.assertEqual(0, len(reddit.user_cache))
+
+    # another instance sharing the cache doesn't refetch the user
+    other = reddit.Reddit('token-here', user_cache=cache)
+    self.assert_equals(ACTOR, other.praw_to_actor(util.Struct(name='bonkerfield')))
+
+  def test_api_per_thread(self):
+    r = reddit.Reddit('token-here')
+    self.assertIs(r.api, r.api)
+    self.assertTrue(r.api.read_only)
+
+    apis = []
+    threads = [threading.Thread(target=lambda: apis.append(r.api))
+               for _ in range(2)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertIsNot(apis[0], apis[1])
+    self.assertNotIn(r.api, apis)
+
   def test_get_comment(self):
     self.api.comment(id='xyz').AndReturn(self.comment)
     self.mox.ReplayAll()
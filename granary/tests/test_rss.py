@@ -1,5 +1,9 @@
 # coding=utf-8
 """Unit tests for rss.py."""
+import io
+import os
+from xml.etree import ElementTree
+
 from oauth_dropins.webutil import testutil
 
 from .. import rss
@@ -101,3 +105,72 @@ class RssTest(testutil.TestCase):
         },
       }], feed_url='http://this')
     self.assert_multiline_in('<author>- (Mrs. Baz)</author>', got)
+
+  def test_iter_to_activities_matches_to_activities(self):
+    testdata = os.path.join(os.path.dirname(__file__), 'testdata')
+    for filename in ('feed_with_audio_video.rss.xml',
+                     'feed_with_authors.rss.xml', 'feed_with_note.rss.xml'):
+      with self.subTest(filename), open(os.path.join(testdata, filename),
+                                        'rb') as f:
+        body = f.read()
+        chunks = [body[i:i + 50] for i in range(0, len(body), 50)]
+        self.assert_equals(rss.to_activities(body.decode()),
+                           list(rss.iter_to_activities(chunks)))
+        self.assert_equals(rss.to_activities(body.decode()),
+                           list(rss.iter_to_activities(io.BytesIO(body))))
+
+  def test_iter_to_activities_feed_author(self):
+    got = list(rss.iter_to_activities("""\
+<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0" xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd">
+<channel>
+<title>My Podcast</title>
+<link>http://my/podcast</link>
+<itunes:image href="http://my/art.jpg" />
+<item><guid>http://my/1</guid><title>one</title></item>
+<item><guid>http://my/2</guid><title>two</title></item>
+</channel>
+</rss>
+"""))
+    actor = {
+      'displayName': 'My Podcast',
+      'url': 'http://my/podcast',
+      'image': [{'url': 'http://my/art.jpg'}],
+    }
+    self.assert_equals([{
+      'objectType': 'activity',
+      'verb': 'create',
+      'id': 'http://my/1',
+      'url': 'http://my/1',
+      'actor': actor,
+      'object': {
+        'objectType': 'article',
+        'id': 'http://my/1',
+        'url': 'http://my/1',
+        'displayName': 'one',
+        'author': actor,
+      },
+    }, {
+      'objectType': 'activity',
+      'verb': 'create',
+      'id': 'http://my/2',
+      'url': 'http://my/2',
+      'actor': actor,
+      'object': {
+        'objectType': 'article',
+        'id': 'http://my/2',
+        'url': 'http://my/2',
+        'displayName': 'two',
+        'author': actor,
+      },
+    }], got)
+
+  def test_iter_to_activities_malformed(self):
+    with self.assertRaises(ElementTree.ParseError):
+      list(rss.iter_to_activities('not valid xml'))
+
+    got = rss.iter_to_activities(
+      '<rss><channel><item><guid>http://my/1</guid></item><item><guid>')
+    self.assertEqual('http://my/1', next(got)['id'])
+    with self.assertRaises(ElementTree.ParseError):
+      next(got)
@@ -1,13 +1,20 @@
 # coding=utf-8
 """Unit tests for source.py.
 """
+import asyncio
 import copy
 import re
+import threading
+from unittest import skipIf
 
+from bs4 import SoupStrainer
 from oauth_dropins.webutil import testutil
 from oauth_dropins.webutil import util
+import requests
 
+from .. import caches
 from .. import facebook
+from .. import httputil
 from .. import instagram
 from .. import source
 from ..source import (
@@ -34,6 +41,76 @@ from .test_as1 import (
 EVENT_ACTIVITY_WITH_RSVPS = {'object': EVENT_WITH_RSVPS}
 
 
+def serialize_http_mocks(test):
+  """Makes a test's mocked out HTTP functions safe to call from many threads.
+
+  mox isn't thread safe, so this wraps the stubbed out urlopen and requests
+  functions with a lock. Call it after ReplayAll().
+
+  Args:
+    test: :class:`testutil.TestCase`
+  """
+  lock = threading.Lock()
+  for module, name in ((util.urllib.request, 'urlopen'), (requests, 'get'),
+                       (requests, 'post'), (requests, 'head')):
+    def locked(*args, fn=getattr(module, name), **kwargs):
+      with lock:
+        return fn(*args, **kwargs)
+    test.mox.stubs.Set(module, name, locked)
+
+
+class FakeAdapter(requests.adapters.BaseAdapter):
+  """Fake HTTP transport. Mount on a session to return canned responses.
+
+  Attributes:
+    responses: dict mapping string URL to (int status, str body) or
+      (int status, str body, dict headers) tuple
+    requests: list of :class:`requests.PreparedRequest`s sent so far
+  """
+  def __init__(self, responses):
+    super().__init__()
+    self.responses = responses
+    self.requests = []
+
+  def send(self, request, **kwargs):
+    self.requests.append(request)
+    status, body, *headers = self.responses.get(request.url, (404, 'not found'))
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = body.encode()
+    resp.headers['ETag'] = '"xyz"'
+    if headers:
+      resp.headers.update(headers[0])
+    resp.url = request.url
+    resp.request = request
+    return resp
+
+  def close(self):
+    pass
+
+
+def fake_session(responses, **kwargs):
+  """Returns a :class:`httputil.PooledSession` that uses a :class:`FakeAdapter`."""
+  session = httputil.PooledSession(**kwargs)
+  session.mount('http://', FakeAdapter(responses))
+  session.mount('https://', FakeAdapter(responses))
+  return session
+
+
+def mock_async_client(handler):
+  """Returns an :class:`httpx.AsyncClient` that serves requests with handler.
+
+  Args:
+    handler: function that takes an :class:`httpx.Request` and returns an
+      :class:`httpx.Response`
+  """
+  return httputil.httpx.AsyncClient(
+    transport=httputil.httpx.MockTransport(handler))
+
+
+requires_httpx = skipIf(httputil.httpx is None, 'requires httpx')
+
+
 class FakeSource(Source):
   DOMAIN = 'fake.com'
   EMBED_POST = 'foo %(url)s bar'
@@ -359,3 +436,100 @@ Watching  \t waves
     orig = expected = 'trailing slash http://www.foo.co/'
     result = truncate(orig, 'http://www.foo.co/', OMIT_LINK)
     self.assertEqual(expected, result)
+
+  def test_session(self):
+    session = httputil.PooledSession()
+    self.assertIsNone(FakeSource().session)
+    self.assertIs(session, FakeSource(session=session).session)
+
+  def test_aget_actor_default_runs_sync_method(self):
+    self.mox.StubOutWithMock(self.source, 'get_actor')
+    self.source.get_actor('foo').AndReturn({'id': 'foo'})
+    self.mox.StubOutWithMock(self.source, 'get_activities_response')
+    self.source.get_activities_response(group_id='@self').AndReturn(
+      {'items': [{'id': 'bar'}]})
+    self.mox.ReplayAll()
+
+    self.assertEqual({'id': 'foo'}, asyncio.run(self.source.aget_actor('foo')))
+    self.assertEqual([{'id': 'bar'}], asyncio.run(
+      self.source.aget_activities(group_id='@self')))
+
+  def test_conditional_headers(self):
+    self.assertEqual(({'X': 'y'}, None),
+                     self.source._conditional_headers('http://foo', 'tok', {'X': 'y'}))
+
+    self.source.validators = httputil.ValidatorStore()
+    self.source._store_validators('http://foo', 'tok', {'ETag': '"abc"'}, 'body')
+    self.assertEqual(({'X': 'y', 'If-None-Match': '"abc"'}, 'body'),
+                     self.source._conditional_headers('http://foo', 'tok', {'X': 'y'}))
+
+    # the caller's own conditional headers win
+    self.assertEqual(({'If-None-Match': '"def"'}, None),
+                     self.source._conditional_headers(
+                       'http://foo', 'tok', {'If-None-Match': '"def"'}))
+
+  def test_html_to_text(self):
+    source.html_to_text_cache.clear()
+    self.assertIsNone(source.html_to_text(''))
+    self.assertEqual('x **y**', source.html_to_text('<p>x <b>y</b></p>'))
+
+    # cached
+    self.mox.StubOutWithMock(source.html2text_pool, 'converter')
+    self.mox.ReplayAll()
+    self.assertEqual('x **y**', source.html_to_text('<p>x <b>y</b></p>'))
+
+  def test_html_to_text_unhashable_option(self):
+    self.assertEqual('x **y**', source.html_to_text('<p>x <b>y</b></p>',
+                                                    foo=['a']))
+
+    pool = source.HTML2TextPool()
+    with pool.converter(foo=['a']) as h:
+      self.assertEqual(['a'], h.foo)
+    self.assertEqual({}, pool._idle)
+
+  def test_html2text_pool_reuses_and_resets_converters(self):
+    pool = source.HTML2TextPool(size=1)
+    with pool.converter(ignore_emphasis=True) as h:
+      self.assertEqual('x y\n\n  * \n\n', h.handle('<p>x <b>y</b></p><ul><li>'))
+      first = h
+
+    with pool.converter(ignore_emphasis=True) as h:
+      self.assertIs(first, h)
+      self.assertEqual('z\n\n', h.handle('<p>z</p>'))
+
+    with pool.converter() as h:
+      self.assertIsNot(first, h)
+      self.assertEqual('**z**\n\n', h.handle('<p><b>z</b></p>'))
+
+  def test_looks_like_html(self):
+    for text in ('<p>x</p>', 'a <br /> b', 'x &amp; y', 'x &#39; y', '<b c>'):
+      self.assertTrue(source.looks_like_html(text), text)
+
+    for text in ('', 'foo', 'c<a&b', '1 < 2 > 0', '</p>', '& ;'):
+      self.assertFalse(source.looks_like_html(text), text)
+
+  def test_parse_scraped_html(self):
+    html = '<html><body><p id="a">x</p><div id="b">y</div></body></html>'
+    soup = source.parse_scraped_html(html)
+    self.assertEqual('x', soup.find(id='a').string)
+    self.assertIs(soup, source.parse_scraped_html(soup))
+
+    strained = source.parse_scraped_html(
+      html, parse_only=SoupStrainer(id='b'))
+    self.assertIsNone(strained.find(id='a'))
+    self.assertEqual('y', strained.find(id='b').string)
+    self.assertEqual('lxml', strained.builder.NAME)
+
+  def test_parse_scraped_html_full_parse_uses_default_parser(self):
+    self.mox.stubs.Set(util, 'beautifulsoup_parser', 'html.parser')
+    soup = source.parse_scraped_html('<p id="a">x</p>')
+    self.assertEqual('html.parser', soup.builder.NAME)
+
+  def test_source_cache_attribute(self):
+    self.assertEqual({}, self.source._cache_or_default(None))
+
+    cache = caches.MemoryCache()
+    self.source.cache = cache
+    self.assertIs(cache, self.source._cache_or_default(None))
+    other = {}
+    self.assertIs(other, self.source._cache_or_default(other))
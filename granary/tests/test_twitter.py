@@ -1,11 +1,14 @@
 # coding=utf-8
 """Unit tests for twitter.py.
 """
+import asyncio
 from collections import OrderedDict
 import copy
 import http.client
+import io
 import socket
-import urllib.parse
+import time
+import urllib.error, urllib.parse, urllib.response
 
 from mox3 import mox
 from oauth_dropins import twitter_auth
@@ -15,7 +18,10 @@ from oauth_dropins.webutil.util import json_dumps, json_loads
 import requests
 from requests import RequestException
 
+from .. import caches
+from .. import httputil
 from .. import microformats2
+from .. import ratelimits
 from .. import source
 from .. import twitter
 from ..twitter import (
@@ -34,6 +40,12 @@ from ..twitter import (
   SCRAPE_LIKES_URL,
   Twitter,
 )
+from .test_source import (
+  fake_session,
+  mock_async_client,
+  requires_httpx,
+  serialize_http_mocks,
+)
 
 # test data
 def tag_uri(name):
@@ -696,6 +708,7 @@ class TwitterTest(testutil.TestCase):
     twitter_auth.TWITTER_APP_KEY = 'fake'
     twitter_auth.TWITTER_APP_SECRET = 'fake'
     self.twitter = twitter.Twitter('key', 'secret')
+    ratelimits.rate_limits.clear()
 
   def expect_urlopen(self, url, response=None, params=None, **kwargs):
     if not url.startswith('http'):
@@ -713,6 +726,16 @@ class TwitterTest(testutil.TestCase):
     self.mox.ReplayAll()
     self.assert_equals(ACTOR, self.twitter.get_actor('foo'))
 
+  def test_get_actor_session(self):
+    session = fake_session({
+      twitter.API_BASE + 'users/show.json?screen_name=foo': (200, json_dumps(USER)),
+    })
+    tw = twitter.Twitter('key', 'secret', session=session)
+    self.assert_equals(ACTOR, tw.get_actor('foo'))
+
+    req = session.get_adapter(twitter.API_BASE).requests[0]
+    self.assertTrue(req.headers['Authorization'].startswith(b'OAuth '))
+
   def test_get_actor_default(self):
     self.expect_urlopen('account/verify_credentials.json', USER)
     self.mox.ReplayAll()
@@ -861,6 +884,44 @@ class TwitterTest(testutil.TestCase):
     self.assert_equals([ACTIVITY_WITH_REPLIES],
                           self.twitter.get_activities(fetch_replies=True, min_id='567'))
 
+  def test_get_activities_fetch_replies_concurrently_with_cache(self):
+    self.expect_urlopen(TIMELINE, [TWEET])
+    search = API_SEARCH + '&since_id=567'
+    self.expect_urlopen(search % {'q': '%40snarfed_org', 'count': 100},
+                        REPLIES_TO_SNARFED)
+    # alice and bob are both on the second level of the reply tree
+    self.expect_urlopen(search % {'q': '%40alice', 'count': 100},
+                        REPLIES_TO_ALICE).InAnyOrder('level 1')
+    self.expect_urlopen(search % {'q': '%40bob', 'count': 100},
+                        REPLIES_TO_BOB).InAnyOrder('level 1')
+
+    # second call should use the cached searches
+    self.expect_urlopen(TIMELINE, [TWEET])
+    self.mox.ReplayAll()
+    serialize_http_mocks(self)
+
+    cache = caches.MemoryCache(ttl=60)
+    tw = twitter.Twitter('key', 'secret', max_workers=2, mentions_cache=cache)
+    for _ in range(2):
+      self.assert_equals([ACTIVITY_WITH_REPLIES],
+                         tw.get_activities(fetch_replies=True, min_id='567'))
+
+    self.assertEqual({'hits': 3, 'misses': 3}, cache.stats())
+
+  def test_mentions_cache_keyed_by_access_token(self):
+    search = API_SEARCH % {'q': '%40alice', 'count': 100}
+    self.expect_urlopen(search, {'statuses': [{'id_str': '1'}]})
+    self.expect_urlopen(search, {'statuses': [{'id_str': '2'}]})
+    self.mox.ReplayAll()
+
+    cache = {}
+    self.assertEqual([{'id_str': '1'}], twitter.Twitter(
+      'key', 'secret', mentions_cache=cache)._search_mentions('alice'))
+    self.assertEqual([{'id_str': '2'}], twitter.Twitter(
+      'other', 'secret', mentions_cache=cache)._search_mentions('alice'))
+    self.assertEqual([{'id_str': '1'}], twitter.Twitter(
+      'key', 'secret', mentions_cache=cache)._search_mentions('alice'))
+
   def test_get_activities_fetch_mentions(self):
     self.expect_urlopen(TIMELINE, [])
     self.expect_urlopen('account/verify_credentials.json',
@@ -1087,6 +1148,171 @@ class TwitterTest(testutil.TestCase):
     self.mox.ReplayAll()
     self.twitter.get_activities(fetch_shares=True)
 
+  def test_retweets_limited_by_rate_limit_headers(self):
+    tweets = [{**copy.deepcopy(TWEET), 'id_str': str(i), 'retweet_count': 1}
+              for i in range(1, 5)]
+
+    # the first call's retweets response says we only have two calls left
+    self.expect_urlopen(TIMELINE, tweets[:1])
+    self.expect_urlopen(API_RETWEETS % 1, RETWEETS, response_headers={
+      'x-rate-limit-remaining': '2',
+      'x-rate-limit-reset': str(int(time.time()) + 60),
+    })
+    self.expect_urlopen(TIMELINE, tweets)
+    self.expect_urlopen(API_RETWEETS % 2, RETWEETS).InAnyOrder()
+    self.expect_urlopen(API_RETWEETS % 3, RETWEETS).InAnyOrder()
+    self.mox.ReplayAll()
+
+    cache = {}
+    self.twitter.get_activities(fetch_shares=True, cache=cache)
+    self.twitter.get_activities(fetch_shares=True, cache=cache)
+
+    # tweet 4 wasn't fetched, so it should be retried next time
+    self.assertEqual({'ATR 1': 1, 'ATR 2': 1, 'ATR 3': 1}, cache)
+
+  def test_reply_searches_limited_by_rate_limit_headers(self):
+    ratelimits.rate_limits.update(self.twitter._rate_limit_key(API_SEARCH), {
+      'x-rate-limit-remaining': '1',
+      'x-rate-limit-reset': str(int(time.time()) + 60),
+    })
+
+    self.expect_urlopen(TIMELINE, [TWEET])
+    self.expect_urlopen(API_SEARCH % {'q': '%40snarfed_org', 'count': 100},
+                        REPLIES_TO_SNARFED)
+    self.mox.ReplayAll()
+
+    # alice's and bob's mentions aren't searched, so we only get direct replies
+    activity = self.twitter.get_activities(fetch_replies=True)[0]
+    self.assert_equals([tag_uri('200'), tag_uri('300')],
+                       [r['id'] for r in activity['object']['replies']['items']])
+
+  def test_urlopen_conditional_get_replays_304(self):
+    self.twitter.validators = httputil.ValidatorStore()
+    self.expect_urlopen(API_STATUS % 1, TWEET, response_headers={'ETag': '"abc"'})
+    self.expect_urlopen(API_STATUS % 1, status=304,
+                        headers={'If-none-match': '"abc"'})
+    self.mox.ReplayAll()
+
+    for _ in range(2):
+      self.assert_equals(TWEET, self.twitter.urlopen(API_STATUS % 1))
+
+  def test_urlopen_records_rate_limit_on_error(self):
+    self.expect_urlopen(API_STATUS % 123, status=429, response='',
+                        response_headers={'Retry-After': '30'})
+    self.mox.ReplayAll()
+
+    with self.assertRaises(urllib.error.HTTPError):
+      self.twitter.urlopen(API_STATUS % 123)
+
+    key = self.twitter._rate_limit_key(API_STATUS % 456)
+    self.assertEqual(0, ratelimits.rate_limits.remaining(key))
+    self.assertAlmostEqual(time.time() + 30, ratelimits.rate_limits.reset(key),
+                           delta=5)
+
+  def test_get_activities_fetch_shares_and_likes_concurrently(self):
+    tweets = [{**copy.deepcopy(TWEET), 'id_str': str(i), 'retweet_count': 1,
+               'favorite_count': 2} for i in range(1, 5)]
+    self.expect_urlopen(TIMELINE, tweets)
+
+    for i in range(1, 4):
+      self.expect_urlopen(API_RETWEETS % i, RETWEETS).InAnyOrder('retweets')
+    self.expect_urlopen(API_RETWEETS % 4).InAnyOrder('retweets').AndRaise(
+      urllib.error.HTTPError('url', 404, 'msg', {}, None))
+
+    for i in range(1, 4):
+      self.expect_requests_get(SCRAPE_LIKES_URL % i, LIKES_SCRAPED,
+                               headers={'x': 'y'}).InAnyOrder('likes')
+    self.mox.ReplayAll()
+
+    serialize_http_mocks(self)
+
+    tw = twitter.Twitter('key', 'secret', scrape_headers={'x': 'y'},
+                         max_workers=3)
+    cache = {'ATF 4': 2}
+    got = tw.get_activities(fetch_shares=True, fetch_likes=True, cache=cache)
+
+    self.assertEqual([tag_uri(str(i)) for i in range(1, 5)],
+                     [a['object']['id'] for a in got])
+    for activity in got[:3]:
+      self.assertEqual(
+        ['like', 'like', 'like', 'share', 'share'],
+        sorted(t['verb'] for t in activity['object']['tags']
+               if t.get('verb') in ('like', 'share')))
+    self.assertEqual({'ATR 1': 1, 'ATR 2': 1, 'ATR 3': 1, 'ATR 4': 1,
+                      'ATF 1': 2, 'ATF 2': 2, 'ATF 3': 2, 'ATF 4': 2}, cache)
+
+  @requires_httpx
+  def test_aget_activities_fetch_shares_and_likes(self):
+    tweets = [{**copy.deepcopy(TWEET), 'id_str': str(i), 'retweet_count': 1,
+               'favorite_count': 2} for i in range(1, 4)]
+    responses = {twitter.API_BASE + TIMELINE: tweets}
+    for i in range(1, 3):
+      responses[twitter.API_BASE + API_RETWEETS % i] = RETWEETS
+    for i in range(1, 4):
+      responses[SCRAPE_LIKES_URL % i] = LIKES_SCRAPED
+
+    def handler(request):
+      url = str(request.url)
+      if 'liked_by' in url:
+        self.assertEqual('y', request.headers['x'])
+      else:
+        self.assertTrue(request.headers['Authorization'].startswith('OAuth '))
+      if url in responses:
+        return httputil.httpx.Response(200, json=responses[url],
+                                     headers={'ETag': '"my etag"'})
+      return httputil.httpx.Response(404)  # retweets of tweet 3
+
+    tw = twitter.Twitter('key', 'secret', scrape_headers={'x': 'y'},
+                         async_client=mock_async_client(handler))
+    cache = {}
+    resp = asyncio.run(tw.aget_activities_response(
+      fetch_shares=True, fetch_likes=True, cache=cache))
+    self.assertEqual('"my etag"', resp['etag'])
+
+    got = resp['items']
+    self.assertEqual([tag_uri(str(i)) for i in range(1, 4)],
+                     [a['object']['id'] for a in got])
+    for activity, num_shares in zip(got, (2, 2, 0)):
+      self.assertEqual(
+        ['like'] * 3 + ['share'] * num_shares,
+        sorted(t['verb'] for t in activity['object']['tags']
+               if t.get('verb') in ('like', 'share')))
+    self.assertEqual({'ATR 1': 1, 'ATR 2': 1, 'ATR 3': 1,
+                      'ATF 1': 2, 'ATF 2': 2, 'ATF 3': 2}, cache)
+
+  @requires_httpx
+  def test_ascrape_likes_errors(self):
+    def handler(request):
+      if request.url.params['tweet_id'] == '1':
+        raise httputil.httpx.ConnectError('nope', request=request)
+      return httputil.httpx.Response(500, text='bad')
+
+    tw = twitter.Twitter('key', 'secret', scrape_headers={'x': 'y'},
+                         async_client=mock_async_client(handler))
+    self.assertIsNone(asyncio.run(tw._ascrape_likes('1')))
+    self.assertIsNone(asyncio.run(tw._ascrape_likes('2')))
+
+  @requires_httpx
+  def test_aget_activities_304_not_modified(self):
+    def handler(request):
+      self.assertEqual('"my etag"', request.headers['If-None-Match'])
+      return httputil.httpx.Response(304)
+
+    tw = twitter.Twitter('key', 'secret', async_client=mock_async_client(handler))
+    self.assert_equals([], asyncio.run(tw.aget_activities(etag='"my etag"')))
+
+  @requires_httpx
+  def test_aget_actor_and_comment(self):
+    def handler(request):
+      return httputil.httpx.Response(200, json={
+        twitter.API_BASE + 'users/show.json?screen_name=foo': USER,
+        twitter.API_BASE + twitter.API_STATUS % '100': TWEET,
+      }[str(request.url)])
+
+    tw = twitter.Twitter('key', 'secret', async_client=mock_async_client(handler))
+    self.assert_equals(ACTOR, asyncio.run(tw.aget_actor('foo')))
+    self.assert_equals(OBJECT, asyncio.run(tw.aget_comment('100')))
+
   def test_get_activities_request_etag(self):
     self.expect_urlopen(TIMELINE, [], headers={'If-none-match': '"my etag"'})
     self.mox.ReplayAll()
@@ -2466,6 +2692,74 @@ the caption. extra long so we can check that it accounts for the pic-twitter-com
     self.assert_equals({'url': 'http://posted/picture', 'type': 'post'},
                        self.twitter.create(obj).content)
 
+  def test_create_with_photos_concurrently_and_cached(self):
+    tw = twitter.Twitter('key', 'secret', max_workers=2, media_cache={})
+    image_urls = ['http://my/picture/0', 'http://my/picture/1']
+    obj = {
+      'objectType': 'note',
+      'content': 'my content',
+      'image': [{'url': url} for url in image_urls],
+    }
+
+    for i, url in enumerate(image_urls):
+      content = f'picture response {i}'
+      self.expect_urlopen(url, content, response_headers={'Content-Length': 3}
+                          ).InAnyOrder()
+      # peek at the file instead of reading it, since mox may compare each
+      # call against both expectations
+      requests.post(
+        twitter.API_UPLOAD_MEDIA, timeout=mox.IgnoreArg(), stream=True,
+        headers=mox.IgnoreArg(), files=mox.Func(
+          lambda files, content=content: files['media'].content.getvalue() == content),
+      ).InAnyOrder().AndReturn(testutil.requests_response(
+        json_dumps({'media_id_string': str(i)})))
+
+    # second time, the media ids are cached, so it doesn't upload them again
+    for _ in range(2):
+      self.expect_urlopen(twitter.API_POST_TWEET, {'url': 'http://posted/picture'},
+                          params=(('media_ids', '0,1'), ('status', b'my content')))
+    self.mox.ReplayAll()
+    serialize_http_mocks(self)
+
+    for _ in range(2):
+      self.assert_equals({'url': 'http://posted/picture', 'type': 'post'},
+                         tw.create(obj).content)
+
+    self.assertEqual(2, len(tw.media_cache))
+    for key in tw.media_cache:
+      self.assertNotIn('key', key.split(' ', 1)[1])
+
+  def test_upload_video_cached_media_id(self):
+    self.twitter.media_cache = {}
+    content = 'video'
+    self.expect_video_urlopen(content)
+    self.expect_urlopen(twitter.API_UPLOAD_MEDIA, {'media_id_string': '9'},
+                        params={
+                          'command': 'INIT',
+                          'media_type': 'video/mp4',
+                          'media_category': 'tweet_video',
+                          'total_bytes': len(content),
+                        })
+    self.expect_requests_post(
+      twitter.API_UPLOAD_MEDIA, '',
+      data={'command': 'APPEND', 'media_id': '9', 'segment_index': 0},
+      files={'media': b'video'}, headers=mox.IgnoreArg())
+    self.expect_urlopen(twitter.API_UPLOAD_MEDIA, {
+      'media_id_string': '9',
+      'expires_after_secs': 60,
+    }, params={'command': 'FINALIZE', 'media_id': '9'})
+    self.mox.ReplayAll()
+
+    self.assertEqual('9', self.twitter.upload_video('http://my/video'))
+    self.assertEqual('9', self.twitter.upload_video('http://my/video'))
+
+    cached = list(self.twitter.media_cache.values())[0]
+    self.assertLessEqual(cached['expires'], time.time() + 60)
+
+    # expired
+    cached['expires'] = time.time() - 1
+    self.assertIsNone(self.twitter._cached_media_id('http://my/video'))
+
   def test_create_reply_with_photo(self):
     obj = {
       'objectType': 'note',
@@ -2721,6 +3015,11 @@ the caption. extra long so we can check that it accounts for the pic-twitter-com
     self.assert_equals({'url': 'http://posted/picture', 'type': 'post'},
                        self.twitter.create(obj).content)
 
+  def expect_video_urlopen(self, content, url='http://my/video'):
+    """Expects a video download. Its response body is bytes, like urllib's."""
+    self.expect_urlopen(url).AndReturn(urllib.response.addinfourl(
+      io.BytesIO(content.encode()), {'Content-Length': len(content)}, url))
+
   def test_create_with_video_wait_for_processing(self):
     self.twitter.TRUNCATE_TEXT_LENGTH = 140
 
@@ -2735,8 +3034,7 @@ the caption. extra long so we can check that it accounts for the pic-twitter-com
 
     # test create
     content = 'video response'
-    self.expect_urlopen('http://my/video', content,
-                        response_headers={'Content-Length': len(content)})
+    self.expect_video_urlopen(content)
 
     self.expect_urlopen(twitter.API_UPLOAD_MEDIA, {'media_id_string': '9'},
                         params={
@@ -2747,7 +3045,7 @@ the caption. extra long so we can check that it accounts for the pic-twitter-com
                         })
 
     twitter.UPLOAD_CHUNK_SIZE = 5
-    for i, chunk in (0, 'video'), (1, ' resp'), (2, 'onse'):
+    for i, chunk in (0, b'video'), (1, b' resp'), (2, b'onse'):
       self.expect_requests_post(
         twitter.API_UPLOAD_MEDIA, '',
         data={'command': 'APPEND', 'media_id': '9', 'segment_index': i},
@@ -2812,8 +3110,7 @@ the caption. extra long so we can check that it accounts for the pic-twitter-com
 
     # test create
     content = 'video response'
-    self.expect_urlopen('http://my/video', content,
-                        response_headers={'Content-Length': len(content)})
+    self.expect_video_urlopen(content)
 
     self.expect_urlopen(twitter.API_UPLOAD_MEDIA, {'media_id_string': '9'},
                         params={
@@ -2824,7 +3121,7 @@ the caption. extra long so we can check that it accounts for the pic-twitter-com
                         })
 
     twitter.UPLOAD_CHUNK_SIZE = 5
-    for i, chunk in (0, 'video'), (1, ' resp'), (2, 'onse'):
+    for i, chunk in (0, b'video'), (1, b' resp'), (2, b'onse'):
       self.expect_requests_post(
         twitter.API_UPLOAD_MEDIA, '',
         data={'command': 'APPEND', 'media_id': '9', 'segment_index': i},
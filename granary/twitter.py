@@ -8,8 +8,11 @@ the tweet author's 'protected' field is true or false.
 https://dev.twitter.com/docs/platform-objects/users
 """
 import collections
+import concurrent.futures
 import datetime
+import hashlib
 import http.client
+import io
 import itertools
 import logging
 import mimetypes
@@ -24,6 +27,8 @@ from oauth_dropins.webutil.util import json_dumps, json_loads
 from requests import RequestException
 
 from . import as1
+from . import httputil
+from . import ratelimits
 from . import source
 
 logger = logging.getLogger(__name__)
@@ -101,6 +106,9 @@ MB = 1024 * 1024
 MAX_IMAGE_SIZE = 5 * MB
 MAX_VIDEO_SIZE = 512 * MB
 UPLOAD_CHUNK_SIZE = 5 * MB
+# how long uploaded media ids can be attached to tweets, if the upload response
+# doesn't include expires_after_secs
+MEDIA_REUSE_SECS = 24 * 60 * 60
 MAX_ALT_LENGTH = 420
 
 # username requirements and limits:
@@ -168,7 +176,8 @@ class Twitter(source.Source):
   # TRUNCATE_URL_LENGTH = None
 
   def __init__(self, access_token_key, access_token_secret, username=None,
-               scrape_headers=None):
+               scrape_headers=None, max_workers=1, session=None,
+               async_client=None, mentions_cache=None, media_cache=None):
     """Constructor.
 
     Twitter now requires authentication in v1.1 of their API. You can get an
@@ -180,11 +189,30 @@ class Twitter(source.Source):
       username: string, optional, the current user. Used in e.g. preview/create.
       scrape_headers: dict, optional, with string HTTP header keys and values to
         use when scraping likes
+      max_workers: int, optional, max number of concurrent HTTP requests to
+        make when fetching each tweet's retweets and likes, searching for
+        replies, and uploading images. Defaults to 1, ie serially.
+      session: :class:`requests.Session`, optional, passed through to
+        :meth:`Source.__init__`. Only used for GETs.
+      async_client: :class:`httpx.AsyncClient`, optional, passed through to
+        :meth:`Source.__init__`
+      mentions_cache: :class:`caches.Cache` or dict, optional, caches the
+        @-mention searches that :meth:`fetch_replies` runs across calls, eg
+        ``caches.MemoryCache(ttl=300)``. The TTL bounds how stale replies can
+        be. Keyed by access token, so it can be shared across accounts. If not
+        provided, searches are only reused within a single call.
+      media_cache: :class:`caches.Cache` or dict, optional, caches uploaded
+        media ids by source URL until Twitter expires them, so that retried or
+        duplicate posts don't upload the same image or video again.
     """
+    super().__init__(session=session, async_client=async_client)
     self.access_token_key = access_token_key
     self.access_token_secret = access_token_secret
     self.username = username
     self.scrape_headers = scrape_headers
+    self.max_workers = max_workers
+    self.mentions_cache = mentions_cache
+    self.media_cache = media_cache
 
   def get_actor(self, screen_name=None):
     """Returns a user as a JSON ActivityStreams actor dict.
@@ -195,6 +223,11 @@ class Twitter(source.Source):
     url = API_CURRENT_USER if screen_name is None else API_USER % screen_name
     return self.user_to_actor(self.urlopen(url))
 
+  async def aget_actor(self, screen_name=None):
+    """Async version of :meth:`get_actor`."""
+    url = API_CURRENT_USER if screen_name is None else API_USER % screen_name
+    return self.user_to_actor(await self.aurlopen(url))
+
   def get_activities_response(self, user_id=None, group_id=None, app_id=None,
                               activity_id=None, start_index=0, count=0,
                               etag=None, min_id=None, cache=None,
@@ -231,6 +264,9 @@ class Twitter(source.Source):
     since that's Twitter's rate limit per 15 minute window. :(
     https://dev.twitter.com/docs/rate-limiting/1.1/limits
 
+    The per-tweet retweet and like fetches are made in parallel, up to the
+    constructor's max_workers at a time.
+
     Quote tweets are fetched by searching for the possibly quoted tweet's ID,
     using the OR operator to search up to 5 IDs at a time, and then checking
     the quoted_status_id_str field
@@ -257,18 +293,10 @@ class Twitter(source.Source):
       NotImplementedError: if fetch_likes is True but scrape_headers was not
         provided to the constructor.
     """
-    if fetch_likes and not self.scrape_headers:
-        raise NotImplementedError('fetch_likes requires scrape_headers')
-
+    user_id = self._check_activities_args(user_id, fetch_likes)
     if group_id is None:
       group_id = source.FRIENDS
 
-    if user_id:
-      if user_id.startswith('@'):
-        user_id = user_id[1:]
-      if not USERNAME_RE.match(user_id):
-        raise ValueError(f'Invalid Twitter username: {user_id}')
-
     # nested function for lazily fetching the user object if we need it
     user = []
 
@@ -289,106 +317,37 @@ class Twitter(source.Source):
       if group_id == source.SELF:
         if user_id in (None, source.ME):
           user_id = ''
-        url = API_USER_TIMELINE % {
-          'count': count,
-          'screen_name': user_id,
-        }
-
         if fetch_likes:
           liked = self.urlopen(API_FAVORITES % user_id)
           if liked:
             activities += [self._make_like(tweet, _user()) for tweet in liked]
-      elif group_id == source.SEARCH:
-        if not search_query:
-          raise ValueError('search requires search_query parameter')
-        url = API_SEARCH % {
-          'q': urllib.parse.quote_plus(search_query.encode('utf-8')),
-          'count': count,
-        }
-      elif group_id in (source.FRIENDS, source.ALL):
-        url = API_TIMELINE % (count)
-      else:
-        if util.is_int(group_id):
-          # it's a list id
-          url = API_LIST_ID_TIMELINE % {
-            'count': count,
-            'list_id': group_id,
-          }
-        else:
-          # it's a list slug
-          if not user_id:
-            user_id = _user().get('screen_name')
-          url = API_LIST_TIMELINE % {
-            'count': count,
-            'slug': urllib.parse.quote(group_id),
-            'owner_screen_name': user_id,
-          }
+      elif self._is_list_slug(group_id) and not user_id:
+        user_id = _user().get('screen_name')
+      url = self._timeline_url(user_id, group_id, count, search_query)
 
       headers = {'If-None-Match': etag} if etag else {}
       total_count = None
       try:
         resp = self.urlopen(url, headers=headers, parse_response=False)
         etag = resp.info().get('ETag')
-        tweet_obj = source.load_json(resp.read(), url)
-        if group_id == source.SEARCH:
-          tweet_obj = tweet_obj.get('statuses', [])
-        tweets = tweet_obj[start_index:]
+        tweets = self._extract_tweets(source.load_json(resp.read(), url),
+                                      group_id, start_index)
       except urllib.error.HTTPError as e:
         if e.code == 304:  # Not Modified, from a matching ETag
           tweets = []
         else:
           raise
 
-    if cache is None:
-      # for convenience, throwaway object just for this method
-      cache = {}
+    cache = self._cache_or_default(cache)
 
     if fetch_shares:
-      retweet_calls = 0
-      for tweet in tweets:
-        # don't fetch retweets if the tweet is itself a retweet or if the
-        # author's account is protected. /statuses/retweets 403s with error
-        # code 200 (?!) for protected accounts.
-        # https://github.com/snarfed/bridgy/issues/688
-        if tweet.get('retweeted') or tweet.get('user', {}).get('protected'):
-          continue
-        elif retweet_calls >= RETWEET_LIMIT:
-          logger.warning(f"Hit Twitter's retweet rate limit ({RETWEET_LIMIT}) with more to fetch! Results will be incomplete!")
-          break
-
-        # store retweets in the 'retweets' field, which is handled by
-        # tweet_to_activity().
-        # TODO: make these HTTP requests asynchronous. not easy since we don't
-        # (yet) require threading support or use a non-blocking HTTP library.
-        #
-        # twitter limits this API endpoint to one call per minute per user,
-        # which is easy to hit, so we stop before we hit that.
-        # https://dev.twitter.com/docs/rate-limiting/1.1/limits
-        #
-        # can't use the statuses/retweets_of_me endpoint because it only
-        # returns the original tweets, not the retweets or their authors.
-        id = tweet['id_str']
-        count = tweet.get('retweet_count')
-        if count and count != cache.get('ATR ' + id):
-          url = API_RETWEETS % id
-          if min_id is not None:
-            url = util.add_query_params(url, {'since_id': min_id})
-
-          try:
-            tweet['retweets'] = self.urlopen(url)
-          except urllib.error.URLError as e:
-            code, body = util.interpret_http_exception(e)
-            try:
-              # duplicates code in interpret_http_exception :(
-              error_code = json_loads(body).get('errors')[0].get('code')
-            except BaseException:
-              error_code = None
-            if not (code == '404' or  # tweet was deleted
-                    (code == '403' and error_code == 200)):  # tweet is protected?
-              raise
-
-          retweet_calls += 1
-          cache['ATR ' + id] = count
+      to_fetch = self._retweets_to_fetch(tweets, cache)
+      to_fetch = to_fetch[:ratelimits.rate_limits.limit(
+        self._rate_limit_key(API_RETWEETS), len(to_fetch))]
+      fetched = httputil.map_concurrently(
+        lambda tweet: self._fetch_retweets(tweet['id_str'], min_id=min_id),
+        to_fetch, max_workers=self.max_workers)
+      self._merge_retweets(to_fetch, fetched, cache)
 
     if not include_shares:
       tweets = [t for t in tweets if not t.get('retweeted_status')]
@@ -406,28 +365,324 @@ class Twitter(source.Source):
       tweet_activities += [self.tweet_to_activity(m) for m in mentions]
 
     if fetch_likes:
-      for tweet, activity in zip(tweets, tweet_activities):
-        id = tweet['id_str']
-        count = tweet.get('favorite_count')
-        if as1.is_public(activity) and count and count != cache.get('ATF ' + id):
-          try:
-            resp = util.requests_get(SCRAPE_LIKES_URL % id,
-                                     headers=self.scrape_headers)
-            resp.raise_for_status()
-          except RequestException as e:
-            util.interpret_http_exception(e)  # just log it
-            continue
-
-          likes = [self._make_like(tweet, author) for author in
-                   resp.json().get('globalObjects', {}).get('users', {}).values()]
-          activity['object'].setdefault('tags', []).extend(likes)
-          cache['ATF ' + id] = count
+      to_fetch = self._likes_to_fetch(tweets, tweet_activities, cache)
+      fetched = httputil.map_concurrently(
+        lambda pair: self._scrape_likes(pair[0]['id_str']),
+        to_fetch, max_workers=self.max_workers)
+      self._merge_likes(to_fetch, fetched, cache)
+
+    activities += tweet_activities
+    response = self.make_activities_base_response(activities)
+    response.update({'total_count': total_count, 'etag': etag})
+    return response
+
+  async def aget_activities_response(
+      self, user_id=None, group_id=None, app_id=None, activity_id=None,
+      start_index=0, count=0, etag=None, min_id=None, cache=None,
+      fetch_replies=False, fetch_likes=False, fetch_shares=False,
+      include_shares=True, fetch_events=False, fetch_mentions=False,
+      search_query=None, scrape=False, **kwargs):
+    """Async version of :meth:`get_activities_response`.
+
+    The timeline, retweets, and likes are fetched natively with httpx, the
+    per-tweet retweet and like fetches concurrently, up to
+    :const:`httputil.ASYNC_MAX_CONCURRENCY` at once. Replies and mentions use
+    search and are run with :meth:`fetch_replies` and :meth:`fetch_mentions`
+    in the event loop's default executor.
+    """
+    user_id = self._check_activities_args(user_id, fetch_likes)
+    if group_id is None:
+      group_id = source.FRIENDS
+
+    user = []
+
+    async def _user():
+      if not user:
+        user.append(await self.aurlopen(
+          API_USER % user_id if user_id else API_CURRENT_USER))
+      return user[0]
+
+    if count:
+      count += start_index
+
+    activities = []
+    if activity_id:
+      self._validate_id(activity_id)
+      tweets = [await self.aurlopen(API_STATUS % int(activity_id))]
+      total_count = len(tweets)
+    else:
+      if group_id == source.SELF:
+        if user_id in (None, source.ME):
+          user_id = ''
+        if fetch_likes:
+          liked = await self.aurlopen(API_FAVORITES % user_id)
+          if liked:
+            activities += [self._make_like(tweet, await _user())
+                           for tweet in liked]
+      elif self._is_list_slug(group_id) and not user_id:
+        user_id = (await _user()).get('screen_name')
+      url = self._timeline_url(user_id, group_id, count, search_query)
+
+      total_count = None
+      resp = await self.aurlopen(url, parse_response=False,
+                                 headers={'If-None-Match': etag} if etag else {})
+      if resp.status_code == 304:  # Not Modified, from a matching ETag
+        tweets = []
+      else:
+        resp.raise_for_status()
+        etag = resp.headers.get('ETag')
+        tweets = self._extract_tweets(resp.json(), group_id, start_index)
+
+    cache = self._cache_or_default(cache)
+
+    if fetch_shares:
+      to_fetch = self._retweets_to_fetch(tweets, cache)
+      to_fetch = to_fetch[:ratelimits.rate_limits.limit(
+        self._rate_limit_key(API_RETWEETS), len(to_fetch))]
+      fetched = await httputil.amap_concurrently(
+        lambda tweet: self._afetch_retweets(tweet['id_str'], min_id=min_id),
+        to_fetch)
+      self._merge_retweets(to_fetch, fetched, cache)
+
+    if not include_shares:
+      tweets = [t for t in tweets if not t.get('retweeted_status')]
+
+    tweet_activities = [self.tweet_to_activity(t) for t in tweets]
+
+    if fetch_replies:
+      await self._run_in_executor(self.fetch_replies, tweet_activities,
+                                  min_id=min_id)
+
+    if fetch_mentions:
+      mentions = await self._run_in_executor(
+        self.fetch_mentions, (await _user()).get('screen_name'), tweets,
+        min_id=min_id)
+      tweet_activities += [self.tweet_to_activity(m) for m in mentions]
+
+    if fetch_likes:
+      to_fetch = self._likes_to_fetch(tweets, tweet_activities, cache)
+      fetched = await httputil.amap_concurrently(
+        lambda pair: self._ascrape_likes(pair[0]['id_str']), to_fetch)
+      self._merge_likes(to_fetch, fetched, cache)
 
     activities += tweet_activities
     response = self.make_activities_base_response(activities)
     response.update({'total_count': total_count, 'etag': etag})
     return response
 
+  def _check_activities_args(self, user_id, fetch_likes):
+    """Validates get_activities_response args.
+
+    Returns:
+      string user_id, without leading @
+    """
+    if fetch_likes and not self.scrape_headers:
+        raise NotImplementedError('fetch_likes requires scrape_headers')
+
+    if user_id:
+      if user_id.startswith('@'):
+        user_id = user_id[1:]
+      if not USERNAME_RE.match(user_id):
+        raise ValueError(f'Invalid Twitter username: {user_id}')
+
+    return user_id
+
+  @staticmethod
+  def _is_list_slug(group_id):
+    return (group_id not in (source.SELF, source.SEARCH, source.FRIENDS,
+                             source.ALL)
+            and not util.is_int(group_id))
+
+  @staticmethod
+  def _timeline_url(user_id, group_id, count, search_query):
+    """Returns the API URL for fetching a timeline, search, or list.
+
+    For list slugs, user_id must be the list owner's screen name.
+    """
+    if group_id == source.SELF:
+      return API_USER_TIMELINE % {
+        'count': count,
+        'screen_name': user_id,
+      }
+    elif group_id == source.SEARCH:
+      if not search_query:
+        raise ValueError('search requires search_query parameter')
+      return API_SEARCH % {
+        'q': urllib.parse.quote_plus(search_query.encode('utf-8')),
+        'count': count,
+      }
+    elif group_id in (source.FRIENDS, source.ALL):
+      return API_TIMELINE % (count)
+    elif util.is_int(group_id):
+      # it's a list id
+      return API_LIST_ID_TIMELINE % {
+        'count': count,
+        'list_id': group_id,
+      }
+    else:
+      # it's a list slug
+      return API_LIST_TIMELINE % {
+        'count': count,
+        'slug': urllib.parse.quote(group_id),
+        'owner_screen_name': user_id,
+      }
+
+  @staticmethod
+  def _extract_tweets(tweet_obj, group_id, start_index):
+    """Returns the tweets in a :meth:`_timeline_url` API response."""
+    if group_id == source.SEARCH:
+      tweet_obj = tweet_obj.get('statuses', [])
+    return tweet_obj[start_index:]
+
+  @staticmethod
+  def _retweets_to_fetch(tweets, cache):
+    """Returns the tweets whose retweets need to be fetched."""
+    to_fetch = []
+    for tweet in tweets:
+      # don't fetch retweets if the tweet is itself a retweet or if the
+      # author's account is protected. /statuses/retweets 403s with error
+      # code 200 (?!) for protected accounts.
+      # https://github.com/snarfed/bridgy/issues/688
+      if tweet.get('retweeted') or tweet.get('user', {}).get('protected'):
+        continue
+      elif len(to_fetch) >= RETWEET_LIMIT:
+        logger.warning(f"Hit Twitter's retweet rate limit ({RETWEET_LIMIT}) with more to fetch! Results will be incomplete!")
+        break
+
+      # twitter limits this API endpoint to one call per minute per user,
+      # which is easy to hit, so we stop before we hit that.
+      # https://dev.twitter.com/docs/rate-limiting/1.1/limits
+      #
+      # can't use the statuses/retweets_of_me endpoint because it only
+      # returns the original tweets, not the retweets or their authors.
+      count = tweet.get('retweet_count')
+      if count and count != cache.get('ATR ' + tweet['id_str']):
+        to_fetch.append(tweet)
+
+    return to_fetch
+
+  @staticmethod
+  def _merge_retweets(tweets, fetched, cache):
+    """Stores fetched retweets in each tweet's 'retweets' field.
+
+    That field is handled by :meth:`tweet_to_activity`.
+    """
+    for tweet, retweets in zip(tweets, fetched):
+      if retweets is not None:
+        tweet['retweets'] = retweets
+      cache['ATR ' + tweet['id_str']] = tweet.get('retweet_count')
+
+  @staticmethod
+  def _likes_to_fetch(tweets, activities, cache):
+    """Returns the (tweet, activity) pairs whose likes need to be scraped."""
+    to_fetch = []
+    for tweet, activity in zip(tweets, activities):
+      count = tweet.get('favorite_count')
+      if (as1.is_public(activity) and count and
+          count != cache.get('ATF ' + tweet['id_str'])):
+        to_fetch.append((tweet, activity))
+
+    return to_fetch
+
+  def _merge_likes(self, to_fetch, fetched, cache):
+    """Adds scraped likes to their activities' tags."""
+    for (tweet, activity), likers in zip(to_fetch, fetched):
+      if likers is None:
+        continue
+      likes = [self._make_like(tweet, author) for author in likers]
+      activity['object'].setdefault('tags', []).extend(likes)
+      cache['ATF ' + tweet['id_str']] = tweet.get('favorite_count')
+
+  def _fetch_retweets(self, id, min_id=None):
+    """Fetches a tweet's retweets. Thread safe.
+
+    Args:
+      id: string tweet id
+      min_id: only return retweets with ids greater than this
+
+    Returns:
+      list of Twitter retweet objects, or None if the tweet was deleted or is
+      protected
+    """
+    url = API_RETWEETS % id
+    if min_id is not None:
+      url = util.add_query_params(url, {'since_id': min_id})
+
+    try:
+      return self.urlopen(url)
+    except urllib.error.URLError as e:
+      code, body = util.interpret_http_exception(e)
+      if not self._is_deleted_or_protected(code, body):
+        raise
+
+  async def _afetch_retweets(self, id, min_id=None):
+    """Async version of :meth:`_fetch_retweets`."""
+    url = API_RETWEETS % id
+    if min_id is not None:
+      url = util.add_query_params(url, {'since_id': min_id})
+
+    resp = await self.aurlopen(url, parse_response=False)
+    if resp.is_error and self._is_deleted_or_protected(str(resp.status_code),
+                                                       resp.text):
+      return None
+    resp.raise_for_status()
+    return resp.json()
+
+  @staticmethod
+  def _is_deleted_or_protected(code, body):
+    """Returns True if a retweets API error means we should skip the tweet.
+
+    Args:
+      code: string HTTP status code
+      body: string HTTP response body
+    """
+    try:
+      # duplicates code in interpret_http_exception :(
+      error_code = json_loads(body).get('errors')[0].get('code')
+    except BaseException:
+      error_code = None
+    return (code == '404' or  # tweet was deleted
+            (code == '403' and error_code == 200))  # tweet is protected?
+
+  def _scrape_likes(self, id):
+    """Scrapes the users who liked a tweet. Thread safe.
+
+    Args:
+      id: string tweet id
+
+    Returns:
+      list of Twitter user objects, or None if the scrape failed
+    """
+    try:
+      resp = httputil.requests_fn('get', session=self.session)(
+        SCRAPE_LIKES_URL % id, headers=self.scrape_headers)
+      resp.raise_for_status()
+    except RequestException as e:
+      util.interpret_http_exception(e)  # just log it
+      return None
+
+    return self._likers(resp.json())
+
+  async def _ascrape_likes(self, id):
+    """Async version of :meth:`_scrape_likes`."""
+    try:
+      resp = await httputil.arequest('GET', SCRAPE_LIKES_URL % id,
+                                   client=self.async_client,
+                                   headers=dict(self.scrape_headers))
+      if resp.is_error:
+        resp.raise_for_status()
+    except httputil.httpx.HTTPError as e:
+      # includes transport errors, eg connection failures and timeouts
+      logger.info(f'Scraping likes failed: {e}')
+      return None
+
+    return self._likers(resp.json())
+
+  @staticmethod
+  def _likers(resp):
+    """Returns the users in a :const:`SCRAPE_LIKES_URL` response."""
+    return list(resp.get('globalObjects', {}).get('users', {}).values())
+
   def fetch_replies(self, activities, min_id=None):
     """Fetches and injects Twitter replies into a list of activities, in place.
 
@@ -435,6 +690,10 @@ class Twitter(source.Source):
     for @-mentions, matches them to the original tweets with
     in_reply_to_status_id_str, and recurses until it's walked the entire tree.
 
+    Walks each reply tree one level at a time, and searches for all of a level's
+    new authors concurrently, up to the constructor's max_workers at once.
+    Searches are cached in the constructor's mentions_cache, if provided.
+
     Args:
       activities: list of activity dicts
 
@@ -442,10 +701,27 @@ class Twitter(source.Source):
       same activities list
     """
 
-    # cache searches for @-mentions for individual users. maps username to dict
-    # mapping tweet id to ActivityStreams reply object dict.
+    # cache searches for @-mentions for individual users. maps username to list
+    # of Twitter API tweet objects.
     mentions = {}
 
+    def search(authors):
+      """Searches for mentions of the authors we haven't already searched.
+
+      Skips authors beyond the search API's remaining rate limit budget.
+      """
+      authors = [a for a in dict.fromkeys(authors) if a not in mentions]
+      limit = ratelimits.rate_limits.limit(self._rate_limit_key(API_SEARCH),
+                                       len(authors))
+      mentions.update((author, []) for author in authors[limit:])
+      authors = authors[:limit]
+      results = httputil.map_concurrently(
+        lambda author: self._search_mentions(author, min_id=min_id), authors,
+        max_workers=self.max_workers)
+      mentions.update(zip(authors, results))
+
+    search(activity['actor']['username'] for activity in activities)
+
     # find replies
     for activity in activities:
       # list of ActivityStreams reply object dict and set of seen activity ids
@@ -454,24 +730,16 @@ class Twitter(source.Source):
       _, id = util.parse_tag_uri(activity['id'])
       seen_ids = set([id])
 
-      for reply in replies:
+      for i, reply in enumerate(replies):
         # get mentions of this tweet's author so we can search them for replies to
         # this tweet. can't use statuses/mentions_timeline because i'd need to
         # auth as the user being mentioned.
         # https://dev.twitter.com/docs/api/1.1/get/statuses/mentions_timeline
-        #
-        # note that these HTTP requests are synchronous. you can make async
-        # requests by using urlfetch.fetch() directly, but not with urllib2.
-        # https://developers.google.com/appengine/docs/python/urlfetch/asynchronousrequests
         author = reply['actor']['username']
         if author not in mentions:
-          url = API_SEARCH % {
-            'q': urllib.parse.quote_plus('@' + author),
-            'count': 100,
-          }
-          if min_id is not None:
-            url = util.add_query_params(url, {'since_id': min_id})
-          mentions[author] = self.urlopen(url)['statuses']
+          # we've reached a new level of the reply tree. search for all of its
+          # authors at once.
+          search(r['actor']['username'] for r in replies[i:])
 
         # look for replies. add any we find to the end of replies. this makes us
         # recursively follow reply chains to their end. (python supports
@@ -489,6 +757,36 @@ class Twitter(source.Source):
         'totalItems': len(items),
       }
 
+  def _search_mentions(self, username, min_id=None):
+    """Searches for tweets that @-mention a user. Uses mentions_cache if set.
+
+    Args:
+      username: string
+      min_id: only return tweets with ids greater than this
+
+    Returns:
+      list of Twitter API tweet objects
+    """
+    # search results depend on the account, eg its blocks and mutes
+    token = hashlib.sha256((self.access_token_key or '').encode()).hexdigest()[:16]
+    cache_key = f'ATM {token} {username} {min_id or ""}'
+    if self.mentions_cache is not None:
+      statuses = self.mentions_cache.get(cache_key)
+      if statuses is not None:
+        return statuses
+
+    url = API_SEARCH % {
+      'q': urllib.parse.quote_plus('@' + username),
+      'count': 100,
+    }
+    if min_id is not None:
+      url = util.add_query_params(url, {'since_id': min_id})
+    statuses = self.urlopen(url)['statuses']
+
+    if self.mentions_cache is not None:
+      self.mentions_cache[cache_key] = statuses
+    return statuses
+
   def fetch_mentions(self, username, tweets, min_id=None):
     """Fetches a user's @-mentions and returns them as ActivityStreams.
 
@@ -574,6 +872,13 @@ class Twitter(source.Source):
     url = API_STATUS % comment_id
     return self.tweet_to_object(self.urlopen(url))
 
+  async def aget_comment(self, comment_id, activity_id=None,
+                         activity_author_id=None, activity=None):
+    """Async version of :meth:`get_comment`."""
+    self._validate_id(comment_id)
+    url = API_STATUS % comment_id
+    return self.tweet_to_object(await self.aurlopen(url))
+
   def get_share(self, activity_user_id, activity_id, share_id, activity=None):
     """Returns an ActivityStreams 'share' activity object.
 
@@ -637,7 +942,9 @@ class Twitter(source.Source):
         resp = self.urlopen(api_endpoint % cursor)
       except urllib.error.HTTPError as e:
         if e.code in HTTP_RATE_LIMIT_CODES:
-          raise source.RateLimited(str(e), partial=values)
+          raise source.RateLimited(
+            str(e), partial=values,
+            reset=ratelimits.rate_limits.reset(self._rate_limit_key(api_endpoint)))
         raise
       values.extend(response_fn(resp))
       cursor = resp.get('next_cursor_str')
@@ -892,6 +1199,9 @@ class Twitter(source.Source):
 
     https://dev.twitter.com/rest/reference/post/media/upload
 
+    Uploads up to the constructor's max_workers images at once. Skips images
+    whose media ids are in media_cache.
+
     Note that files and JSON bodies in media POST API requests are *not*
     included in OAuth signatures.
     https://developer.twitter.com/en/docs/media/upload-media/uploading-media/media-best-practices
@@ -903,12 +1213,28 @@ class Twitter(source.Source):
     Returns:
       list of string media ids or :class:`CreationResult` on error
     """
-    ids = []
-    for image in images:
-      url = image.get('url')
-      if not url:
-        continue
+    ids = httputil.map_concurrently(self._upload_image,
+                                  [image for image in images if image.get('url')],
+                                  max_workers=self.max_workers)
+    for id in ids:
+      if isinstance(id, source.CreationResult):
+        return id
+
+    return ids
+
+  def _upload_image(self, image):
+    """Uploads a single image and sets its alt text. Used by :meth:`upload_images`.
 
+    Args:
+      image: AS image object
+
+    Returns:
+      string media id or :class:`CreationResult` on error
+    """
+    url = image['url']
+    media_id = self._cached_media_id(url)
+
+    if not media_id:
       image_resp = util.urlopen(url)
       error = self._check_media(url, image_resp, IMAGE_MIME_TYPES,
                                 'JPG, PNG, GIF, and WEBP images', MAX_IMAGE_SIZE)
@@ -922,22 +1248,23 @@ class Twitter(source.Source):
                                 headers=headers)
       resp.raise_for_status()
       logger.info(f'Got: {resp.text}')
-      media_id = source.load_json(resp.text, API_UPLOAD_MEDIA)['media_id_string']
-      ids.append(media_id)
-
-      alt = image.get('displayName')
-      if alt:
-        alt = util.ellipsize(alt, words=1000, chars=MAX_ALT_LENGTH)
-        headers = twitter_auth.auth_header(
-          API_MEDIA_METADATA, self.access_token_key, self.access_token_secret, 'POST')
-        resp = util.requests_post(
-          API_MEDIA_METADATA,
-          json={'media_id': media_id, 'alt_text': {'text': alt}},
-          headers=headers)
-        resp.raise_for_status()
-        logger.info(f'Got: {resp.text}')
+      resp = source.load_json(resp.text, API_UPLOAD_MEDIA)
+      media_id = resp['media_id_string']
+      self._cache_media_id(url, resp)
 
-    return ids
+    alt = image.get('displayName')
+    if alt:
+      alt = util.ellipsize(alt, words=1000, chars=MAX_ALT_LENGTH)
+      headers = twitter_auth.auth_header(
+        API_MEDIA_METADATA, self.access_token_key, self.access_token_secret, 'POST')
+      resp = util.requests_post(
+        API_MEDIA_METADATA,
+        json={'media_id': media_id, 'alt_text': {'text': alt}},
+        headers=headers)
+      resp.raise_for_status()
+      logger.info(f'Got: {resp.text}')
+
+    return media_id
 
   def upload_video(self, url):
     """Uploads a video from web URLs using the chunked upload process.
@@ -950,12 +1277,21 @@ class Twitter(source.Source):
 
     https://developer.twitter.com/en/docs/media/upload-media/uploading-media/chunked-media-upload
 
+    Streams the video from its URL into the APPEND calls. Downloads the next
+    block on a separate thread while the current one uploads, so at most two
+    blocks are held in memory at once. Skips the upload entirely if the video's
+    media id is in media_cache.
+
     Args:
       url: string URL of images
 
     Returns:
       string media id or :class:`CreationResult` on error
     """
+    media_id = self._cached_media_id(url)
+    if media_id:
+      return media_id
+
     video_resp = util.urlopen(url)
     error = self._check_media(url, video_resp, VIDEO_MIME_TYPES, 'MP4 videos',
                               MAX_VIDEO_SIZE)
@@ -976,21 +1312,24 @@ class Twitter(source.Source):
     headers = twitter_auth.auth_header(
       API_UPLOAD_MEDIA, self.access_token_key, self.access_token_secret, 'POST')
 
-    i = 0
-    while True:
-      chunk = util.FileLimiter(video_resp, UPLOAD_CHUNK_SIZE)
-      data = {
-        'command': 'APPEND',
-        'media_id': media_id,
-        'segment_index': i,
-      }
-      resp = util.requests_post(API_UPLOAD_MEDIA, data=data,
-                                files={'media': chunk}, headers=headers)
-      resp.raise_for_status()
-
-      if chunk.ateof:
-        break
-      i += 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as reader:
+      next_chunk = reader.submit(video_resp.read, UPLOAD_CHUNK_SIZE)
+      i = 0
+      while True:
+        chunk = next_chunk.result()
+        if not chunk:
+          break
+        next_chunk = reader.submit(video_resp.read, UPLOAD_CHUNK_SIZE)
+        data = {
+          'command': 'APPEND',
+          'media_id': media_id,
+          'segment_index': i,
+        }
+        resp = util.requests_post(API_UPLOAD_MEDIA, data=data,
+                                  files={'media': io.BytesIO(chunk)},
+                                  headers=headers)
+        resp.raise_for_status()
+        i += 1
 
     # FINALIZE
     resp = self.urlopen(API_UPLOAD_MEDIA, data=urllib.parse.urlencode({
@@ -1003,6 +1342,7 @@ class Twitter(source.Source):
       info = resp.get('processing_info', {})
       state = info.get('state')
       if not state or state == 'succeeded':
+        self._cache_media_id(url, resp)
         return media_id
       elif state == 'failed':
         # TODO test
@@ -1024,6 +1364,39 @@ class Twitter(source.Source):
     msg = f'Twitter still processing uploaded video after {total_delay}s'
     return source.creation_result(abort=True, error_plain=msg)
 
+  def _media_cache_key(self, url):
+    """Returns the media_cache key for a source media URL.
+
+    Media ids belong to the user who uploaded them, so the key includes the
+    access token. It's hashed so that the token doesn't end up in the cache.
+    """
+    key = hashlib.sha256(f'{self.access_token_key} {url}'.encode()).hexdigest()
+    return f'ATMU {key}'
+
+  def _cached_media_id(self, url):
+    """Returns a source media URL's unexpired uploaded media id, or None."""
+    if self.media_cache is None:
+      return None
+
+    cached = self.media_cache.get(self._media_cache_key(url))
+    if cached and cached.get('expires', 0) > time.time():
+      logger.info(f'Reusing media id {cached["id"]} for {url}')
+      return cached['id']
+
+  def _cache_media_id(self, url, resp):
+    """Stores an uploaded media id in media_cache, if it's set.
+
+    Args:
+      url: string, source media URL
+      resp: dict, Twitter API media upload or FINALIZE response
+    """
+    if self.media_cache is not None:
+      expires_after = resp.get('expires_after_secs') or MEDIA_REUSE_SECS
+      self.media_cache[self._media_cache_key(url)] = {
+        'id': resp['media_id_string'],
+        'expires': time.time() + expires_after,
+      }
+
   @staticmethod
   def _check_media(url, resp, types, label, max_size):
     """Checks that an image or video is an allowed type and size.
@@ -1082,14 +1455,50 @@ class Twitter(source.Source):
 {self.embed_post({'url': url})}""")
 
   def urlopen(self, url, parse_response=True, **kwargs):
-    """Wraps :func:`urllib2.urlopen()` and adds an OAuth signature."""
+    """Wraps :func:`urllib2.urlopen()` and adds an OAuth signature.
+
+    If :attr:`validators` is set, GETs with parse_response=True are sent as
+    conditional requests, and HTTP 304 responses return the stored body.
+    """
     if not url.startswith('http'):
       url = API_BASE + url
 
+    stored = None
+    if parse_response and 'data' not in kwargs:
+      kwargs['headers'], stored = self._conditional_headers(
+        url, self.access_token_key, kwargs.get('headers'))
+
+    def send():
+      if self.session is not None and 'data' not in kwargs:
+        headers = kwargs.get('headers') or {}
+        headers.update(twitter_auth.auth_header(
+          url, self.access_token_key, self.access_token_secret))
+        resp = httputil.urlopen(urllib.request.Request(url, headers=headers),
+                              session=self.session)
+      else:
+        resp = twitter_auth.signed_urlopen(
+          url, self.access_token_key, self.access_token_secret, **kwargs)
+      return resp
+
     def request():
-      resp = twitter_auth.signed_urlopen(
-        url, self.access_token_key, self.access_token_secret, **kwargs)
-      return source.load_json(resp.read(), url) if parse_response else resp
+      try:
+        resp = send()
+      except urllib.error.HTTPError as e:
+        ratelimits.rate_limits.update(self._rate_limit_key(url), e.headers,
+                                  status=e.code)
+        if e.code == 304 and stored is not None:
+          return source.load_json(stored, url)
+        raise
+      info = getattr(resp, 'info', None)
+      if info:
+        ratelimits.rate_limits.update(self._rate_limit_key(url), info())
+      if not parse_response:
+        return resp
+
+      body = resp.read()
+      if info and 'data' not in kwargs:
+        self._store_validators(url, self.access_token_key, info(), body)
+      return source.load_json(body, url)
 
     if ('data' not in kwargs and not
         (isinstance(url, urllib.request.Request) and url.get_method() == 'POST')):
@@ -1111,6 +1520,63 @@ class Twitter(source.Source):
     # last try. if it deadlines, let the exception bubble up.
     return request()
 
+  async def aurlopen(self, url, parse_response=True, headers=None):
+    """Async version of :meth:`urlopen`. Only supports GETs. Requires httpx.
+
+    Retries on HTTP 500, 501, and 502 like :meth:`urlopen`.
+
+    Args:
+      url: string
+      parse_response: boolean. If True, raises on HTTP errors and returns the
+        decoded JSON response body. If False, returns the
+        :class:`httpx.Response` as is, without checking its status.
+      headers: dict, optional HTTP headers
+
+    Returns: decoded JSON object or :class:`httpx.Response`
+    """
+    if not url.startswith('http'):
+      url = API_BASE + url
+
+    stored = None
+    if parse_response:
+      headers, stored = self._conditional_headers(url, self.access_token_key,
+                                                  headers)
+    headers = dict(headers or {})
+    headers.update(twitter_auth.auth_header(
+      url, self.access_token_key, self.access_token_secret))
+
+    for i in range(RETRIES + 1):
+      resp = await httputil.arequest('GET', url, client=self.async_client,
+                                   headers=headers)
+      ratelimits.rate_limits.update(self._rate_limit_key(url), resp.headers,
+                                status=resp.status_code)
+      if resp.status_code not in (500, 501, 502) or i == RETRIES:
+        break
+      logger.info('Twitter API call failed! Retrying...')
+
+    if not parse_response:
+      return resp
+    elif resp.status_code == 304 and stored is not None:
+      return source.load_json(stored, url)
+
+    resp.raise_for_status()
+    self._store_validators(url, self.access_token_key, resp.headers, resp.text)
+    return source.load_json(resp.text, url)
+
+  def _rate_limit_key(self, url):
+    """Returns the :class:`ratelimits.RateLimits` key for an API URL.
+
+    Twitter rate limits each endpoint separately, so the key includes the
+    endpoint's path, with ids replaced by ``:id``.
+    https://developer.twitter.com/en/docs/twitter-api/v1/rate-limits
+    """
+    if isinstance(url, urllib.request.Request):
+      url = url.full_url
+    path = urllib.parse.urlparse(urllib.parse.urljoin(API_BASE, url)).path
+    path = re.sub(r'^/1\.1|\.json$', '', path)
+    path = re.sub(r'/\d+(?=/|$)', '/:id', path)
+    return ratelimits.rate_limit_key(self.NAME, self.access_token_key, path)
+
   def base_object(self, obj):
     """Returns the 'base' silo object that an object operates on.
 
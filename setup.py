@@ -38,6 +38,7 @@ setup(name='granary',
       install_requires=[
           'beautifulsoup4>=4.8',
           'brevity>=0.2.17',
+          'cachetools>=4.0',
           'feedgen>=0.9',
           'feedparser',
           'html2text>=2019.8.11',
@@ -49,5 +50,8 @@ setup(name='granary',
           'python-dateutil>=2.8',
           'requests>=2.22',
       ],
-      tests_require=['mox3>=0.28'],
+      extras_require={
+          'async': ['httpx>=0.23'],
+      },
+      tests_require=['mox3>=0.28', 'httpx>=0.23'],
 )
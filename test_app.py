@@ -13,6 +13,7 @@ from oauth_dropins.webutil import testutil, util
 from oauth_dropins.webutil.util import json_dumps, json_loads
 import requests
 
+import app as app_module
 from app import app, cache
 
 client = app.test_client()
@@ -557,6 +558,24 @@ not atom!
     self.assert_equals('application/stream+json', resp.headers['Content-Type'])
     self.assert_equals(RSS_ACTIVITIES, [a['object'] for a in resp.json['items']])
 
+  def test_url_rss_to_as1_malformed_entity(self):
+    """Non-XML entities like &nbsp; are common in RSS. feedparser handles them."""
+    self.expect_requests_get('http://feed', """\
+<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0">
+<channel>
+<title>Feed&nbsp;title</title>
+<item><title>one</title><link>http://feed/1</link><description>a&nbsp;b</description></item>
+<item><title>two</title><link>http://feed/2</link></item>
+</channel>
+</rss>""")
+    self.mox.ReplayAll()
+
+    resp = client.get('/url?url=http://feed&input=rss&output=as1')
+    self.assert_equals(200, resp.status_code)
+    self.assert_equals(['http://feed/1', 'http://feed/2'],
+                       [a['object']['url'] for a in resp.json['items']])
+
   def test_url_rss_to_as1_parse_error(self):
     """feedparser.parse returns empty on bad input RSS."""
     self.expect_requests_get('http://feed', 'not valid xml')
@@ -598,6 +617,55 @@ not RSS!
     self.assertNotIn('<a class="p-name u-url" href="http://my/place">My place</a>',
                      resp.get_data(as_text=True))
 
+  def test_url_as1_to_atom_stream(self):
+    activities = []
+    for i in range(100):
+      activity = copy.deepcopy(AS1[0])
+      activity['object']['url'] = f'https://perma/link/{i}'
+      activities.append(activity)
+    self.expect_requests_get('http://my/posts.as', activities)
+    self.mox.ReplayAll()
+
+    resp = client.get('/url?url=http://my/posts.as&input=as1&output=atom&stream=true')
+    self.assert_equals(200, resp.status_code)
+    self.assert_equals('application/atom+xml', resp.headers['Content-Type'])
+    body = resp.get_data(as_text=True)
+    self.assert_equals(100, body.count('<entry>'))
+    self.assertIn('https://perma/link/99', body)
+    self.assertTrue(body.rstrip().endswith('</feed>'))
+
+  def test_make_response_atom_stream(self):
+    response = {'items': [copy.deepcopy(AS1[0])]}
+    with app.test_request_context('/url?output=atom&stream=true'):
+      self.assertTrue(app_module.make_response(response).is_streamed)
+
+    with app.test_request_context('/url?output=atom'):
+      body, _ = app_module.make_response(response)
+      self.assertIsInstance(body, str)
+
+  @testutil.enable_flask_caching(app, cache)
+  def test_url_as1_to_atom_large_feed_cached(self):
+    activities = []
+    for i in range(100):
+      activity = copy.deepcopy(AS1[0])
+      activity['object']['url'] = f'https://perma/link/{i}'
+      activities.append(activity)
+    self.expect_requests_get('http://my/posts.as', activities)
+    self.mox.ReplayAll()
+
+    # second request is served from the response cache, not fetched again
+    for _ in range(2):
+      resp = client.get('/url?url=http://my/posts.as&input=as1&output=atom')
+      self.assert_equals(200, resp.status_code)
+      self.assert_equals(100, resp.get_data(as_text=True).count('<entry>'))
+
+  def test_url_atom_bad_stream_param(self):
+    self.expect_requests_get('http://my/posts.as', AS1)
+    self.mox.ReplayAll()
+
+    resp = client.get('/url?url=http://my/posts.as&input=as1&output=atom&stream=foo')
+    self.assert_equals(400, resp.status_code)
+
   def test_url_as1_to_atom_if_missing_actor_use_hfeed(self):
     mf2 = {'items': [{
       'type': ['h-feed'],